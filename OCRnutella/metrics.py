@@ -0,0 +1,165 @@
+"""Per-request instrumentation of the OCRnutella project.
+
+RequestMetricsMiddleware measures every request: wall time, SQL queries and their time, template rendering
+time. The measures are kept in rolling windows per view and exposed in the Prometheus text format by
+`metrics_view`. Everything is disabled unless the METRICS_ENABLED setting is set.
+"""
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.template.backends.django import DjangoTemplates, Template
+
+current_request = ContextVar('current_request_metrics', default=None)
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def sql_shape(sql):
+    """ Returning the shape of a query: its SQL with the variable length IN lists collapsed, the parameters being
+    apart already
+    """
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class RequestMetrics:
+    """ Measures of a single request
+    """
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        """ Database execute wrapper timing every query
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.sql_count += 1
+            self.shapes[sql] += 1
+
+    def repeated_shapes(self, threshold):
+        """ Returning the query shapes run more than `threshold` times, the sign of an N+1 pattern
+        """
+        shapes = Counter()
+        for sql, count in self.shapes.items():
+            shapes[sql_shape(sql)] += count
+        return {shape: count for shape, count in shapes.items() if count > threshold}
+
+
+class Window:
+    """ Rolling window of the last observations of a value, with running totals since startup
+    """
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        values = sorted(self.values)
+        if not values:
+            return {}
+        return {quantile: values[min(len(values) - 1, int(quantile * len(values)))] for quantile in QUANTILES}
+
+
+class Registry:
+    """ In-process store of the measures, per view
+    """
+    SUMMARIES = (
+        ('request_duration_seconds', "Wall time of the requests"),
+        ('sql_queries', "Number of SQL queries per request"),
+        ('sql_duration_seconds', "Time spent in SQL queries per request"),
+        ('template_duration_seconds', "Time spent rendering templates per request"),
+    )
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.summaries = {name: {} for name, description in self.SUMMARIES}
+        self.n_plus_one = Counter()
+
+    def record(self, view, duration, metrics, n_plus_one):
+        observations = (('request_duration_seconds', duration),
+                        ('sql_queries', metrics.sql_count),
+                        ('sql_duration_seconds', metrics.sql_time),
+                        ('template_duration_seconds', metrics.template_time))
+        with self.lock:
+            for name, value in observations:
+                windows = self.summaries[name]
+                if view not in windows:
+                    windows[view] = Window(self.window)
+                windows[view].observe(value)
+            if n_plus_one:
+                self.n_plus_one[view] += 1
+
+    def render(self):
+        """ Returning the measures in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, description in self.SUMMARIES:
+                metric = 'pur_beurre_' + name
+                lines.append('# HELP {0} {1}'.format(metric, description))
+                lines.append('# TYPE {0} summary'.format(metric))
+                for view, window in sorted(self.summaries[name].items()):
+                    for quantile, value in window.quantiles().items():
+                        lines.append('{0}{{view="{1}",quantile="{2}"}} {3}'.format(metric, view, quantile, value))
+                    lines.append('{0}_sum{{view="{1}"}} {2}'.format(metric, view, window.sum))
+                    lines.append('{0}_count{{view="{1}"}} {2}'.format(metric, view, window.count))
+            lines.append('# HELP pur_beurre_n_plus_one_total Requests repeating a query shape too many times')
+            lines.append('# TYPE pur_beurre_n_plus_one_total counter')
+            for view, count in sorted(self.n_plus_one.items()):
+                lines.append('pur_beurre_n_plus_one_total{{view="{0}"}} {1}'.format(view, count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = current_request.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """ Django template backend timing the rendering of the templates for the request metrics
+    """
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
+
+
+def metrics_view(request):
+    """ Exposing the request metrics to Prometheus, when enabled. With a METRICS_TOKEN setting, the scraper must
+    send it as a bearer token.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    token = settings.METRICS_TOKEN
+    if token and request.META.get('HTTP_AUTHORIZATION') != 'Bearer ' + token:
+        return HttpResponse(status=401)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,91 @@
+import json
+import logging
+import re
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from OCRnutella.metrics import RequestMetrics, current_request, registry
+from OCRnutella.routers import PIN_COOKIE, SAFE_METHODS, Routing, current_routing
+
+logger = logging.getLogger('OCRnutella.requests')
+
+REQUEST_ID = re.compile(r'^[\w.-]{1,64}$')
+
+
+class RequestMetricsMiddleware:
+    """ Measuring the wall time, SQL queries and template rendering of every request, per view. Each request gets
+    an id, taken from the X-Request-ID header when the proxy sets one, which is sent back and written in a
+    structured log line. Not loaded unless the METRICS_ENABLED setting is set.
+    """
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = settings.METRICS_N_PLUS_ONE_THRESHOLD
+        registry.window = settings.METRICS_WINDOW
+
+    def __call__(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID', '')
+        if not REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+
+        metrics = RequestMetrics()
+        token = current_request.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        n_plus_one = metrics.repeated_shapes(self.threshold)
+        registry.record(view, duration, metrics, n_plus_one)
+        response['X-Request-ID'] = request_id
+
+        logger.info(json.dumps({
+            'request_id': request_id,
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+            'sql_queries': metrics.sql_count,
+            'sql_ms': round(metrics.sql_time * 1000, 2),
+            'template_ms': round(metrics.template_time * 1000, 2),
+        }))
+        for shape, count in n_plus_one.items():
+            logger.warning(json.dumps({'request_id': request_id, 'view': view, 'n_plus_one': count, 'sql': shape}))
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """ Letting the router send the catalog reads of the request to the replicas, unless the request writes or
+    its client wrote recently. Not loaded unless the DATABASE_REPLICAS setting lists a replica.
+    """
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = Routing(pinned=request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES)
+        token = current_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        if routing.wrote or request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                                samesite='Lax')
+        return response
@@ -0,0 +1,81 @@
+"""PostgreSQL backend keeping the connections of each process in a bounded pool.
+
+Django opens a connection per thread and closes it at the end of the request when CONN_MAX_AGE is 0, or keeps it
+open for as long as CONN_MAX_AGE whatever the load. With this backend the connection is returned to the pool of
+its process instead of being closed, and every process holds at most POOL['SIZE'] connections, whatever its number
+of threads: the total stays within the budget of the database. Use it with CONN_MAX_AGE set to 0.
+
+    DATABASES['default']['POOL'] = {'SIZE': 5, 'TIMEOUT': 10, 'CHECK_AFTER': 30, 'MAX_AGE': 1800}
+"""
+import os
+import threading
+
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from OCRnutella.postgresql_pool.pool import ConnectionPool, PoolTimeout
+
+Database = base.Database
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def ping(connection):
+    """ Telling whether an idle connection still answers
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if not connection.autocommit:
+            connection.rollback()
+        return True
+    except Database.Error:
+        return False
+
+
+def reusable(connection):
+    """ Telling whether a connection can be handed out again, rolling back what a closing request left open
+    """
+    if connection.closed:
+        return False
+    try:
+        if connection.get_transaction_status() in (extensions.TRANSACTION_STATUS_INTRANS,
+                                                   extensions.TRANSACTION_STATUS_INERROR):
+            connection.rollback()
+        return connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+    except Database.Error:
+        return False
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def pool(self):
+        """ Returning the pool of this database in the current process: a forked worker starts with its own
+        """
+        key = (self.alias, os.getpid())
+        with pools_lock:
+            if key not in pools:
+                options = self.settings_dict.get('POOL', {})
+                pools[key] = ConnectionPool(options.get('SIZE', 5), options.get('TIMEOUT', 10),
+                                            options.get('CHECK_AFTER', 30), options.get('MAX_AGE', 30 * 60))
+            return pools[key]
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection = self.pool().acquire(lambda: Database.connect(**conn_params), ping)
+        except PoolTimeout as error:
+            raise Database.OperationalError(str(error))
+
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            self.pool().release(self.connection, reusable(self.connection))
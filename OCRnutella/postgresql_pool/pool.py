@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """ Bounded pool of database connections shared by the threads of one process. At most `size` connections are
+    handed out at once, a thread asking for one more waiting up to `timeout` seconds. Idle connections are reused
+    most recently returned first, so that the spare ones age out: a connection older than `max_age` seconds is
+    closed, and one idle for more than `check_after` seconds is checked with `ping` before being handed out.
+    """
+    def __init__(self, size, timeout=10, check_after=30, max_age=30 * 60):
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_age = max_age
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        # Referencing the connections handed out, so that the id of a live one is never reused by another object
+        self.created = {}
+
+    def acquire(self, connect, ping):
+        """ Returning a healthy idle connection, or a new one made by `connect`
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout("No database connection free after {0}s, {1} in use".format(self.timeout, self.size))
+        try:
+            while True:
+                with self.lock:
+                    entry = self.idle.pop() if self.idle else None
+                if entry is None:
+                    connection = connect()
+                    with self.lock:
+                        self.created[id(connection)] = (connection, time.monotonic())
+                    return connection
+                connection, returned = entry
+                now = time.monotonic()
+                if now - self.created[id(connection)][1] > self.max_age:
+                    self.discard(connection)
+                elif now - returned > self.check_after and not ping(connection):
+                    self.discard(connection)
+                else:
+                    return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, reusable):
+        """ Taking a connection back, to be reused unless it is not `reusable` or too old. A connection this pool did
+        not hand out, such as one inherited from a parent process, is closed.
+        """
+        if self.created.get(id(connection), (None,))[0] is not connection:
+            close_quietly(connection)
+            return
+        if reusable and time.monotonic() - self.created[id(connection)][1] <= self.max_age:
+            with self.lock:
+                self.idle.append((connection, time.monotonic()))
+        else:
+            self.discard(connection)
+        self.slots.release()
+
+    def discard(self, connection):
+        with self.lock:
+            self.created.pop(id(connection), None)
+        close_quietly(connection)
+
+    def clear(self):
+        """ Closing the idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, returned in idle:
+            self.discard(connection)
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
@@ -0,0 +1,131 @@
+"""Routing of the catalog reads to the read replicas of the database.
+
+The aliases of the replicas are listed in the DATABASE_REPLICAS setting. Within a request handled by
+ReplicaRoutingMiddleware, the reads of the catalog models go to the replicas in turn, skipping those lagging more
+than REPLICA_MAX_LAG seconds behind the primary, and to the primary when none is fit. Everything else goes to the
+primary: the writes, the reads of the users and of their saved products, the reads within a transaction of the
+primary, which have to see its uncommitted writes, and every query made outside of a request, by the management
+commands for instance.
+
+A request writing to the database is pinned to the primary from its first write on, and so are the requests of
+the same client for the next REPLICA_PIN_SECONDS seconds, through a cookie: a user saving a product reads it back
+from the primary, whatever the lag of the replicas. The requests of other methods than GET and HEAD are pinned
+from the start.
+
+What is cached under the catalog generation is computed from the primary, within `primary()`: a replica still
+behind the refresh which bumped the generation would otherwise fill the new generation with the catalog as it was
+before, to be served until the next refresh.
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+PRIMARY = 'default'
+PIN_COOKIE = 'pin_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+REPLICATED_MODELS = {'pur_beurre.categories', 'pur_beurre.product', 'pur_beurre.product_categories',
+                     'pur_beurre.productsubstitute'}
+
+current_routing = ContextVar('current_routing', default=None)
+
+lags = {}
+lags_lock = threading.Lock()
+turns = itertools.count()
+
+
+class Routing:
+    """ Routing state of a single request
+    """
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+@contextmanager
+def primary():
+    """ Reading from the primary within the block, the request being pinned again only if it wrote meanwhile
+    """
+    routing = current_routing.get()
+    if routing is None or routing.pinned:
+        yield
+        return
+    routing.pinned = True
+    try:
+        yield
+    finally:
+        routing.pinned = routing.wrote
+
+
+def measure_lag(alias):
+    """ Returning how many seconds a replica is behind the primary, 0 when it replayed everything it received
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                       'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+        lag = cursor.fetchone()[0]
+    return float(lag or 0)
+
+
+def replica_lag(alias):
+    """ Returning the lag of a replica, measured at most once every REPLICA_LAG_CHECK_INTERVAL seconds per
+    process. A replica which cannot be reached is infinitely late.
+    """
+    now = time.monotonic()
+    with lags_lock:
+        checked = lags.get(alias)
+    if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        lag = measure_lag(alias)
+    except DatabaseError:
+        lag = float('inf')
+    with lags_lock:
+        lags[alias] = (now, lag)
+    return lag
+
+
+def pick_replica():
+    """ Returning the next replica in turn lagging no more than REPLICA_MAX_LAG seconds, or the primary
+    """
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas:
+        return PRIMARY
+    start = next(turns)
+    for index in range(len(replicas)):
+        alias = replicas[(start + index) % len(replicas)]
+        if replica_lag(alias) <= settings.REPLICA_MAX_LAG:
+            return alias
+    return PRIMARY
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or routing.pinned or model._meta.label_lower not in REPLICATED_MODELS:
+            return PRIMARY
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return pick_replica()
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.pinned = routing.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
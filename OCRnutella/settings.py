@@ -44,7 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'pur_beurre',
+    'pur_beurre.apps.OcwebsiteConfig',
     'users.apps.UsersConfig',
     'crispy_forms',
 
@@ -52,6 +52,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'OCRnutella.middleware.RequestMetricsMiddleware',
+    'OCRnutella.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -64,7 +66,7 @@ ROOT_URLCONF = 'OCRnutella.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'OCRnutella.metrics.InstrumentedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates'),
                  ],
         'APP_DIRS': True,
@@ -112,7 +114,91 @@ else:
 
 
 
+# Cache
+# The backend is chosen with the CACHE_BACKEND environment variable: locmem (default), file or redis. The locmem
+# cache belongs to each process: what has to be seen by every worker and by the management commands, such as the
+# catalog generation, is then kept in the database.
 
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+CACHE_SHARED = CACHE_BACKEND in ('redis', 'file')
+
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            },
+        }
+    }
+elif CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Sessions and logged in users
+# SESSION_STORE=cached_db reads the sessions from the cache and writes them through to the database, cache keeps
+# them in the cache only and db in the database only. cached_db is the default when the cache is shared by the
+# workers, the per-process locmem cache not being able to hold sessions. With a shared cache, the authentication
+# backend caches the logged in users for USER_CACHE_TIMEOUT seconds and forgets them whenever they are saved, so
+# that an authenticated request reads neither its session nor its user from the database. The locmem cache of a
+# worker would not see the users forgotten by the others, which would keep accepting a changed password or a
+# deactivated user: the users are then read from the database. "manage.py clear_expired_sessions" deletes the
+# expired database sessions by batches.
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'cached_db' if CACHE_SHARED else 'db')
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + SESSION_STORE
+AUTHENTICATION_BACKENDS = ['users.backends.CachedModelBackend' if CACHE_SHARED else
+                           'django.contrib.auth.backends.ModelBackend']
+USER_CACHE_TIMEOUT = 60 * 5
+
+# Lifetime of the cached product and substitutes pages, which are also invalidated by every catalog refresh. Without
+# a shared cache, each worker reads the catalog generation from the database every CATALOG_GENERATION_CHECK_INTERVAL
+# seconds.
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+CATALOG_GENERATION_CHECK_INTERVAL = 5
+
+# Search box suggestions: the prefix index is published to this file by the catalog imports and each worker checks
+# it for a newer version every AUTOCOMPLETE_RELOAD_INTERVAL seconds
+AUTOCOMPLETE_INDEX_PATH = os.environ.get('AUTOCOMPLETE_INDEX_PATH', os.path.join(BASE_DIR, 'autocomplete.idx'))
+AUTOCOMPLETE_RELOAD_INTERVAL = 30
+
+# Popularity: the save counts of the products are buffered by each worker and written in batches, once
+# SAVE_COUNT_FLUSH_SIZE products changed or SAVE_COUNT_FLUSH_INTERVAL seconds passed. "manage.py reconcile_save_counts"
+# corrects any drift. The most saved products lists are cached for MOST_SAVED_CACHE_TIMEOUT seconds.
+SAVE_COUNT_FLUSH_SIZE = 100
+SAVE_COUNT_FLUSH_INTERVAL = 10
+MOST_SAVED_CACHE_TIMEOUT = 60 * 10
+MOST_SAVED_SIZE = 30
+
+# Product image thumbnails, fetched by "manage.py fetch_images" and served from this directory
+THUMBNAIL_ROOT = os.environ.get('THUMBNAIL_ROOT', os.path.join(BASE_DIR, 'thumbnails'))
+THUMBNAIL_MAX_BYTES = int(os.environ.get('THUMBNAIL_MAX_BYTES', 512 * 1024 * 1024))
+THUMBNAIL_FETCHER = 'pur_beurre.thumbnails.HttpImageFetcher'
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_SIZES = {
+    'card': (200, 200),
+    'page': (400, 400),
+}
+
+
+# Request metrics
+# Opt-in with METRICS_ENABLED=1: timings and SQL counts per view, exposed for Prometheus on /metrics.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_WINDOW = 1000
+METRICS_N_PLUS_ONE_THRESHOLD = 10
 
 
 # Password validation
@@ -161,4 +247,42 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 django_heroku.settings(locals())
 
+# Read replicas
+# DATABASE_REPLICA_URLS lists the URLs of the read replicas, separated by commas, which become the replica1,
+# replica2... databases. OCRnutella.routers.PrimaryReplicaRouter sends them the catalog reads of the requests,
+# skipping a replica more than REPLICA_MAX_LAG seconds behind; a client having written reads from the primary
+# for REPLICA_PIN_SECONDS. The tests read the replicas from the test database of the primary.
+
+DATABASE_REPLICAS = []
+for url in filter(None, (url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = 'replica{0}'.format(len(DATABASE_REPLICAS) + 1)
+    DATABASES[alias] = dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['OCRnutella.routers.PrimaryReplicaRouter']
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+REPLICA_LAG_CHECK_INTERVAL = 5
+REPLICA_PIN_SECONDS = 15
+
+# Database connections in production
+# Every process keeps its connections in a pool (OCRnutella.postgresql_pool) rather than opening one per request.
+# The DB_CONNECTION_BUDGET connections a dyno may open on each database are shared between its WEB_CONCURRENCY
+# worker processes, set by gunicorn.conf.py: a thread finding the pool of its process empty waits for a
+# connection. DB_POOL=0 goes back to the plain backend. Applied after django_heroku, which rebuilds DATABASES from
+# DATABASE_URL.
+
+if os.environ.get('ENV') == 'PRODUCTION' and os.environ.get('DB_POOL', '1') == '1':
+    for alias in DATABASES:
+        DATABASES[alias].update({
+            'ENGINE': 'OCRnutella.postgresql_pool',
+            'CONN_MAX_AGE': 0,
+            'POOL': {
+                'SIZE': max(1, int(os.environ.get('DB_CONNECTION_BUDGET', 20)) //
+                            int(os.environ.get('WEB_CONCURRENCY', 1))),
+                'TIMEOUT': 10,
+                'CHECK_AFTER': 30,
+                'MAX_AGE': 30 * 60,
+            },
+        })
+
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""Gunicorn settings of the web dynos.
+
+The number of worker processes follows the CPUs, within what the memory of the dyno can hold, and each worker
+runs threads to keep the CPUs busy while requests wait on the database or the cache. The application is loaded
+once before forking (preload_app), so the workers share its memory copy-on-write. WEB_CONCURRENCY and
+GUNICORN_THREADS override the computed values.
+"""
+import multiprocessing
+import os
+
+# Resident memory of one worker serving the site, in MB
+WORKER_MEMORY = int(os.environ.get('GUNICORN_WORKER_MEMORY', 150))
+
+
+def memory_limit():
+    """ Returning the memory available to the dyno in MB, from its cgroup limit when there is one
+    """
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as limit_file:
+                value = limit_file.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 50:
+            return int(value) // (1024 * 1024)
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+cpus = multiprocessing.cpu_count()
+workers = int(os.environ.get('WEB_CONCURRENCY') or max(1, min(2 * cpus + 1, memory_limit() // WORKER_MEMORY)))
+threads = int(os.environ.get('GUNICORN_THREADS') or max(2, min(8, 4 * cpus // workers)))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = True
+
+bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', '8000'))
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Recycling the workers now and then bounds the memory any leak can take
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = '-'
+errorlog = '-'
+
+# Read by the settings to share the database connections between the workers
+os.environ['WEB_CONCURRENCY'] = str(workers)
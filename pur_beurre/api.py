@@ -0,0 +1,262 @@
+"""Read-only JSON API over the catalog, version 1.
+
+Every endpoint reads `values()` rows and runs a fixed number of queries whatever the page size: one for the page,
+plus one for the categories of its products when they are requested. Lists are paginated with opaque cursors on
+the ordering key rather than offsets, so deep pages cost as little as the first one.
+"""
+import base64
+import binascii
+import json
+
+from django.db.models import Count, F
+from django.http import JsonResponse
+from django.utils.cache import patch_cache_control
+from django.views import View
+
+from pur_beurre.models import Categories, Product
+from pur_beurre.popularity import most_saved
+from pur_beurre.substitutes import live_substitutes, stored_substitutes_cover
+
+# API field name -> model field. The product page and ingredients are stored in the itemcode and openfoodfacts_link
+# fields respectively since the first imports. The barcode is null for the products without one.
+PRODUCT_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'brand': 'brand',
+    'nutriscore': 'nutriscore',
+    'image': 'image',
+    'barcode': 'barcode',
+    'url': 'itemcode',
+    'ingredients': 'openfoodfacts_link',
+    'last_modified_t': 'last_modified_t',
+    'save_count': 'save_count',
+}
+CATEGORY_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'product_count': 'product_count',
+    'url': 'url',
+    'off_id': 'off_id',
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise ApiError("Invalid cursor")
+    if not isinstance(value, int):
+        raise ApiError("Invalid cursor")
+    return value
+
+
+def parse_ids(value, limit):
+    try:
+        ids = sorted({int(part) for part in value.split(',') if part.strip()})
+    except ValueError:
+        raise ApiError("ids must be a comma separated list of integers")
+    if len(ids) > limit:
+        raise ApiError("At most {0} ids per request".format(limit))
+    return ids
+
+
+class ApiView(View):
+    """ Base of the API endpoints: field selection, cursor pagination and errors as JSON
+        """
+    fields = PRODUCT_FIELDS
+    relations = ()
+    default_fields = ('id', 'name', 'brand', 'nutriscore', 'image')
+    default_limit = 50
+    max_limit = 200
+    max_age = 300
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            data = super().dispatch(request, *args, **kwargs)
+        except ApiError as error:
+            return JsonResponse({'error': str(error)}, status=error.status)
+        if not isinstance(data, dict):
+            return data
+        response = JsonResponse(data)
+        patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
+
+    def selected_fields(self):
+        """ Returning the fields asked for with `?fields=`, the default ones otherwise
+        """
+        value = self.request.GET.get('fields')
+        if not value:
+            return list(self.default_fields)
+        selected = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in selected if name not in self.fields and name not in self.relations]
+        if unknown:
+            raise ApiError("Unknown fields: {0}".format(', '.join(unknown)))
+        return selected
+
+    def limit(self):
+        value = self.request.GET.get('limit', '')
+        if not value:
+            return self.default_limit
+        if not value.isdigit() or not 0 < int(value) <= self.max_limit:
+            raise ApiError("limit must be between 1 and {0}".format(self.max_limit))
+        return int(value)
+
+    def rows(self, queryset, selected, extra=()):
+        """ Reading the selected fields of the queryset as dicts keyed by their API names
+        """
+        columns = {self.fields[name] for name in selected if name in self.fields} | {'id'} | set(extra)
+        rows = list(queryset.values(*columns))
+        return [{name: row[self.fields[name]] for name in selected if name in self.fields} for row in rows], rows
+
+    def paginate(self, queryset, selected, key='id', extra=()):
+        """ Returning the page of rows following the cursor, ordered by `key`, and the cursor of the next page
+        """
+        cursor = self.request.GET.get('cursor')
+        if cursor:
+            queryset = queryset.filter(**{key + '__gt': decode_cursor(cursor)})
+        limit = self.limit()
+        results, rows = self.rows(queryset.order_by(key)[:limit + 1], selected, extra=(key,) + extra)
+        if len(rows) <= limit:
+            return results, rows, None
+        return results[:limit], rows[:limit], encode_cursor(rows[limit - 1][key])
+
+    def next_url(self, cursor):
+        if cursor is None:
+            return None
+        query = self.request.GET.copy()
+        query['cursor'] = cursor
+        return self.request.build_absolute_uri('?' + query.urlencode())
+
+
+class ProductApiView(ApiView):
+    relations = ('categories',)
+
+    def with_categories(self, results, rows, selected):
+        """ Adding the category ids of every product, read in one query for the whole page
+        """
+        if 'categories' not in selected:
+            return results
+        categories = {row['id']: [] for row in rows}
+        links = (Product.categories.through.objects.filter(product_id__in=list(categories))
+                 .order_by('categories_id').values_list('product_id', 'categories_id'))
+        for product_id, category_id in links:
+            categories[product_id].append(category_id)
+        for result, row in zip(results, rows):
+            result['categories'] = categories[row['id']]
+        return results
+
+
+class ProductList(ProductApiView):
+    """ Listing the products by id, optionally filtered by nutriscore or category, or looking up many products at
+    once with `?ids=`
+        """
+    def get(self, request):
+        selected = self.selected_fields()
+        queryset = Product.objects.filter(is_active=True)
+        if request.GET.get('nutriscore'):
+            queryset = queryset.filter(nutriscore=request.GET['nutriscore'].upper())
+        if request.GET.get('category', '').isdigit():
+            queryset = queryset.filter(categories=request.GET['category'])
+
+        if 'ids' in request.GET:
+            ids = parse_ids(request.GET['ids'], self.max_limit)
+            results, rows = self.rows(queryset.filter(id__in=ids).order_by('id'), selected)
+            return {'results': self.with_categories(results, rows, selected), 'next': None}
+
+        results, rows, cursor = self.paginate(queryset, selected)
+        return {'results': self.with_categories(results, rows, selected), 'next': self.next_url(cursor)}
+
+
+class MostSavedProducts(ProductApiView):
+    """ Listing the most saved products, of a category with `?category=` or of the whole catalog, from the cached
+    ranking
+        """
+    def get(self, request):
+        selected = self.selected_fields()
+        category = request.GET.get('category', '')
+        ids = most_saved(int(category) if category.isdigit() else None, self.limit())
+        results, rows = self.rows(Product.objects.filter(id__in=ids), selected)
+        position = {product_id: index for index, product_id in enumerate(ids)}
+        ordered = sorted(zip(results, rows), key=lambda pair: position[pair[1]['id']])
+        results, rows = [result for result, row in ordered], [row for result, row in ordered]
+        return {'results': self.with_categories(results, rows, selected), 'next': None}
+
+
+class ProductDetail(ProductApiView):
+    """ Returning a single product
+        """
+    default_fields = tuple(PRODUCT_FIELDS) + ('categories',)
+
+    def get(self, request, id):
+        selected = self.selected_fields()
+        results, rows = self.rows(Product.objects.filter(id=id), selected)
+        if not results:
+            raise ApiError("Product not found", status=404)
+        return self.with_categories(results, rows, selected)[0]
+
+
+class ProductSubstitutes(ProductApiView):
+    """ Listing the substitutes of a product, best first, with their rank and the number of categories they share
+    with it. They are read from the precomputed ones, or ranked by the similarity engine like the substitutes page
+    does for the products without any and beyond the precomputed ranks.
+        """
+    def get(self, request, id):
+        selected = self.selected_fields()
+        product = (Product.objects.filter(id=id).annotate(stored=Count('substitutes'))
+                   .values('id', 'nutriscore', 'stored').first())
+        if product is None:
+            raise ApiError("Product not found", status=404)
+        cursor = request.GET.get('cursor')
+        after = decode_cursor(cursor) if cursor else 0
+        if stored_substitutes_cover(product['stored'], after + self.limit()):
+            queryset = (Product.objects.filter(substitute_of__product_id=id, is_active=True)
+                        .annotate(rank=F('substitute_of__rank'),
+                                  shared_categories=F('substitute_of__shared_categories')))
+            results, rows, cursor = self.paginate(queryset, selected, key='rank', extra=('shared_categories',))
+        else:
+            results, rows, cursor = self.live_page(product, after, selected)
+        for result, row in zip(results, rows):
+            result['rank'] = row['rank']
+            result['shared_categories'] = row['shared_categories']
+        return {'results': self.with_categories(results, rows, selected), 'next': self.next_url(cursor)}
+
+    def live_page(self, product, after, selected):
+        """ Returning the page of the substitutes ranked by the engine following the rank `after`, and the cursor of
+        the next page
+        """
+        limit = self.limit()
+        candidates = live_substitutes(product['id'], product['nutriscore'])[after:after + limit + 1]
+        ranks = {candidate['id']: (after + position, candidate['shared'])
+                 for position, candidate in enumerate(candidates[:limit], 1)}
+        results, rows = self.rows(Product.objects.filter(id__in=list(ranks), is_active=True), selected)
+        for row in rows:
+            row['rank'], row['shared_categories'] = ranks[row['id']]
+        ordered = sorted(zip(results, rows), key=lambda pair: pair[1]['rank'])
+        cursor = encode_cursor(after + limit) if len(candidates) > limit else None
+        return [result for result, row in ordered], [row for result, row in ordered], cursor
+
+
+class CategoryList(ApiView):
+    """ Listing the categories by id, or looking up many categories at once with `?ids=`
+        """
+    fields = CATEGORY_FIELDS
+    default_fields = tuple(CATEGORY_FIELDS)
+
+    def get(self, request):
+        selected = self.selected_fields()
+        if 'ids' in request.GET:
+            ids = parse_ids(request.GET['ids'], self.max_limit)
+            results, rows = self.rows(Categories.objects.filter(id__in=ids).order_by('id'), selected)
+            return {'results': results, 'next': None}
+        results, rows, cursor = self.paginate(Categories.objects.all(), selected)
+        return {'results': results, 'next': self.next_url(cursor)}
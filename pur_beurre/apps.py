@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def reinstall_sqlite_fts(using, **kwargs):
+    """ SQLite loses the FTS5 triggers whenever a migration rebuilds the product table
+    """
+    from django.db import connections
+    from pur_beurre.search import install_sqlite_fts
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        install_sqlite_fts(connection)
 
 
 class OcwebsiteConfig(AppConfig):
     name = 'pur_beurre'
+
+    def ready(self):
+        post_migrate.connect(reinstall_sqlite_fts, sender=self)
@@ -0,0 +1,177 @@
+import heapq
+import os
+import pickle
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count
+
+from pur_beurre.cache import catalog_generation
+from pur_beurre.models import Product, SavedProduct
+from pur_beurre.search import search_terms
+
+PRODUCT = 'product'
+BRAND = 'brand'
+
+
+def normalize(text):
+    """ Returning the key under which a name is indexed: lowercase words without accents nor punctuation
+    """
+    return ' '.join(search_terms(text))
+
+
+class PrefixIndex:
+    """ Sorted array of normalized product names and brands with their popularity. The suggestions for a prefix
+    are the most popular entries of the contiguous range of keys starting with it, found by bisection. The ranges
+    of short prefixes are too large to scan on every keystroke, so their suggestions are computed once at build.
+    """
+    precomputed_length = 3
+    precomputed_range = 1000
+
+    def __init__(self, entries, limit=10):
+        """ `entries` are (key, weight, label, kind, product id) tuples
+        """
+        entries = sorted(entries)
+        self.keys = [entry[0] for entry in entries]
+        self.weights = [entry[1] for entry in entries]
+        self.suggestions = [{'label': entry[2], 'kind': entry[3], 'id': entry[4]} for entry in entries]
+        self.limit = limit
+        self.precomputed = {}
+        prefixes = {key[:length] for key in self.keys for length in range(1, self.precomputed_length + 1)}
+        for prefix in prefixes:
+            start, end = self.range(prefix)
+            if end - start > self.precomputed_range:
+                self.precomputed[prefix] = self.best(start, end, limit)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def range(self, prefix):
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + '￿')
+
+    def best(self, start, end, limit):
+        positions = heapq.nlargest(limit, range(start, end), key=self.weights.__getitem__)
+        return [self.suggestions[position] for position in positions]
+
+    def suggest(self, text, limit=None):
+        """ Returning the most popular suggestions starting with the text, most popular first
+        """
+        limit = min(limit or self.limit, self.limit)
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        if prefix in self.precomputed:
+            return self.precomputed[prefix][:limit]
+        return self.best(*self.range(prefix), limit)
+
+    @classmethod
+    def build(cls, limit=10):
+        """ Building the index from the catalog. Products sharing a name are merged into the most popular one, a
+        product weighs one plus the number of times it was saved and a brand the sum of its products' weights.
+        """
+        saves = dict(SavedProduct.objects.values_list('saved_product').annotate(count=Count('id')))
+        products = {}
+        brands = {}
+        rows = Product.objects.filter(is_active=True).values_list('id', 'name', 'brand')
+        for product_id, name, brand in rows.iterator():
+            weight = 1 + saves.get(product_id, 0)
+            key = normalize(name)
+            if key:
+                known = products.get(key)
+                if known is None or weight > known[1]:
+                    products[key] = (key, weight + (known[1] if known else 0), name, PRODUCT, product_id)
+                else:
+                    products[key] = known[:1] + (known[1] + weight,) + known[2:]
+            key = normalize(brand)
+            if key:
+                known = brands.get(key, (key, 0, brand, BRAND, None))
+                brands[key] = known[:1] + (known[1] + weight,) + known[2:]
+        return cls(list(products.values()) + list(brands.values()), limit)
+
+    def save(self, path):
+        """ Writing the index atomically, so that workers never read a partial file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as index_file:
+            pickle.dump(self, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as index_file:
+            return pickle.load(index_file)
+
+
+class SharedIndex:
+    """ The index of this worker process, shared by its threads: every worker holds its own copy, loaded from the
+    file published by the catalog imports. The file is checked for a newer version at most every
+    `reload_interval` seconds and swapped in whole, so requests always see a complete index. Without a published
+    file, as when the import ran on another machine, the index is built from the database by a thread of its own,
+    and built again once the catalog generation changed. Requests never wait for a build nor for another request
+    loading the file: they are answered from the previous index meanwhile, an empty one at first.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.mtime = None
+        self.generation = None
+        self.checked = 0
+        self.builder = None
+
+    def get(self):
+        due = time.monotonic() - self.checked > settings.AUTOCOMPLETE_RELOAD_INTERVAL
+        if due and self.lock.acquire(blocking=False):
+            try:
+                self.reload()
+            finally:
+                self.lock.release()
+        return self.index if self.index is not None else EMPTY_INDEX
+
+    def reload(self):
+        self.checked = time.monotonic()
+        path = settings.AUTOCOMPLETE_INDEX_PATH
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            generation = catalog_generation()
+            building = self.builder is not None and self.builder.is_alive()
+            if not building and (self.index is None or self.mtime is not None or generation != self.generation):
+                self.builder = threading.Thread(target=self.build, args=(generation,), daemon=True)
+                self.builder.start()
+            return
+        if mtime != self.mtime:
+            self.index, self.mtime = PrefixIndex.load(path), mtime
+
+    def build(self, generation):
+        """ Building the index of a catalog generation from the database. Running outside of any request, it
+        reads from the primary.
+        """
+        try:
+            index = PrefixIndex.build()
+            with self.lock:
+                self.index, self.mtime, self.generation = index, None, generation
+        finally:
+            connections.close_all()
+
+    def reset(self):
+        if self.builder is not None:
+            self.builder.join()
+        with self.lock:
+            self.index, self.mtime, self.generation, self.checked, self.builder = None, None, None, 0, None
+
+
+EMPTY_INDEX = PrefixIndex([])
+shared_index = SharedIndex()
+
+
+def rebuild_autocomplete_index():
+    """ Building the index from the catalog and publishing it, for every worker to load its own copy
+    """
+    index = PrefixIndex.build()
+    index.save(settings.AUTOCOMPLETE_INDEX_PATH)
+    return index
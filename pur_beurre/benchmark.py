@@ -0,0 +1,152 @@
+import platform
+import random
+import subprocess
+import time
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from pur_beurre.cache import catalog_generation
+from pur_beurre.models import Categories, Product, ProductSubstitute, SavedProduct
+from pur_beurre.substitutes import refresh_substitutes
+
+FOODS = ['Crème', 'Pâte', 'Biscuit', 'Yaourt', 'Jus', 'Chocolat', 'Fromage', 'Pain', 'Soupe', 'Céréales',
+         'Compote', 'Beurre', 'Lait', 'Confiture', 'Gâteau', 'Purée', 'Sauce', 'Thé', 'Riz', 'Galette']
+FLAVOURS = ['Nature', 'Bio', 'Allégé', 'Fraise', 'Vanille', 'Noisette', 'Citron', 'Complet', 'Doux', 'Épicé',
+            'Pomme', 'Caramel', 'Coco', 'Miel', 'Tomate']
+NUTRISCORES = (('A', 15), ('B', 15), ('C', 25), ('D', 25), ('E', 15), ('Z', 5))
+QUANTILES = (50, 95, 99)
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}}
+
+
+def generate_catalog(products, categories, users, saved_per_user=10, seed=0):
+    """ Filling the database with a synthetic catalog. Category popularity follows a Zipf-like law and every
+    product gets 2 to 8 categories, the nutriscores follow the usual distribution of Open Food Facts. The same
+    sizes and seed always give the same catalog.
+    """
+    rng = random.Random(seed)
+    Categories.objects.bulk_create([Categories(name='Catégorie {0}'.format(i), url='https://fr.openfoodfacts.org',
+                                               off_id='en:category-{0}'.format(i)) for i in range(categories)])
+    category_ids = list(Categories.objects.order_by('id').values_list('id', flat=True))
+    category_weights = [1.0 / (rank + 1) for rank in range(len(category_ids))]
+
+    grades, grade_weights = zip(*NUTRISCORES)
+    Product.objects.bulk_create([Product(name='{0} {1}'.format(rng.choice(FOODS), rng.choice(FLAVOURS)),
+                                         brand='Marque {0}'.format(rng.randrange(max(products // 20, 1))),
+                                         nutriscore=rng.choices(grades, grade_weights)[0],
+                                         description=str(3000000000000 + i),
+                                         image='https://static.openfoodfacts.org/images/{0}.jpg'.format(i))
+                                 for i in range(products)])
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+
+    through = Product.categories.through
+    links = []
+    for product_id in product_ids:
+        chosen = set(rng.choices(category_ids, category_weights, k=rng.randint(2, 8)))
+        links.extend(through(product_id=product_id, categories_id=category_id) for category_id in chosen)
+    through.objects.bulk_create(links)
+
+    password = make_password('benchmark')
+    User.objects.bulk_create([User(username='bench{0}'.format(i), password=password) for i in range(users)])
+    user_ids = list(User.objects.filter(username__startswith='bench').values_list('id', flat=True))
+    SavedProduct.objects.bulk_create([SavedProduct(saved_by_id=user_id, saved_product_id=product_id)
+                                      for user_id in user_ids
+                                      for product_id in rng.sample(product_ids, min(saved_per_user, products))])
+    refresh_substitutes()
+    return product_ids, user_ids
+
+
+def clear_catalog():
+    ProductSubstitute.objects.all().delete()
+    SavedProduct.objects.all().delete()
+    Product.objects.all().delete()
+    Categories.objects.all().delete()
+    User.objects.filter(username__startswith='bench').delete()
+
+
+def scenarios(product_ids, rng):
+    """ Returning the scripted requests, by scenario name: (method, url, data, logged in)
+    """
+    return {
+        'results': lambda: ('get', reverse('pur-beurre-results'), {'food': rng.choice(FOODS)}, False),
+        'substitutes': lambda: ('get', reverse('pur-beurre-substitutes', args=[rng.choice(product_ids)]), {}, False),
+        'food': lambda: ('get', reverse('pur-beurre-food', args=[rng.choice(product_ids)]), {}, False),
+        'save': lambda: ('post', reverse('pur-beurre-save'), {'food_id': rng.choice(product_ids)}, True),
+        'saved_products': lambda: ('get', reverse('saved-products'), {}, True),
+    }
+
+
+def percentile(values, quantile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile / 100 * len(values)))]
+
+
+def run_scenarios(product_ids, user_ids, iterations=50, seed=0, warm_cache=False):
+    """ Running every scenario `iterations` times and returning their latency percentiles and query counts
+    """
+    rng = random.Random(seed)
+    anonymous, logged_in = Client(), Client()
+    logged_in.force_login(User.objects.get(id=user_ids[0]))
+    catalog_generation()
+    report = {}
+    for name, request in scenarios(product_ids, rng).items():
+        timings, queries = [], []
+        for i in range(iterations):
+            method, url, data, login = request()
+            if not warm_cache:
+                cache.clear()
+            client = logged_in if login else anonymous
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = getattr(client, method)(url, data)
+                timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError("{0} answered {1}".format(url, response.status_code))
+            queries.append(len(context.captured_queries))
+        report[name] = {'p{0}_ms'.format(quantile): round(percentile(timings, quantile), 3)
+                        for quantile in QUANTILES}
+        report[name].update({'mean_ms': round(sum(timings) / len(timings), 3),
+                             'queries_mean': round(sum(queries) / len(queries), 2),
+                             'queries_max': max(queries)})
+    return report
+
+
+def environment():
+    """ Describing what was measured, so that reports of different commits can be compared
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor}
+
+
+def run_benchmark(sizes, iterations=50, seed=0, warm_cache=False):
+    """ Running the scenarios on a synthetic catalog of every size, each size being (products, categories, users).
+    The scenarios clear the cache and the catalog refreshes bump its generation: they run on a cache of their
+    own, overriding CACHES resetting the cache handler, never on the configured one.
+    """
+    report = {'environment': environment(), 'seed': seed, 'iterations': iterations,
+              'warm_cache': warm_cache, 'sizes': []}
+    with override_settings(CACHES=BENCHMARK_CACHES, CACHE_SHARED=False):
+        for products, categories, users in sizes:
+            clear_catalog()
+            start = time.perf_counter()
+            product_ids, user_ids = generate_catalog(products, categories, users, seed=seed)
+            report['sizes'].append({'products': products,
+                                    'categories': categories,
+                                    'users': users,
+                                    'generation_s': round(time.perf_counter() - start, 3),
+                                    'scenarios': run_scenarios(product_ids, user_ids, iterations, seed,
+                                                               warm_cache)})
+        clear_catalog()
+    return report
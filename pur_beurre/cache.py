@@ -0,0 +1,118 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.http import HttpResponse
+
+from OCRnutella.routers import primary
+from pur_beurre.models import SyncState
+
+GENERATION_KEY = 'pur_beurre:catalog_generation'
+GENERATION_SOURCE = 'catalog_generation'
+
+stored = {'generation': None, 'checked': 0.0}
+stored_lock = threading.Lock()
+
+
+def catalog_generation():
+    """ Returning the current catalog generation. Every cached catalog page is keyed by it, so bumping it
+    invalidates all of them at once. It is kept in the cache when the cache is shared by every process, in the
+    database otherwise, read again by each process every CATALOG_GENERATION_CHECK_INTERVAL seconds.
+    """
+    if not settings.CACHE_SHARED:
+        return stored_generation()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_catalog_generation():
+    """ Invalidating every cached catalog page, to be called once the catalog has been refreshed
+    """
+    if not settings.CACHE_SHARED:
+        if not SyncState.objects.filter(source=GENERATION_SOURCE).update(watermark=F('watermark') + 1):
+            SyncState.objects.get_or_create(source=GENERATION_SOURCE, defaults={'watermark': int(time.time() * 1000)})
+        return stored_generation(refresh=True)
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:
+        generation = int(time.time() * 1000)
+        cache.set(GENERATION_KEY, generation, None)
+        return generation
+
+
+def stored_generation(refresh=False):
+    """ Returning the catalog generation kept in the SyncState row of the GENERATION_SOURCE
+    """
+    now = time.monotonic()
+    with stored_lock:
+        if (not refresh and stored['generation'] is not None and
+                now - stored['checked'] < settings.CATALOG_GENERATION_CHECK_INTERVAL):
+            return stored['generation']
+    generation = SyncState.objects.get_or_create(source=GENERATION_SOURCE,
+                                                 defaults={'watermark': int(time.time() * 1000)})[0].watermark
+    with stored_lock:
+        stored['generation'], stored['checked'] = generation, now
+    return generation
+
+
+def catalog_cache_key(request, *parts):
+    """ Building a cache key in the current catalog generation, read once per request
+    """
+    if not hasattr(request, 'catalog_generation'):
+        request.catalog_generation = catalog_generation()
+    return 'pur_beurre:{0}:{1}'.format(request.catalog_generation, ':'.join(str(part) for part in parts))
+
+
+def page_number(request):
+    """ Returning the requested page number as the paginators will understand it, so that junk values do not make
+    new cache entries
+    """
+    page = request.GET.get('page', '')
+    return page if page.isdigit() else '1'
+
+
+def cached_catalog_data(request, parts, compute):
+    """ Returning the catalog data computed by `compute`, from the cache when possible. It is computed from the
+    primary, which the generation of the key never runs ahead of.
+    """
+    key = catalog_cache_key(request, 'data', *parts)
+    data = cache.get(key)
+    if data is None:
+        with primary():
+            data = compute()
+        cache.set(key, data, settings.CATALOG_CACHE_TIMEOUT)
+    return data
+
+
+def cache_anonymous_page(view_name, variant=None):
+    """ Decorator for the `get` method of catalog views. The whole page is cached for anonymous visitors, keyed by
+    the view arguments, the page number and the `variant` of the request when given, such as its ordering. Logged
+    in users get a page rendered for them, with their save buttons and CSRF tokens, so it is never cached. The
+    cached pages are rendered from the primary.
+    """
+    def decorator(get):
+        @wraps(get)
+        def wrapper(self, request, *args, **kwargs):
+            if request.user.is_authenticated:
+                return get(self, request, *args, **kwargs)
+            key = catalog_cache_key(request, 'page', view_name, *args,
+                                    *[value for name, value in sorted(kwargs.items())], page_number(request),
+                                    *([variant(request)] if variant else []))
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type, status = cached
+                return HttpResponse(content, content_type=content_type, status=status)
+            with primary():
+                response = get(self, request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, (response.content, response['Content-Type'], response.status_code),
+                          settings.CATALOG_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,189 @@
+import json
+
+from django.apps import apps
+from django.contrib.postgres.search import SearchVectorField
+from django.core import serializers
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+from pur_beurre.ingestion import legacy_barcode
+from pur_beurre.models import Categories, Product, SavedProduct
+
+BULK_APP = 'pur_beurre'
+DUMPED_MODELS = (Categories, Product, SavedProduct)
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """ Yielding the items of a JSON array one at a time, reading the stream by chunks instead of at once
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                if buffer[position:].strip():
+                    raise
+                return
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        position = end
+        yield item
+
+
+def model_fields(model, record):
+    """ Splitting the fields of a fixture record into the model's attributes and its many to many values
+    """
+    values = {'pk': record['pk']}
+    relations = {}
+    for name, value in record['fields'].items():
+        field = model._meta.get_field(name)
+        if field.many_to_many:
+            relations[field] = value
+        elif field.remote_field:
+            values[field.attname] = value
+        else:
+            values[field.attname] = field.to_python(value)
+    return values, relations
+
+
+class FixtureLoader:
+    """ Loading a fixture written by dumpdata or dump_catalog. The records of the catalog models are grouped by
+    model and inserted `batch_size` at a time with bulk queries, their many to many relations through the through
+    tables. Records of other applications (content types, permissions) go through Django's deserializer.
+    """
+    def __init__(self, batch_size=2000):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.order = []
+        self.loaded = {}
+        self.barcodes = set()
+        self.legacy_barcodes = set()
+
+    def load(self, stream):
+        for record in iter_json_array(stream):
+            model = apps.get_model(record['model'])
+            if model._meta.app_label == BULK_APP:
+                self.add(model, record)
+            else:
+                for obj in serializers.deserialize('python', [record]):
+                    obj.save()
+                self.count(model)
+        self.flush()
+        self.reset_sequences()
+        return self.loaded
+
+    def add(self, model, record):
+        values, relations = model_fields(model, record)
+        if model is Product:
+            self.fill_barcode(values)
+        if model not in self.pending:
+            self.pending[model] = []
+            self.order.append(model)
+        self.pending[model].append(model(**values))
+        for field, targets in relations.items():
+            through = field.remote_field.through
+            if through not in self.pending:
+                self.pending[through] = []
+                self.order.append(through)
+            self.pending[through].extend(
+                through(**{field.m2m_column_name(): values['pk'], field.m2m_reverse_name(): target})
+                for target in targets)
+        if len(self.pending[model]) >= self.batch_size:
+            self.flush()
+
+    def fill_barcode(self, values):
+        """ Giving a product of a fixture written before barcodes had their own field its legacy barcode, unless
+        another product of the fixture holds it: the duplicates are left to dedupe_catalog
+        """
+        if values.get('barcode') is None:
+            code = legacy_barcode(values.get('description'), values.get('itemcode'))
+            if code is not None and code not in self.barcodes:
+                values['barcode'] = code
+                self.legacy_barcodes.add(code)
+        if values.get('barcode') is not None:
+            self.barcodes.add(values['barcode'])
+
+    def flush(self):
+        """ Inserting the buffered records, in the order their models appeared so relations follow their rows. A
+        legacy barcode already held in the database is dropped rather than the product.
+        """
+        for model in self.order:
+            rows = self.pending[model]
+            if model is Product:
+                legacy = [row.barcode for row in rows if row.barcode in self.legacy_barcodes]
+                taken = set(Product.objects.filter(barcode__in=legacy).values_list('barcode', flat=True))
+                for row in rows:
+                    if row.barcode in taken:
+                        row.barcode = None
+            if rows:
+                model.objects.bulk_create(rows, ignore_conflicts=True)
+                self.count(model, len(rows))
+                self.pending[model] = []
+
+    def count(self, model, amount=1):
+        self.loaded[model._meta.label] = self.loaded.get(model._meta.label, 0) + amount
+
+    def reset_sequences(self):
+        models = [model for model in self.order if model._meta.auto_created is False]
+        with connection.cursor() as cursor:
+            for statement in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(statement)
+
+
+def dump_catalog(stream, models=DUMPED_MODELS, chunk_size=2000):
+    """ Writing the catalog in the dumpdata fixture format, record by record. The rows are read with a database
+    cursor and the many to many values fetched once per chunk of rows. Returning the number of records written.
+    """
+    written = 0
+    stream.write('[')
+    for model in models:
+        fields = [field for field in model._meta.concrete_fields
+                  if not field.primary_key and not isinstance(field, SearchVectorField)]
+        relations = model._meta.many_to_many
+        rows = model.objects.order_by('pk').values_list('pk', *[field.attname for field in fields])
+        chunk = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                written = write_records(stream, model, fields, relations, chunk, written)
+                chunk = []
+        written = write_records(stream, model, fields, relations, chunk, written)
+    stream.write(']\n')
+    return written
+
+
+def write_records(stream, model, fields, relations, rows, written):
+    if not rows:
+        return written
+    related = {}
+    for field in relations:
+        through = field.remote_field.through
+        source, target = field.m2m_column_name(), field.m2m_reverse_name()
+        values = {}
+        for pk, target_pk in through.objects.filter(**{source + '__in': [row[0] for row in rows]}).order_by(
+                source, target).values_list(source, target):
+            values.setdefault(pk, []).append(target_pk)
+        related[field.name] = values
+
+    for row in rows:
+        record_fields = {field.name: value for field, value in zip(fields, row[1:])}
+        for name, values in related.items():
+            record_fields[name] = values.get(row[0], [])
+        record = {'model': model._meta.label_lower, 'pk': row[0], 'fields': record_fields}
+        if written:
+            stream.write(', ')
+        stream.write(json.dumps(record, cls=DjangoJSONEncoder))
+        written += 1
+    return written
@@ -0,0 +1,82 @@
+"""Streaming exports, as CSV or JSON lines.
+
+The rows are read with a database cursor, `chunk_size` at a time, and every line is sent as soon as it is written:
+whatever the number of rows, the memory used stays that of one chunk, and a CSV export sends its header before
+the first query runs. The categories of the catalog are read once per chunk of products.
+"""
+import csv
+import json
+
+from pur_beurre.api import PRODUCT_FIELDS
+from pur_beurre.models import Product, SavedProduct
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+}
+EXPORTED_FIELDS = ('id', 'name', 'brand', 'nutriscore', 'barcode', 'url', 'ingredients', 'image')
+CATALOG_FIELDS = EXPORTED_FIELDS + ('categories',)
+CATEGORY_SEPARATOR = '|'
+
+
+class Echo:
+    """ File-like object handing back what the CSV writer writes, to be yielded
+    """
+    def write(self, value):
+        return value
+
+
+def chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def favorite_rows(user, chunk_size=2000):
+    """ Yielding the products saved by a user, as dicts keyed by their API names, in the order they were saved
+    """
+    columns = ['saved_product__' + PRODUCT_FIELDS[name] for name in EXPORTED_FIELDS]
+    rows = SavedProduct.objects.filter(saved_by=user).order_by('id').values_list(*columns)
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(EXPORTED_FIELDS, row))
+
+
+def catalog_rows(chunk_size=2000):
+    """ Yielding every product with the names of its categories, by ascending id
+    """
+    columns = [PRODUCT_FIELDS[name] for name in EXPORTED_FIELDS]
+    through = Product.categories.through
+    rows = Product.objects.order_by('id').values_list(*columns)
+    for chunk in chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+        categories = {}
+        for product_id, name in through.objects.filter(product_id__in=[row[0] for row in chunk]).order_by(
+                'product_id', 'categories__name').values_list('product_id', 'categories__name'):
+            categories.setdefault(product_id, []).append(name)
+        for row in chunk:
+            yield dict(zip(EXPORTED_FIELDS, row), categories=categories.get(row[0], []))
+
+
+def csv_lines(rows, fields):
+    """ Yielding the header and then the rows as CSV lines, lists being joined by CATEGORY_SEPARATOR
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([CATEGORY_SEPARATOR.join(row[name]) if isinstance(row[name], list) else row[name]
+                               for name in fields])
+
+
+def jsonl_lines(rows, fields):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def export_lines(rows, fields, format):
+    if format == 'csv':
+        return csv_lines(rows, fields)
+    return jsonl_lines(rows, fields)
@@ -0,0 +1,38 @@
+from django.db import connection
+
+from pur_beurre.models import Product, SavedProduct
+from pur_beurre.popularity import save_counts
+
+
+def save_favorites(user_id, product_ids):
+    """ Saving products as favorites of a user in a single INSERT ... SELECT ... ON CONFLICT DO NOTHING: unknown
+    products and products saved already are skipped by the database, without reading anything first. Returning
+    the number of newly saved products.
+    """
+    if not product_ids:
+        return 0
+    quote = connection.ops.quote_name
+    sql = ('INSERT INTO {0} ({1}, {2}) SELECT %s, {3} FROM {4} WHERE {3} IN ({5}) ON CONFLICT DO NOTHING '
+           'RETURNING {2}'.format(quote(SavedProduct._meta.db_table), quote('saved_by_id'), quote('saved_product_id'),
+                                  quote('id'), quote(Product._meta.db_table), ', '.join(['%s'] * len(product_ids))))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user_id] + list(product_ids))
+        saved = [row[0] for row in cursor.fetchall()]
+    save_counts.add(saved, 1)
+    return len(saved)
+
+
+def remove_favorites(user_id, product_ids):
+    """ Removing products from the favorites of a user in a single DELETE. Returning the number of removed ones.
+    """
+    if not product_ids:
+        return 0
+    quote = connection.ops.quote_name
+    sql = 'DELETE FROM {0} WHERE {1} = %s AND {2} IN ({3}) RETURNING {2}'.format(
+        quote(SavedProduct._meta.db_table), quote('saved_by_id'), quote('saved_product_id'),
+        ', '.join(['%s'] * len(product_ids)))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user_id] + list(product_ids))
+        removed = [row[0] for row in cursor.fetchall()]
+    save_counts.add(removed, -1)
+    return len(removed)
@@ -1,4 +1,5 @@
 from django import forms
+from django.urls import reverse_lazy
 from .models import Categories
 
 
@@ -14,5 +15,8 @@ class FoodRequestForm(forms.Form):
                                attrs={'class': 'form-control',
                                       'placeholder': 'Entrez votre produit ici',
                                       'aria-label': 'Produit',
-                                      'required': 'True'}
+                                      'required': 'True',
+                                      'autocomplete': 'off',
+                                      'list': 'food-suggestions',
+                                      'data-autocomplete': reverse_lazy('pur-beurre-autocomplete')}
                            ))
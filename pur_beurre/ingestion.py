@@ -0,0 +1,351 @@
+import re
+import unicodedata
+from string import punctuation, digits
+
+from django.db import transaction
+
+from pur_beurre.models import Categories, Product, SavedProduct
+
+SYNCED_FIELDS = ('name', 'brand', 'nutriscore', 'itemcode', 'description', 'image', 'openfoodfacts_link',
+                 'last_modified_t', 'is_active', 'thumbnail', 'thumbnail_missing', 'missing_since')
+
+OPENFOODFACTS_PRODUCT_URL = "https://fr.openfoodfacts.org/produit/"
+NUTRISCORES = ('a', 'b', 'c', 'd', 'e')
+UNKNOWN_NUTRISCORE = 'Z'
+
+LANGUAGE_PREFIX = re.compile(r'^[a-z]{2,3}:')
+BARCODE = re.compile(r'^\d{4,}$')
+
+
+def clean_text(text):
+    """ Removing punctuation and digits from an Open Food Facts string, title casing it and collapsing its
+    whitespace
+    """
+    for character in punctuation:
+        text = text.replace(character, '')
+    for character in digits:
+        text = text.replace(character, '')
+    return ' '.join(text.title().split())
+
+
+def category_key(text):
+    """ Returning the canonical key of a category name or Open Food Facts tag: without language prefix, accents,
+    case, spaces nor punctuation, so that "en:orange-juices", "Orange Juices" and "Orangejuices" share it
+    """
+    text = unicodedata.normalize('NFKD', LANGUAGE_PREFIX.sub('', text.strip().lower()))
+    return ''.join(character for character in text if character.isalpha())
+
+
+def tag_name(tag):
+    """ Turning an Open Food Facts tag into a category name, "en:orange-juices" gives "Orange Juices"
+    """
+    return clean_text(LANGUAGE_PREFIX.sub('', tag.strip()).replace('-', ' '))
+
+
+def legacy_barcode(description, itemcode):
+    """ Returning the barcode of a product imported before barcodes had their own field: the description holds it,
+    else the tail of the product page url in itemcode. None when neither looks like one.
+    """
+    code = (description or '').strip()
+    if not BARCODE.match(code):
+        code = (itemcode or '').rstrip('/').rsplit('/', 1)[-1]
+    return code if BARCODE.match(code) else None
+
+
+def modification_time(food):
+    """ Returning the time of the last upstream change of a product, as a Unix timestamp, None when unknown
+    """
+    try:
+        return int(food.get("last_modified_t"))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_nutriscore(grade):
+    """ Returning the upper case nutriscore of an Open Food Facts grade, "Z" for anything else than a to e, such
+    as "unknown" or "not-applicable"
+    """
+    grade = (grade or '').strip().lower()
+    return grade.upper() if grade in NUTRISCORES else UNKNOWN_NUTRISCORE
+
+
+def parse_food(food):
+    """ Turning an Open Food Facts product into the Product fields and its cleaned category names. The fields
+    follow the layout of the existing catalog: the barcode is kept in `description`, the product page url in
+    `itemcode` and the ingredients in `openfoodfacts_link`. Returning None for products without name or barcode.
+    """
+    code = food.get("code")
+    name = clean_text(food.get("product_name") or '')
+    if not code or not name:
+        return None
+    fields = {
+        'name': name,
+        'brand': clean_text(food.get("brands") or '').split(',')[0],
+        'itemcode': OPENFOODFACTS_PRODUCT_URL + code,
+        'description': code,
+        'openfoodfacts_link': food.get("ingredients_text") or '',
+        'barcode': code,
+        'last_modified_t': modification_time(food),
+    }
+    fields['nutriscore'] = parse_nutriscore(food.get("nutrition_grades"))
+    image = food.get("image_url")
+    if image and len(image) <= Product._meta.get_field('image').max_length:
+        fields['image'] = image
+    for field, value in fields.items():
+        max_length = Product._meta.get_field(field).max_length
+        if max_length and value:
+            fields[field] = value[:max_length]
+
+    max_length = Categories._meta.get_field('name').max_length
+    names = [clean_text(category) for category in (food.get("categories") or '').split(',')]
+    if not any(names):
+        tags = food.get("categories_tags") or []
+        names = [tag_name(tag) for tag in (tags.split(',') if isinstance(tags, str) else tags)]
+    categories = {}
+    for name in names:
+        if category_key(name):
+            categories.setdefault(category_key(name), name[:max_length])
+    return fields, list(categories.values())
+
+
+class BulkProductWriter:
+    """ Batched writer for products and their categories. Products are buffered and written `batch_size` at a time,
+    each batch in one transaction: the missing categories, the new products and the product-category rows are
+    each inserted with a single bulk query. Category ids are kept in memory for the whole import by canonical key,
+    the names and Open Food Facts ids of the known categories both leading to their row, so that spelling and
+    locale variants of a category are linked to it rather than created again. Products already in the database
+    (same barcode) are not inserted twice, and the barcodes written by the import are kept in a hash index unless
+    `merge_duplicates` is False: a product met again, as when it is listed by several categories, is merged into
+    the first one without any query and counted in `duplicates`. The ids of the written products are kept in
+    `product_ids` unless `track_ids` is False, for imports too large to remember them.
+
+    With `upsert`, the products already in the database are updated when upstream changed them since their last
+    import (a newer `last_modified_t`) and left untouched otherwise, without any write. Their categories are then
+    replaced rather than extended. The ids of the created, updated or reactivated products are kept in
+    `changed_ids`, and every barcode seen in `seen_barcodes` when `track_seen` is set.
+    """
+    def __init__(self, batch_size=500, track_ids=True, upsert=False, track_seen=False, merge_duplicates=True):
+        self.batch_size = batch_size
+        self.track_ids = track_ids
+        self.upsert = upsert
+        self.track_seen = track_seen
+        self.merge_duplicates = merge_duplicates
+        self.pending = []
+        self.category_ids = category_index()
+        self.known = {}
+        self.product_ids = set()
+        self.changed_ids = set()
+        self.seen_barcodes = set()
+        self.written = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.duplicates = 0
+
+    def add(self, fields, categories):
+        self.pending.append((fields, categories))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Writing the buffered products to the database
+        """
+        if not self.pending:
+            return
+        products = {}
+        for fields, categories in self.pending:
+            known = products.get(fields['barcode'])
+            if known is None or (fields['last_modified_t'] or 0) >= (known[0]['last_modified_t'] or 0):
+                products[fields['barcode']] = (fields, categories)
+        self.duplicates += len(self.pending) - len(products)
+        self.pending = []
+        if self.merge_duplicates:
+            merged = [barcode for barcode, (fields, categories) in products.items() if barcode in self.known and
+                      (not self.upsert or (fields['last_modified_t'] or 0) <= self.known[barcode])]
+            for barcode in merged:
+                del products[barcode]
+            self.duplicates += len(merged)
+            if not products:
+                return
+
+        with transaction.atomic():
+            self.save_categories({name for fields, categories in products.values() for name in categories})
+            product_ids, changed = self.save_products([fields for fields, categories in products.values()])
+
+            through = Product.categories.through
+            if self.upsert:
+                products = {barcode: products[barcode] for barcode in changed}
+                through.objects.filter(product_id__in=[product_ids[barcode] for barcode in changed]).delete()
+            links = {(product_ids[barcode], self.category_ids[category_key(name)])
+                     for barcode, (fields, categories) in products.items()
+                     for name in categories}
+            through.objects.bulk_create([through(product_id=product_id, categories_id=category_id)
+                                         for product_id, category_id in sorted(links)], ignore_conflicts=True)
+
+        if self.track_ids:
+            self.product_ids.update(product_ids.values())
+        if self.track_seen:
+            self.seen_barcodes.update(product_ids)
+        if self.merge_duplicates:
+            self.known.update((barcode, fields['last_modified_t'] or 0) for barcode, (fields, categories) in
+                              products.items())
+        self.changed_ids.update(product_ids[barcode] for barcode in changed)
+        self.written += len(product_ids)
+
+    def save_categories(self, names):
+        """ Inserting the categories whose canonical key is unknown, once per key, and caching their ids
+        """
+        missing = {}
+        for name in names:
+            if category_key(name) not in self.category_ids:
+                missing.setdefault(category_key(name), name)
+        if not missing:
+            return
+        Categories.objects.bulk_create([Categories(name=name) for name in missing.values()], ignore_conflicts=True)
+        self.category_ids.update((category_key(name), category_id) for name, category_id in
+                                 Categories.objects.filter(name__in=list(missing.values())).values_list('name', 'id'))
+
+    def save_products(self, products):
+        """ Inserting the products that are not in the database yet, and updating the changed ones when upserting.
+        Returning the ids of all of them by barcode, and the barcodes of the created and updated ones.
+        """
+        barcodes = [fields['barcode'] for fields in products]
+        existing = {barcode: (product_id, modified, active) for barcode, product_id, modified, active in
+                    Product.objects.filter(barcode__in=barcodes).values_list(
+                        'barcode', 'id', 'last_modified_t', 'is_active')}
+        Product.objects.bulk_create([Product(**fields) for fields in products if fields['barcode'] not in existing])
+        changed = {fields['barcode'] for fields in products if fields['barcode'] not in existing}
+        self.created += len(changed)
+
+        if self.upsert:
+            updates = []
+            for fields in products:
+                if fields['barcode'] not in existing:
+                    continue
+                product_id, modified, active = existing[fields['barcode']]
+                if active and modified is not None and (fields['last_modified_t'] or 0) <= modified:
+                    self.unchanged += 1
+                    continue
+                updates.append(Product(id=product_id, is_active=True, thumbnail=None, thumbnail_missing=False,
+                                       missing_since=None, **fields))
+                changed.add(fields['barcode'])
+            Product.objects.bulk_update(updates, SYNCED_FIELDS)
+            self.updated += len(updates)
+        else:
+            self.unchanged += len(existing)
+
+        product_ids = {barcode: existing[barcode][0] for barcode in existing}
+        if len(product_ids) < len(barcodes):
+            product_ids.update(Product.objects.filter(barcode__in=list(changed - set(product_ids)))
+                               .values_list('barcode', 'id'))
+        return product_ids, changed
+
+
+def deactivate_missing(seen_barcodes, batch_size=500, sync=None):
+    """ Soft deleting the active products whose barcode was not seen by a complete sync, the products without a
+    barcode being left alone, and recording the number of that sync in their `missing_since`. Returning the ids of
+    the deactivated products.
+    """
+    missing = [product_id for product_id, barcode in Product.objects.filter(
+        is_active=True, barcode__isnull=False).values_list('id', 'barcode').iterator()
+               if barcode not in seen_barcodes]
+    for start in range(0, len(missing), batch_size):
+        Product.objects.filter(id__in=missing[start:start + batch_size]).update(is_active=False, missing_since=sync)
+    return missing
+
+
+def category_index():
+    """ Returning the ids of the categories by canonical key, of their name and of their Open Food Facts id. A key
+    shared by several categories leads to the one having an Open Food Facts id, else to the oldest.
+    """
+    index = {}
+    for category_id, name, off_id in Categories.objects.order_by('-id').values_list('id', 'name', 'off_id'):
+        index[category_key(name)] = category_id
+    for category_id, name, off_id in Categories.objects.exclude(off_id='').order_by('-id').values_list(
+            'id', 'name', 'off_id'):
+        index[category_key(name)] = category_id
+        index[category_key(off_id)] = category_id
+    index.pop('', None)
+    return index
+
+
+def duplicate_categories():
+    """ Returning, for every category that shares a canonical key with another one, the id of the category it
+    should be merged into: the one having an Open Food Facts id, else the oldest
+    """
+    canonical = {}
+    duplicates = {}
+    rows = sorted(Categories.objects.values_list('id', 'name', 'off_id'),
+                  key=lambda row: (not row[2], row[0]))
+    for category_id, name, off_id in rows:
+        keys = [key for key in (category_key(name), category_key(off_id or '')) if key]
+        target = next((canonical[key] for key in keys if key in canonical), category_id)
+        for key in keys:
+            canonical.setdefault(key, target)
+        if target != category_id:
+            duplicates[category_id] = target
+    return duplicates
+
+
+def duplicate_products():
+    """ Returning, for every product without barcode whose legacy barcode is the one of another product, the id
+    of the product it should be merged into: the one holding the barcode, else the oldest
+    """
+    owners = dict(Product.objects.filter(barcode__isnull=False).values_list('barcode', 'id'))
+    duplicates = {}
+    for product_id, description, itemcode in Product.objects.filter(barcode__isnull=True).order_by('id') \
+            .values_list('id', 'description', 'itemcode').iterator():
+        code = legacy_barcode(description, itemcode)
+        if code is None:
+            continue
+        target = owners.setdefault(code, product_id)
+        if target != product_id:
+            duplicates[product_id] = target
+    return duplicates
+
+
+def merge_categories(duplicates):
+    """ Moving the products of the duplicate categories to the category they are merged into, and deleting them.
+    Returning the ids of the moved products.
+    """
+    through = Product.categories.through
+    links = list(through.objects.filter(categories_id__in=list(duplicates)).values_list('product_id', 'categories_id'))
+    with transaction.atomic():
+        through.objects.bulk_create([through(product_id=product_id, categories_id=duplicates[category_id])
+                                     for product_id, category_id in links], ignore_conflicts=True)
+        Categories.objects.filter(id__in=list(duplicates)).delete()
+    return {product_id for product_id, category_id in links}
+
+
+def merge_products(duplicates):
+    """ Moving the favorites and categories of the duplicate products to the product they are merged into, and
+    deleting them, then giving their legacy barcode to the products left without one. Returning the number of
+    barcodes given.
+    """
+    through = Product.categories.through
+    saved = SavedProduct.objects.filter(saved_product_id__in=list(duplicates)).values_list(
+        'saved_by_id', 'saved_product_id')
+    links = through.objects.filter(product_id__in=list(duplicates)).values_list('product_id', 'categories_id')
+    with transaction.atomic():
+        SavedProduct.objects.bulk_create([SavedProduct(saved_by_id=user_id, saved_product_id=duplicates[product_id])
+                                          for user_id, product_id in saved], ignore_conflicts=True)
+        through.objects.bulk_create([through(product_id=duplicates[product_id], categories_id=category_id)
+                                     for product_id, category_id in links], ignore_conflicts=True)
+        Product.objects.filter(id__in=list(duplicates)).delete()
+    return fill_legacy_barcodes()
+
+
+def fill_legacy_barcodes(batch_size=500):
+    """ Giving their legacy barcode to the products without barcode, the oldest first, unless another product
+    holds it already. Returning the number of barcodes given.
+    """
+    owners = set(Product.objects.filter(barcode__isnull=False).values_list('barcode', flat=True))
+    updates = []
+    for product_id, description, itemcode in Product.objects.filter(barcode__isnull=True).order_by('id') \
+            .values_list('id', 'description', 'itemcode').iterator():
+        code = legacy_barcode(description, itemcode)
+        if code is not None and code not in owners:
+            owners.add(code)
+            updates.append(Product(id=product_id, barcode=code))
+    Product.objects.bulk_update(updates, ['barcode'], batch_size=batch_size)
+    return len(updates)
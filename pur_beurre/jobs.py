@@ -0,0 +1,136 @@
+"""Checkpointed ingestion jobs.
+
+An import of the catalog is recorded as an IngestionJob, with one IngestionCategory row per category to fetch.
+The pages of a category are fetched concurrently and in any order, so the checkpoint is the category: once every
+one of its pages was read and its products written, it is marked done, and a resumed job only fetches the
+categories which are not. Those interrupted midway are fetched again from their first page, their products being
+upserted or merged by barcode rather than written twice.
+
+Every invocation may be given a budget, in seconds or in products read. It is checked after every page: once it
+is spent the job stops, writes what it read and is left paused, to be resumed by the next invocation.
+"""
+import time
+
+from django.utils import timezone
+
+from pur_beurre.models import Categories, IngestionCategory, IngestionJob
+from pur_beurre.ingestion import modification_time
+
+REPORT_INTERVAL = 10
+
+
+def start_job(source='openfoodfacts', sync=False, full=False):
+    """ Creating a job to fetch every category having an Open Food Facts id
+    """
+    job = IngestionJob.objects.create(source=source, sync=sync, full=full)
+    IngestionCategory.objects.bulk_create([IngestionCategory(job=job, category_id=category_id) for category_id in
+                                           Categories.objects.exclude(off_id='').values_list('id', flat=True)])
+    return job
+
+
+def resumable_job(source='openfoodfacts'):
+    """ Returning the most recent job of the source which did not finish, if any
+    """
+    return IngestionJob.objects.filter(source=source).exclude(status=IngestionJob.DONE).order_by('-id').first()
+
+
+class JobRun:
+    """ One invocation of a job: recording the pages read, checkpointing the finished categories and keeping to the
+    budget. `report` is called with a progress line every REPORT_INTERVAL seconds.
+    """
+    def __init__(self, job, fetcher, max_seconds=None, max_rows=None, report=None):
+        self.job = job
+        self.fetcher = fetcher
+        self.max_seconds = max_seconds
+        self.max_rows = max_rows
+        self.report = report
+        self.start = self.reported = time.monotonic()
+        self.rows = 0
+        self.tasks = {}
+        self.pending = {}
+        self.finished = 0
+
+        job.status = IngestionJob.RUNNING
+        job.invocations += 1
+        job.save(update_fields=['status', 'invocations', 'updated_at'])
+
+    @property
+    def resumed(self):
+        return self.job.invocations > 1
+
+    def categories(self):
+        """ Returning the categories left to fetch, their progress starting over
+        """
+        tasks = list(self.job.categories.exclude(status=IngestionCategory.DONE).select_related('category'))
+        for task in tasks:
+            task.status, task.pages, task.rows, task.started_at = IngestionCategory.PENDING, 0, 0, None
+            self.tasks[task.category_id] = task
+            self.pending[task.category_id] = 1
+        return [task.category for task in tasks]
+
+    def record(self, page):
+        """ Recording a fetched page. Returning whether it was the last one of its category, which has to be
+        written before `checkpoint` is called.
+        """
+        task = self.tasks[page.category.id]
+        task.started_at = task.started_at or timezone.now()
+        task.pages += 1
+        task.rows += len(page.products)
+        self.rows += len(page.products)
+        self.pending[task.category_id] -= 1
+        if page.error:
+            task.status = IngestionCategory.FAILED
+            task.errors += 1
+            task.last_error = self.job.last_error = str(page.error)
+            self.job.errors += 1
+        else:
+            self.pending[task.category_id] += len(self.fetcher.next_pages(page))
+            self.job.watermark = max([self.job.watermark] + [modification_time(food) or 0 for food in page.products])
+        if self.report and time.monotonic() - self.reported >= REPORT_INTERVAL:
+            self.reported = time.monotonic()
+            self.report(self.progress())
+        return self.pending[task.category_id] == 0
+
+    def checkpoint(self, category):
+        """ Marking a category whose every page was read and written as done, or failed if a page could not be
+        fetched
+        """
+        task = self.tasks.pop(category.id)
+        if task.status == IngestionCategory.PENDING:
+            task.status = IngestionCategory.DONE
+        task.finished_at = timezone.now()
+        task.save()
+        self.job.rows += task.rows
+        self.job.save(update_fields=['rows', 'errors', 'last_error', 'watermark', 'updated_at'])
+        self.finished += 1
+
+    def exhausted(self):
+        """ Telling whether the budget of the invocation is spent
+        """
+        return ((self.max_seconds is not None and time.monotonic() - self.start >= self.max_seconds) or
+                (self.max_rows is not None and self.rows >= self.max_rows))
+
+    def finish(self, error=None):
+        """ Recording the categories left unfinished and the outcome of the invocation: the job is done once every
+        category is, paused if the budget was spent, and failed otherwise, resuming it retrying the failed ones
+        """
+        for task in self.tasks.values():
+            if task.started_at:
+                task.save()
+        self.job.seconds += time.monotonic() - self.start
+        if error is not None:
+            self.job.last_error = str(error)
+        if error is None and not self.job.categories.exclude(status=IngestionCategory.DONE).exists():
+            self.job.status = IngestionJob.DONE
+            self.job.finished_at = timezone.now()
+        elif error is None and self.exhausted():
+            self.job.status = IngestionJob.PAUSED
+        else:
+            self.job.status = IngestionJob.FAILED
+        self.job.save()
+
+    def progress(self):
+        elapsed = time.monotonic() - self.start
+        return "{0} produits lus en {1:.0f} s ({2:.1f} produits/s), {3} catégories terminées sur {4}".format(
+            self.rows, elapsed, self.rows / elapsed if elapsed else 0, self.finished,
+            self.finished + len(self.tasks))
@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from pur_beurre.benchmark import run_benchmark
+
+
+def parse_size(value):
+    try:
+        products, categories, users = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise CommandError("Taille invalide {0}, attendu produits:catégories:utilisateurs".format(value))
+    return products, categories, users
+
+
+class Command(BaseCommand):
+    help = ("Mesure les pages de recherche, de substitution, de produit et de favoris sur des catalogues "
+            "synthétiques, dans une base de test créée pour l'occasion")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', action='append', type=parse_size, dest='sizes',
+                            help="Taille du catalogue, produits:catégories:utilisateurs (plusieurs possibles)")
+        parser.add_argument('--iterations', type=int, default=50, help="Nombre de requêtes par scénario")
+        parser.add_argument('--seed', type=int, default=0, help="Graine du générateur de catalogue")
+        parser.add_argument('--warm-cache', action='store_true',
+                            help="Garder le cache entre les requêtes au lieu de le vider")
+        parser.add_argument('-o', '--output', help="Fichier du rapport JSON, la sortie standard par défaut")
+
+    def handle(self, *args, **options):
+        """ Running the benchmark in a throwaway test database and writing its JSON report
+                """
+        sizes = options['sizes'] or [(1000, 100, 20), (10000, 500, 100)]
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmark(sizes, options['iterations'], options['seed'], options['warm_cache'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf8') as report_file:
+                report_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
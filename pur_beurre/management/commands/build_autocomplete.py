@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'index des suggestions de la barre de recherche"
+
+    def handle(self, *args, **options):
+        """ Building the prefix index from the catalog and publishing it to the workers
+                """
+        index = rebuild_autocomplete_index()
+        self.stdout.write("{0} suggestions indexées".format(len(index)))
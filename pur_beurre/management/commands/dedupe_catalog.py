@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.ingestion import duplicate_categories, duplicate_products, merge_categories, merge_products
+from pur_beurre.popularity import reconcile_save_counts
+from pur_beurre.substitutes import refresh_substitutes
+
+
+class Command(BaseCommand):
+    help = ("Fusionne les catégories en double (mêmes noms aux accents, espaces ou préfixe de langue près) et les "
+            "produits importés plusieurs fois sous le même code-barres")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Compter les doublons sans rien modifier")
+
+    def handle(self, *args, **options):
+        """ Merging the duplicates left by the imports made before the ingestion deduplicated them, and giving
+        their barcode to the products which only had it in their legacy fields
+                """
+        categories = duplicate_categories()
+        products = duplicate_products()
+        self.stdout.write("{0} catégories et {1} produits en double".format(len(categories), len(products)))
+        if options['dry_run']:
+            return
+
+        changed = set(products.values())
+        if categories:
+            changed.update(merge_categories(categories))
+        filled = merge_products(products)
+        self.stdout.write("{0} codes-barres renseignés".format(filled))
+        if products:
+            reconcile_save_counts()
+        if not (categories or products):
+            return
+        self.stdout.write("Calcul des produits de substitution")
+        refresh_substitutes(changed)
+        rebuild_autocomplete_index()
+        bump_catalog_generation()
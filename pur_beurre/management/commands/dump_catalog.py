@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.catalog_fixture import dump_catalog
+
+
+class Command(BaseCommand):
+    help = "Exporte le catalogue au format de dumpdata, objet par objet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output', help="Fichier de sortie, la sortie standard par défaut")
+
+    def handle(self, *args, **options):
+        """ Writing the categories, products and saved products as a fixture
+                """
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf8') as output:
+                written = dump_catalog(output)
+            self.stderr.write("{0} objets exportés".format(written))
+        else:
+            dump_catalog(self.stdout)
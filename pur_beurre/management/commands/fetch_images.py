@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.models import Product
+from pur_beurre.thumbnails import ThumbnailStore, evict_thumbnails, fetch_thumbnails, forget_missing_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Télécharge les images des produits et en fait les miniatures servies par le site"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Retenter les images qui n'avaient pas pu être téléchargées")
+        parser.add_argument('--all', action='store_true',
+                            help="Refaire les miniatures de tous les produits")
+        parser.add_argument('--limit', type=int, help="Nombre maximum de produits traités")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Nombre de téléchargements simultanés")
+        parser.add_argument('--evict-only', action='store_true',
+                            help="Seulement ramener le dossier des miniatures sous sa taille maximale")
+
+    def handle(self, *args, **options):
+        """ Fetching the images of the products without thumbnails, or whose thumbnails are missing from this
+        server or were found missing by a request, in batches
+                """
+        store = ThumbnailStore()
+        if options['evict_only']:
+            self.stdout.write("{0} images n'ont plus de miniatures".format(evict_thumbnails(store)))
+            return
+
+        if not options['all']:
+            self.stdout.write("{0} miniatures manquantes".format(forget_missing_thumbnails(store)))
+
+        products = Product.objects.filter(is_active=True).order_by('id')
+        if options['retry_failed']:
+            products = products.filter(Q(thumbnail__isnull=True) | Q(thumbnail='') | Q(thumbnail_missing=True))
+        elif not options['all']:
+            products = products.filter(Q(thumbnail__isnull=True) | Q(thumbnail_missing=True))
+        if options['limit']:
+            products = products[:options['limit']]
+        stored, failed = fetch_thumbnails(products, store=store, workers=options['workers'])
+        self.stdout.write("{0} images enregistrées, {1} en échec".format(stored, failed))
+        if stored:
+            bump_catalog_generation()
@@ -1,13 +1,52 @@
 import requests
-from pur_beurre.models import Categories, Product
+from pur_beurre.models import Categories, Product, SyncState
 from pur_beurre.forms import CategoriesForm
-from string import punctuation, digits
-from django.core.management.base import BaseCommand
-from django.core.exceptions import ValidationError
-from django.db.utils import IntegrityError, DataError
+from pur_beurre.ingestion import (BulkProductWriter, category_index, category_key, clean_text, deactivate_missing,
+                                  parse_food)
+from pur_beurre.openfoodfacts import OpenFoodFactsFetcher, SEARCH_URL
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.substitutes import refresh_substitutes
+from pur_beurre.thumbnails import fetch_thumbnails, forget_missing_thumbnails
+from pur_beurre.jobs import JobRun, resumable_job, start_job
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Nombre de produits écrits par transaction")
+        parser.add_argument('--row-by-row', action='store_true',
+                            help="Enregistrer les produits un par un, chacun dans sa propre transaction")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Nombre de requêtes simultanées vers Open Food Facts")
+        parser.add_argument('--page-size', type=int, default=100,
+                            help="Nombre de produits par page de résultats")
+        parser.add_argument('--max-pages', type=int, default=10,
+                            help="Nombre maximum de pages par catégorie (0 pour toutes)")
+        parser.add_argument('--rate', type=float, default=5.0,
+                            help="Nombre maximum de requêtes par seconde")
+        parser.add_argument('--search-url', default=SEARCH_URL,
+                            help="Adresse de l'API de recherche d'Open Food Facts")
+        parser.add_argument('--sync', action='store_true',
+                            help="Synchronisation incrémentale : ne demander que les produits modifiés depuis la "
+                                 "précédente, mettre à jour ceux qui ont changé et ignorer les autres")
+        parser.add_argument('--images', action='store_true',
+                            help="Télécharger ensuite les images des nouveaux produits et en faire les miniatures")
+        parser.add_argument('--full', action='store_true',
+                            help="Avec --sync, tout redemander et désactiver les produits disparus d'Open Food Facts "
+                                 "(si aucune page n'a échoué ni n'a été omise par --max-pages)")
+        parser.add_argument('--resume', action='store_true',
+                            help="Reprendre la dernière importation inachevée là où elle s'est arrêtée, avec ses "
+                                 "options --sync et --full")
+        parser.add_argument('--max-seconds', type=float,
+                            help="Interrompre l'importation après ce nombre de secondes, à reprendre avec --resume")
+        parser.add_argument('--max-rows', type=int,
+                            help="Interrompre l'importation après ce nombre de produits lus, à reprendre avec "
+                                 "--resume")
+
     def category_request_api(self):
         """ Getting a categories's json file from a specified request to OpenfoodFacts
         """
@@ -15,44 +54,128 @@ class Command(BaseCommand):
         request = requests.get(url)
         return request.json()
 
-    def food_request(self, category):
-        """ Getting a product's json file from a specified request to OpenfoodFacts
-                """
-        url = "https://fr.openfoodfacts.org/cgi/search.pl"
-        params = {"action": "process",
-                  "tagtype_0": "categories",
-                  "tag_contains_0": "contains",
-                  "tag_0": category.off_id,
-                  "page_size": 1000,
-                  "json": 1}
-
-        request = requests.get(url, params)
-
-        return request.json()
-
     def handle(self, *args, **options):
         """ Saving categories and products data into database
                 """
-        self.stdout.write("Obtention des catégories d'Openfood Facts")
-        categories_dict = self.category_request_api()
-        self.stdout.write("Sauvegarde des catégories dans la base de données")
-        self.save_cat_to_db(categories_dict)
-
-        cat_amount = 6
-
-        categories = Categories.objects.all()
-
-        for category in categories:
-            self.stdout.write("Récupération des aliments de la catégorie {0}".format(category.name))
-            food_request_dict = self.food_request(category)
-            self.stdout.write("Inscription dans la base de données des aliments de la catégorie {0}".format(category.name))
-            self.save_food_to_db(food_request_dict)
-            cat_amount -= 1
+        if options.get('resume'):
+            job = resumable_job()
+            if job is None:
+                raise CommandError("Aucune importation à reprendre")
+            self.stdout.write("Reprise de l'importation n°{0}".format(job.id))
+            sync, full = job.sync, job.full
+            state = SyncState.objects.get_or_create(source='openfoodfacts')[0] if sync else None
+        else:
+            self.stdout.write("Obtention des catégories d'Openfood Facts")
+            categories_dict = self.category_request_api()
+            self.stdout.write("Sauvegarde des catégories dans la base de données")
+            self.save_cat_to_db(categories_dict)
+
+            sync = options.get('sync', False)
+            state = SyncState.objects.get_or_create(source='openfoodfacts')[0] if sync else None
+            full = sync and (options.get('full', False) or not state.watermark)
+            job = start_job(sync=sync, full=full)
+        batch_size = 1 if options.get('row_by_row') else options.get('batch_size', 500)
+        writer = BulkProductWriter(batch_size, track_ids=not sync, upsert=sync, track_seen=full)
+        fetcher = OpenFoodFactsFetcher(search_url=options.get('search_url', SEARCH_URL),
+                                       workers=options.get('workers', 4),
+                                       page_size=options.get('page_size', 100),
+                                       max_pages=options.get('max_pages', 10),
+                                       rate=options.get('rate', 5.0),
+                                       newer_than=state.watermark if sync and not full else None)
+        run = JobRun(job, fetcher, options.get('max_seconds'), options.get('max_rows'), report=self.stdout.write)
+        truncated = False
+
+        self.stdout.write("Récupération des aliments des catégories")
+        pages = fetcher.fetch(run.categories())
+        try:
+            for page in pages:
+                if page.error:
+                    self.stderr.write("Échec de la récupération de la page {0} de la catégorie {1} : {2}".format(
+                        page.number, page.category.name, page.error))
+                else:
+                    truncated = truncated or self.truncated(page, fetcher)
+                    self.stdout.write("Inscription dans la base de données des aliments de la catégorie {0}, "
+                                      "page {1}".format(page.category.name, page.number))
+                    self.bulk_save_food_to_db({"products": page.products}, writer)
+                if run.record(page):
+                    writer.flush()
+                    run.checkpoint(page.category)
+                if run.exhausted():
+                    break
+        except BaseException as error:
+            pages.close()
+            run.finish(error)
+            raise
+        pages.close()
+        writer.flush()
+        run.finish()
+        self.stdout.write(run.progress())
+        if job.status == job.PAUSED:
+            self.stdout.write("Budget atteint : l'importation n°{0} reprendra avec --resume".format(job.id))
+        elif job.status == job.FAILED:
+            self.stderr.write("Importation n°{0} incomplète : --resume redemandera les catégories en échec".format(
+                job.id))
+
+        if sync:
+            self.finish_sync(state, writer, job, truncated, run.resumed)
+        else:
+            self.stdout.write("Calcul des produits de substitution")
+            refresh_substitutes()
+        if options.get('images'):
+            self.stdout.write("Téléchargement des images")
+            forget_missing_thumbnails()
+            products = Product.objects.filter(Q(thumbnail__isnull=True) | Q(thumbnail_missing=True), is_active=True)
+            stored, failed = fetch_thumbnails(products, workers=options.get('workers', 4))
+            self.stdout.write("{0} images enregistrées, {1} en échec".format(stored, failed))
+        rebuild_autocomplete_index()
+        bump_catalog_generation()
+
+    @staticmethod
+    def truncated(page, fetcher):
+        """ Telling whether --max-pages keeps a category from being fetched entirely after this page
+                """
+        if not fetcher.max_pages or page.count <= fetcher.max_pages * fetcher.page_size:
+            return False
+        if fetcher.newer_than is None:
+            return page.number == 1
+        return page.number == fetcher.max_pages and len(page.products) == fetcher.page_size
+
+    def finish_sync(self, state, writer, job, truncated, resumed):
+        """ Soft deleting the products gone upstream after a complete full sync, recording the new watermark and
+        refreshing the substitutes of the changed products only. A job left unfinished, by a failed page or its
+        budget, keeps the watermark where it was, so that the next sync asks for its products again, and so does an
+        incremental sync cut short by --max-pages. The products seen by a full sync are only known to the
+        invocation that saw them: one which was resumed deactivates nothing.
+                """
+        full = job.full
+        failed = job.status != job.DONE
+        deactivated = []
+        if full and not failed and not truncated and not resumed:
+            state.full_syncs += 1
+            deactivated = deactivate_missing(writer.seen_barcodes, sync=state.full_syncs)
+        elif full:
+            self.stderr.write("Synchronisation incomplète : aucun produit désactivé")
+        if failed or (truncated and not full):
+            self.stderr.write("Synchronisation incomplète : la prochaine reprendra depuis la même date")
+        else:
+            state.watermark = max(state.watermark, job.watermark)
+            if full:
+                state.last_full_sync = timezone.now()
+            state.save()
+        self.stdout.write("{0} produits créés, {1} mis à jour, {2} inchangés, {3} désactivés".format(
+            writer.created, writer.updated, writer.unchanged, len(deactivated)))
+
+        changed = writer.changed_ids.union(deactivated)
+        if changed:
+            self.stdout.write("Calcul des produits de substitution")
+            refresh_substitutes(changed)
 
     def save_cat_to_db(self, request_dict):
-        """ Saving categories data to database script.
+        """ Saving categories data to database script. A category already known under another spelling, such as
+        one created from the products, is completed with its Open Food Facts id rather than saved twice.
                 """
         categories_list = request_dict["tags"][:3]
+        index = category_index()
         for category in categories_list:
             name = self.request_cleaner(category["name"])
             url = category["url"]
@@ -60,78 +183,22 @@ class Command(BaseCommand):
             off_id = category["id"]
             form_dict = {'name':name, 'product_count': product_count, 'url': url, 'off_id': off_id}
 
-            entry = CategoriesForm(form_dict)
+            known = index.get(category_key(off_id)) or index.get(category_key(name))
+            instance = Categories.objects.filter(id=known).first() if known else None
+            entry = CategoriesForm(form_dict, instance=instance)
 
             if entry.is_valid():
                 entry.save()
 
-    def save_food_to_db(self, request_dict):
-        """ Saving products data to database script.
+    def bulk_save_food_to_db(self, request_dict, writer):
+        """ Saving products data to database by batches through a BulkProductWriter.
                         """
-        food_list = request_dict["products"]
-        for food in food_list:
-            openfoodfacts_link = "https://fr.openfoodfacts.org/produit/" + food['code']
-            try:
-                name = self.request_cleaner(food["product_name"])
-                brand = self.request_cleaner(food["brands"]).split(',')[0]
-                itemcode = food["code"]
-                description = food["ingredients_text"]
-            except KeyError:
-                pass
-            try:
-                image = food["image_url"]
-            except KeyError:
-                image = None
-            try:
-                nutriscore = self.request_cleaner(food["nutrition_grades"])
-            except KeyError:
-                nutriscore = "Z"
-
-            food_categories = food["categories"].split(',')
-
-            entry = self.add_to_db(name, brand, nutriscore, itemcode, description, openfoodfacts_link, image)
-
-            self.add_relationship(food_categories, entry)
-
-    def add_to_db(self, name, brand, nutriscore, description, openfoodfacts_link, itemcode, image):
-        """ Creating entries to database script.
-                        """
-        try:
-            entry = Product()
-            entry.name = name
-            entry.description = description
-            entry.brand = brand
-            entry.nutriscore = nutriscore
-            entry.openfoodfacts_link = openfoodfacts_link
-            entry.itemcode = itemcode
-            if image:
-                entry.image = image
-            entry.clean()
-            entry.save()
-            return entry
-        except (IntegrityError, DataError):
-            pass
-
-    def add_relationship(self, food_category, entry):
-        """ Building relationship for many to many relationship in Database script
-                        """
-        try:
-            for food_category in food_category:
-                food_category = self.request_cleaner(food_category)
-                category = Categories.objects.get_or_create(name=food_category)[0]
-                entry.categories.add(category)
-        except(ValidationError, AttributeError):
-            pass
+        for food in request_dict["products"]:
+            parsed = parse_food(food)
+            if parsed:
+                writer.add(*parsed)
 
     def request_cleaner(self, my_request):
         """ Cleaning request script
                         """
-        mr = my_request
-        for character in punctuation:
-            my_request = my_request.replace(character, '')
-        for character in digits:
-            my_request = my_request.replace(character, '')
-
-        my_request = my_request.title().strip()
-        return my_request
-
+        return clean_text(my_request)
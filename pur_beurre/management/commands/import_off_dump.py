@@ -0,0 +1,111 @@
+import csv
+import gzip
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pur_beurre.ingestion import NUTRISCORES, BulkProductWriter, parse_food
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.substitutes import refresh_substitutes
+
+
+class Command(BaseCommand):
+    help = "Importe les produits d'un export Open Food Facts (JSONL ou CSV, éventuellement compressé en gzip)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Chemin de l'export, par exemple openfoodfacts-products.jsonl.gz")
+        parser.add_argument('--format', choices=('jsonl', 'csv'),
+                            help="Format de l'export, déduit de l'extension du fichier par défaut")
+        parser.add_argument('--country', action='append', default=[],
+                            help="Ne garder que les produits vendus dans ce pays, par exemple en:france")
+        parser.add_argument('--category', action='append', default=[],
+                            help="Ne garder que les produits de cette catégorie, par exemple en:spreads")
+        parser.add_argument('--with-nutriscore', action='store_true',
+                            help="Ne garder que les produits ayant un nutriscore")
+        parser.add_argument('--limit', type=int, help="Nombre maximum de produits importés")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Nombre de produits écrits par transaction")
+        parser.add_argument('--skip-substitutes', action='store_true',
+                            help="Ne pas recalculer les produits de substitution")
+
+    def handle(self, *args, **options):
+        """ Streaming the dump record by record into batched database writes
+                """
+        path = options['path']
+        dump_format = options['format'] or self.guess_format(path)
+        records = self.read_jsonl(path) if dump_format == 'jsonl' else self.read_csv(path)
+        # A dump lists every product once: no need to remember the barcodes of millions of them
+        writer = BulkProductWriter(options['batch_size'], track_ids=False, merge_duplicates=False)
+        read = 0
+
+        for food in records:
+            read += 1
+            if not self.keep(food, options['country'], options['category'], options['with_nutriscore']):
+                continue
+            parsed = parse_food(food)
+            if parsed:
+                writer.add(*parsed)
+            if read % 100000 == 0:
+                self.stdout.write("{0} produits lus, {1} enregistrés".format(read, writer.written))
+            if options['limit'] and writer.written + len(writer.pending) >= options['limit']:
+                break
+        writer.flush()
+        self.stdout.write("{0} produits lus, {1} enregistrés".format(read, writer.written))
+
+        if not options['skip_substitutes']:
+            self.stdout.write("Calcul des produits de substitution")
+            refresh_substitutes()
+        rebuild_autocomplete_index()
+        bump_catalog_generation()
+
+    @staticmethod
+    def guess_format(path):
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith(('.jsonl', '.json')):
+            return 'jsonl'
+        if name.endswith(('.csv', '.tsv')):
+            return 'csv'
+        raise CommandError("Format de l'export inconnu, utilisez --format")
+
+    @staticmethod
+    def open(path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf8', newline='')
+        return open(path, encoding='utf8', newline='')
+
+    def read_jsonl(self, path):
+        """ Yielding the products of a JSON lines export, one line at a time
+                """
+        with self.open(path) as dump:
+            for line in dump:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        self.stderr.write("Ligne invalide ignorée : {0}".format(line[:80]))
+
+    def read_csv(self, path):
+        """ Yielding the products of the tab separated CSV export, with the same keys as the JSON products
+                """
+        csv.field_size_limit(sys.maxsize)
+        with self.open(path) as dump:
+            for row in csv.DictReader(dump, delimiter='\t', quoting=csv.QUOTE_NONE):
+                row['nutrition_grades'] = row.get('nutriscore_grade') or row.get('nutrition_grade_fr')
+                for key in ('categories_tags', 'countries_tags'):
+                    row[key] = [tag for tag in (row.get(key) or '').split(',') if tag]
+                yield row
+
+    @staticmethod
+    def keep(food, countries, categories, with_nutriscore):
+        """ Applying the country, category and nutriscore filters to a product
+                """
+        if countries and not set(countries).intersection(food.get('countries_tags') or []):
+            return False
+        if categories and not set(categories).intersection(food.get('categories_tags') or []):
+            return False
+        if with_nutriscore and (food.get('nutrition_grades') or '').lower() not in NUTRISCORES:
+            return False
+        return True
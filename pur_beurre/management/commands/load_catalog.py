@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pur_beurre.catalog_fixture import FixtureLoader
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.substitutes import refresh_substitutes
+
+
+class Command(BaseCommand):
+    help = "Charge rapidement une fixture du catalogue (par exemple pur_beurre.json)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Chemin de la fixture au format de dumpdata")
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Nombre d'objets d'un même modèle insérés par requête")
+        parser.add_argument('--skip-substitutes', action='store_true',
+                            help="Ne pas recalculer les produits de substitution")
+
+    def handle(self, *args, **options):
+        """ Stream-parsing the fixture and bulk inserting its records in one transaction
+                """
+        loader = FixtureLoader(options['batch_size'])
+        with transaction.atomic(), open(options['path'], encoding='utf8') as fixture:
+            loaded = loader.load(fixture)
+        for label, amount in sorted(loaded.items()):
+            self.stdout.write("{0} : {1} objets chargés".format(label, amount))
+
+        if not options['skip_substitutes']:
+            self.stdout.write("Calcul des produits de substitution")
+            refresh_substitutes()
+        rebuild_autocomplete_index()
+        bump_catalog_generation()
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.autocomplete import rebuild_autocomplete_index
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.purge import CatalogPurge, empty_products, stale_products, vacuum
+from pur_beurre.substitutes import refresh_substitutes
+
+
+class Command(BaseCommand):
+    help = ("Supprime les catégories trop peu utilisées, les produits absents d'Open Food Facts depuis plusieurs "
+            "synchronisations complètes et les produits sans nutriscore ni catégorie")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-products', type=int, default=2,
+                            help="Supprimer les catégories sans identifiant Open Food Facts liées à moins de "
+                                 "produits que cela (0 pour les garder)")
+        parser.add_argument('--missed-syncs', type=int, default=3,
+                            help="Supprimer les produits absents de ce nombre de synchronisations complètes "
+                                 "(0 pour les garder)")
+        parser.add_argument('--keep-empty', action='store_true',
+                            help="Garder les produits sans nutriscore ni catégorie")
+        parser.add_argument('--include-saved', action='store_true',
+                            help="Supprimer aussi les produits sauvegardés par des utilisateurs, et leurs sauvegardes")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Nombre de lignes supprimées par transaction")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Compter les lignes à supprimer sans rien modifier")
+
+    def handle(self, *args, **options):
+        """ Reporting and purging the catalog rows nobody needs, then refreshing what depends on them
+                """
+        purge = CatalogPurge(options['batch_size'], dry_run=options['dry_run'],
+                             include_saved=options['include_saved'])
+        verb = "à supprimer" if options['dry_run'] else "supprimés"
+        kinds = []
+        if options['missed_syncs']:
+            kinds.append(("produits absents d'Open Food Facts", stale_products(options['missed_syncs'])))
+        if not options['keep_empty']:
+            kinds.append(("produits sans nutriscore ni catégorie", empty_products()))
+        for label, queryset in kinds:
+            purged, kept = purge.products(queryset)
+            self.stdout.write("{0} {1} {2}, {3} gardés car sauvegardés".format(purged, label, verb, kept))
+        if options['min_products']:
+            purged = purge.categories(options['min_products'])
+            self.stdout.write("{0} catégories de moins de {1} produits {2}".format(
+                purged, options['min_products'], verb))
+
+        if options['dry_run']:
+            return
+        if purge.affected:
+            self.stdout.write("Calcul des produits de substitution")
+            refresh_substitutes(purge.affected)
+        rebuild_autocomplete_index()
+        bump_catalog_generation()
+        if vacuum():
+            self.stdout.write("Tables nettoyées (VACUUM ANALYZE)")
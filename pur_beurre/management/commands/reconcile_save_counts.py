@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.popularity import reconcile_save_counts
+
+
+class Command(BaseCommand):
+    help = "Recompte les sauvegardes de chaque produit et corrige les compteurs de popularité"
+
+    def handle(self, *args, **options):
+        """ Fixing the save counts that drifted from the favorites, to be run periodically
+                """
+        fixed = reconcile_save_counts()
+        self.stdout.write("{0} compteurs corrigés".format(fixed))
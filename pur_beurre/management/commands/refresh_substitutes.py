@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.substitutes import refresh_substitutes
+
+
+class Command(BaseCommand):
+    help = "Recalcule la table des produits de substitution"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, nargs='+', dest='products',
+                            help="Ne recalculer que les produits affectés par ces produits modifiés")
+
+    def handle(self, *args, **options):
+        """ Rebuilding the precomputed substitutes, of every product or incrementally
+                """
+        self.stdout.write("Calcul des produits de substitution")
+        refreshed = refresh_substitutes(options['products'])
+        self.stdout.write("{0} produits mis à jour".format(refreshed))
+        bump_catalog_generation()
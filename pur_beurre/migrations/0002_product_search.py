@@ -0,0 +1,84 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class VendorRunSQL(migrations.RunSQL):
+    """ SQL run only on the databases of one vendor
+    """
+    def __init__(self, vendor, *args, **kwargs):
+        self.vendor = vendor
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        kwargs['vendor'] = self.vendor
+        return name, args, kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    """ Full-text search of the products. PostgreSQL keeps a weighted search vector up to date with a trigger and
+    indexes it. SQLite gets its FTS5 index and triggers from the post_migrate signal, which installs them again
+    whenever a migration rebuilt the product table, so only their removal is done here.
+    """
+
+    dependencies = [
+        ('pur_beurre', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        VendorRunSQL(
+            'postgresql',
+            [
+                "CREATE EXTENSION IF NOT EXISTS unaccent",
+                "CREATE TEXT SEARCH CONFIGURATION pur_beurre (COPY = simple)",
+                "ALTER TEXT SEARCH CONFIGURATION pur_beurre "
+                "ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple",
+                """
+                CREATE FUNCTION pur_beurre_product_search_vector() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector :=
+                        setweight(to_tsvector('pur_beurre', coalesce(NEW.name, '')), 'A') ||
+                        setweight(to_tsvector('pur_beurre', coalesce(NEW.brand, '')), 'B') ||
+                        setweight(to_tsvector('pur_beurre', coalesce(NEW.description, '')), 'C');
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql
+                """,
+                "CREATE TRIGGER pur_beurre_product_search_vector_update "
+                "BEFORE INSERT OR UPDATE OF name, brand, description ON pur_beurre_product "
+                "FOR EACH ROW EXECUTE PROCEDURE pur_beurre_product_search_vector()",
+                "UPDATE pur_beurre_product SET name = name",
+                "CREATE INDEX pur_beurre_product_search_vector_gin "
+                "ON pur_beurre_product USING gin (search_vector)",
+            ],
+            [
+                "DROP INDEX IF EXISTS pur_beurre_product_search_vector_gin",
+                "DROP TRIGGER IF EXISTS pur_beurre_product_search_vector_update ON pur_beurre_product",
+                "DROP FUNCTION IF EXISTS pur_beurre_product_search_vector()",
+                "DROP TEXT SEARCH CONFIGURATION IF EXISTS pur_beurre",
+            ],
+        ),
+        VendorRunSQL(
+            'sqlite',
+            migrations.RunSQL.noop,
+            [
+                "DROP TRIGGER IF EXISTS pur_beurre_product_fts_insert",
+                "DROP TRIGGER IF EXISTS pur_beurre_product_fts_delete",
+                "DROP TRIGGER IF EXISTS pur_beurre_product_fts_update",
+                "DROP TABLE IF EXISTS pur_beurre_product_fts",
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.7 on 2026-10-18 14:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0002_product_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSubstitute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveIntegerField(verbose_name='Rang')),
+                ('shared_categories', models.PositiveIntegerField(default=0, verbose_name='Catégories communes')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='substitutes', to='pur_beurre.Product')),
+                ('substitute', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='substitute_of', to='pur_beurre.Product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productsubstitute',
+            index=models.Index(fields=['product', 'rank'], name='substitute_rank_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productsubstitute',
+            constraint=models.UniqueConstraint(fields=('product', 'substitute'), name='substitute_association'),
+        ),
+    ]
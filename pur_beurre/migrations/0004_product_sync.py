@@ -0,0 +1,65 @@
+import re
+
+from django.db import migrations, models
+
+BARCODE = re.compile(r'^\d{4,}$')
+
+
+def populate_barcodes(apps, schema_editor):
+    """ Filling the barcode of the existing products: the description holds it, else the tail of the product page
+    url in itemcode. Only the oldest product of a barcode gets it, the later copies being duplicates of earlier
+    imports.
+    """
+    Product = apps.get_model('pur_beurre', 'Product')
+    seen = set()
+    updates = []
+    for product_id, description, itemcode in Product.objects.order_by('id').values_list(
+            'id', 'description', 'itemcode').iterator():
+        code = (description or '').strip()
+        if not BARCODE.match(code):
+            code = (itemcode or '').rstrip('/').rsplit('/', 1)[-1]
+        if BARCODE.match(code) and code not in seen:
+            seen.add(code)
+            updates.append(Product(id=product_id, barcode=code))
+    Product.objects.bulk_update(updates, ['barcode'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0003_productsubstitute'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(blank=True, max_length=150, null=True, verbose_name='Code-barres'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='last_modified_t',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Dernière modification Openfoodfacts'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='is_active',
+            field=models.BooleanField(default=True, verbose_name='Actif'),
+        ),
+        migrations.RunPython(populate_barcodes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(blank=True, max_length=150, null=True, unique=True, verbose_name='Code-barres'),
+        ),
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=50, unique=True, verbose_name='Source')),
+                ('watermark', models.BigIntegerField(default=0, verbose_name='Dernière modification importée')),
+                ('last_full_sync', models.DateTimeField(blank=True, null=True, verbose_name='Dernière synchronisation complète')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Mis à jour le')),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """ Indexes of the hot query shapes: the substitutes candidates by nutriscore, the lookups by itemcode and
+    brand, the favorites of a user in id order, and the products of a category. Django only indexes the through
+    table on (product_id, categories_id) and on each column, so the category first direction is added in SQL.
+    """
+
+    dependencies = [
+        ('pur_beurre', '0004_product_sync'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['nutriscore'], name='product_nutriscore_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['itemcode'], name='product_itemcode_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['brand'], name='product_brand_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='savedproduct',
+            index=models.Index(fields=['saved_by', 'id'], name='saved_by_id_idx'),
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX pur_beurre_product_categories_category_idx '
+            'ON pur_beurre_product_categories (categories_id, product_id)',
+            'DROP INDEX pur_beurre_product_categories_category_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.7 on 2026-10-18 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0005_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='thumbnail',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Miniature'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.7 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+def populate_save_counts(apps, schema_editor):
+    """ Counting the existing favorites of every product
+    """
+    Product = apps.get_model('pur_beurre', 'Product')
+    SavedProduct = apps.get_model('pur_beurre', 'SavedProduct')
+    counts = SavedProduct.objects.values_list('saved_product').annotate(count=models.Count('id')).order_by()
+    Product.objects.bulk_update([Product(id=product_id, save_count=count) for product_id, count in counts],
+                                ['save_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0006_product_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='save_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Nombre de sauvegardes'),
+        ),
+        migrations.RunPython(populate_save_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-save_count', 'id'], name='product_save_count_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.7 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+def count_past_syncs(apps, schema_editor):
+    """ Counting the full syncs already made as one, the products they deactivated having been missing since it
+    """
+    Product = apps.get_model('pur_beurre', 'Product')
+    SyncState = apps.get_model('pur_beurre', 'SyncState')
+    SyncState.objects.filter(last_full_sync__isnull=False).update(full_syncs=1)
+    Product.objects.filter(is_active=False).update(missing_since=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0007_product_save_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='missing_since',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True,
+                                              verbose_name='Absent depuis la synchronisation'),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='full_syncs',
+            field=models.PositiveIntegerField(default=0, verbose_name='Synchronisations complètes'),
+        ),
+        migrations.RunPython(count_past_syncs, migrations.RunPython.noop),
+    ]
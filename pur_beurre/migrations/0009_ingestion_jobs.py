@@ -0,0 +1,52 @@
+# Generated by Django 2.2.7 on 2026-10-18 17:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0008_purge_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(default='openfoodfacts', max_length=50, verbose_name='Source')),
+                ('sync', models.BooleanField(default=False, verbose_name='Synchronisation')),
+                ('full', models.BooleanField(default=False, verbose_name='Synchronisation complète')),
+                ('status', models.CharField(choices=[('running', 'En cours'), ('paused', 'Interrompue'), ('done', 'Terminée'), ('failed', 'Échouée')], default='running', max_length=10, verbose_name='Statut')),
+                ('invocations', models.PositiveIntegerField(default=0, verbose_name='Exécutions')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='Produits lus')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='Erreurs')),
+                ('last_error', models.TextField(blank=True, verbose_name='Dernière erreur')),
+                ('watermark', models.BigIntegerField(default=0, verbose_name='Dernière modification lue')),
+                ('seconds', models.FloatField(default=0, verbose_name='Durée (s)')),
+                ('started_at', models.DateTimeField(auto_now_add=True, verbose_name='Commencée le')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Mise à jour le')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Terminée le')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IngestionCategory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'À faire'), ('done', 'Terminée'), ('failed', 'Échouée')], default='pending', max_length=10, verbose_name='Statut')),
+                ('pages', models.PositiveIntegerField(default=0, verbose_name='Pages lues')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='Produits lus')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='Erreurs')),
+                ('last_error', models.TextField(blank=True, verbose_name='Dernière erreur')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Commencée le')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Terminée le')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pur_beurre.Categories')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='categories', to='pur_beurre.IngestionJob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ingestioncategory',
+            constraint=models.UniqueConstraint(fields=('job', 'category'), name='ingestion_category'),
+        ),
+    ]
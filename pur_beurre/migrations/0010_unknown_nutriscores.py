@@ -0,0 +1,21 @@
+# Generated by Django 2.2.7 on 2026-10-18 18:10
+
+from django.db import migrations
+
+
+def unknown_nutriscores(apps, schema_editor):
+    """ Storing the "unknown" and "not-applicable" grades imported as U and N as unknown, like the missing ones
+    """
+    Product = apps.get_model('pur_beurre', 'Product')
+    Product.objects.exclude(nutriscore__in=['A', 'B', 'C', 'D', 'E', 'Z']).update(nutriscore='Z')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0009_ingestion_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(unknown_nutriscores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations
+
+
+class VendorRunSQL(migrations.RunSQL):
+    """ SQL run only on the databases of one vendor
+    """
+    def __init__(self, vendor, *args, **kwargs):
+        self.vendor = vendor
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        kwargs['vendor'] = self.vendor
+        return name, args, kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def search_vector_sql(column):
+    """ Returning the statements weighting `column` third in the search vector, and computing it again
+    """
+    return [
+        """
+        CREATE OR REPLACE FUNCTION pur_beurre_product_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('pur_beurre', coalesce(NEW.name, '')), 'A') ||
+                setweight(to_tsvector('pur_beurre', coalesce(NEW.brand, '')), 'B') ||
+                setweight(to_tsvector('pur_beurre', coalesce(NEW.{0}, '')), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """.format(column),
+        "DROP TRIGGER IF EXISTS pur_beurre_product_search_vector_update ON pur_beurre_product",
+        "CREATE TRIGGER pur_beurre_product_search_vector_update "
+        "BEFORE INSERT OR UPDATE OF name, brand, {0} ON pur_beurre_product "
+        "FOR EACH ROW EXECUTE PROCEDURE pur_beurre_product_search_vector()".format(column),
+        "UPDATE pur_beurre_product SET name = name",
+    ]
+
+
+SQLITE_FTS_REMOVAL = [
+    "DROP TRIGGER IF EXISTS pur_beurre_product_fts_insert",
+    "DROP TRIGGER IF EXISTS pur_beurre_product_fts_delete",
+    "DROP TRIGGER IF EXISTS pur_beurre_product_fts_update",
+    "DROP TABLE IF EXISTS pur_beurre_product_fts",
+]
+
+
+class Migration(migrations.Migration):
+    """ Searching the ingredients, kept in openfoodfacts_link, instead of the description, which holds the barcode.
+    The search vector of every product is computed again. The SQLite FTS5 index is dropped, for the post_migrate
+    signal to build it again on the new columns.
+    """
+
+    dependencies = [
+        ('pur_beurre', '0010_unknown_nutriscores'),
+    ]
+
+    operations = [
+        VendorRunSQL('postgresql', search_vector_sql('openfoodfacts_link'), search_vector_sql('description')),
+        VendorRunSQL('sqlite', SQLITE_FTS_REMOVAL, SQLITE_FTS_REMOVAL),
+    ]
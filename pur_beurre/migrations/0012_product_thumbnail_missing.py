@@ -0,0 +1,18 @@
+# Generated by Django 2.2.7 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pur_beurre', '0011_search_ingredients'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='thumbnail_missing',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Miniature à refaire'),
+        ),
+    ]
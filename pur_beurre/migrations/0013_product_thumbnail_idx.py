@@ -0,0 +1,19 @@
+# Generated by Django 2.2.7 on 2026-10-18 21:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """ Index of the thumbnail hashes, looked up by the thumbnail view and when thumbnails are forgotten
+    """
+
+    dependencies = [
+        ('pur_beurre', '0012_product_thumbnail_missing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['thumbnail'], name='product_thumbnail_idx'),
+        ),
+    ]
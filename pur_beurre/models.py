@@ -1,4 +1,5 @@
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
 
@@ -17,6 +18,15 @@ class Categories(models.Model):
 class Product(models.Model):
     """ Product class for Django's ORM.
                         """
+    class Meta:
+        indexes = [
+            models.Index(fields=['nutriscore'], name='product_nutriscore_idx'),
+            models.Index(fields=['itemcode'], name='product_itemcode_idx'),
+            models.Index(fields=['brand'], name='product_brand_idx'),
+            models.Index(fields=['-save_count', 'id'], name='product_save_count_idx'),
+            models.Index(fields=['thumbnail'], name='product_thumbnail_idx'),
+            ]
+
     name = models.CharField(verbose_name="Nom", max_length=150)
     nutriscore = models.CharField(verbose_name='Nutriscore', max_length=1)
     brand = models.CharField(verbose_name='Marque', max_length=200, blank=True)
@@ -25,6 +35,16 @@ class Product(models.Model):
     image = models.URLField(blank=True, default="http://www.imagespourtoi.com/image/892.html")
     openfoodfacts_link = models.URLField(verbose_name='URL Openfoodfacts', blank=True)
     categories = models.ManyToManyField('Categories')
+    search_vector = SearchVectorField(null=True, editable=False)
+    barcode = models.CharField(verbose_name='Code-barres', max_length=150, unique=True, null=True, blank=True)
+    last_modified_t = models.BigIntegerField(verbose_name='Dernière modification Openfoodfacts', null=True,
+                                             blank=True)
+    is_active = models.BooleanField(verbose_name='Actif', default=True)
+    thumbnail = models.CharField(verbose_name='Miniature', max_length=64, null=True, blank=True, editable=False)
+    thumbnail_missing = models.BooleanField(verbose_name='Miniature à refaire', default=False, editable=False)
+    save_count = models.IntegerField(verbose_name='Nombre de sauvegardes', default=0, editable=False)
+    missing_since = models.PositiveIntegerField(verbose_name='Absent depuis la synchronisation', null=True,
+                                                blank=True, editable=False)
 
     def __str__(self):
         """ For testing purpose, return the Product's name in the form of its str name
@@ -39,6 +59,9 @@ class SavedProduct(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['saved_by', 'saved_product'], name='saved_association'),
             ]
+        indexes = [
+            models.Index(fields=['saved_by', 'id'], name='saved_by_id_idx'),
+            ]
 
     saved_by = models.ForeignKey(User, verbose_name="Sauvegardé par", on_delete=models.CASCADE,)
     saved_product = models.ForeignKey(Product, verbose_name='Produit sauvegardé', on_delete=models.CASCADE,)
@@ -49,7 +72,92 @@ class SavedProduct(models.Model):
         return self.saved_product
 
 
+class ProductSubstitute(models.Model):
+    """ Precomputed substitutes class for Django's ORM. Ranked better nutriscore substitutes of a product,
+    built at ingest time
+                        """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'substitute'], name='substitute_association'),
+            ]
+        indexes = [
+            models.Index(fields=['product', 'rank'], name='substitute_rank_idx'),
+            ]
+
+    product = models.ForeignKey(Product, related_name='substitutes', on_delete=models.CASCADE,)
+    substitute = models.ForeignKey(Product, related_name='substitute_of', on_delete=models.CASCADE,)
+    rank = models.PositiveIntegerField(verbose_name='Rang')
+    shared_categories = models.PositiveIntegerField(verbose_name='Catégories communes', default=0)
+
+    def __str__(self):
+        return '{0} -> {1}'.format(self.product_id, self.substitute_id)
 
 
+class SyncState(models.Model):
+    """ Synchronization state class for Django's ORM. Remembering, per upstream source, the most recent
+    modification already imported so that the next sync only asks for newer products
+                        """
+    source = models.CharField(verbose_name='Source', max_length=50, unique=True)
+    watermark = models.BigIntegerField(verbose_name='Dernière modification importée', default=0)
+    last_full_sync = models.DateTimeField(verbose_name='Dernière synchronisation complète', null=True, blank=True)
+    full_syncs = models.PositiveIntegerField(verbose_name='Synchronisations complètes', default=0)
+    updated_at = models.DateTimeField(verbose_name='Mis à jour le', auto_now=True)
 
+    def __str__(self):
+        return '{0} ({1})'.format(self.source, self.watermark)
 
+
+class IngestionJob(models.Model):
+    """ Ingestion job class for Django's ORM. One import of the catalog, possibly spread over several invocations of
+    fill_database, each resuming from the categories left by the previous one
+                        """
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(RUNNING, 'En cours'), (PAUSED, 'Interrompue'), (DONE, 'Terminée'), (FAILED, 'Échouée')]
+
+    source = models.CharField(verbose_name='Source', max_length=50, default='openfoodfacts')
+    sync = models.BooleanField(verbose_name='Synchronisation', default=False)
+    full = models.BooleanField(verbose_name='Synchronisation complète', default=False)
+    status = models.CharField(verbose_name='Statut', max_length=10, choices=STATUSES, default=RUNNING)
+    invocations = models.PositiveIntegerField(verbose_name='Exécutions', default=0)
+    rows = models.PositiveIntegerField(verbose_name='Produits lus', default=0)
+    errors = models.PositiveIntegerField(verbose_name='Erreurs', default=0)
+    last_error = models.TextField(verbose_name='Dernière erreur', blank=True)
+    watermark = models.BigIntegerField(verbose_name='Dernière modification lue', default=0)
+    seconds = models.FloatField(verbose_name='Durée (s)', default=0)
+    started_at = models.DateTimeField(verbose_name='Commencée le', auto_now_add=True)
+    updated_at = models.DateTimeField(verbose_name='Mise à jour le', auto_now=True)
+    finished_at = models.DateTimeField(verbose_name='Terminée le', null=True, blank=True)
+
+    def __str__(self):
+        return '{0} n°{1} ({2})'.format(self.source, self.id, self.status)
+
+
+class IngestionCategory(models.Model):
+    """ Ingestion progress class for Django's ORM. Where a job stands for one category: a category is the
+    checkpoint of a job, every one of its pages being written before it is marked done
+                        """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'category'], name='ingestion_category'),
+            ]
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'À faire'), (DONE, 'Terminée'), (FAILED, 'Échouée')]
+
+    job = models.ForeignKey(IngestionJob, related_name='categories', on_delete=models.CASCADE,)
+    category = models.ForeignKey(Categories, on_delete=models.CASCADE,)
+    status = models.CharField(verbose_name='Statut', max_length=10, choices=STATUSES, default=PENDING)
+    pages = models.PositiveIntegerField(verbose_name='Pages lues', default=0)
+    rows = models.PositiveIntegerField(verbose_name='Produits lus', default=0)
+    errors = models.PositiveIntegerField(verbose_name='Erreurs', default=0)
+    last_error = models.TextField(verbose_name='Dernière erreur', blank=True)
+    started_at = models.DateTimeField(verbose_name='Commencée le', null=True, blank=True)
+    finished_at = models.DateTimeField(verbose_name='Terminée le', null=True, blank=True)
+
+    def __str__(self):
+        return '{0} {1} ({2})'.format(self.job_id, self.category_id, self.status)
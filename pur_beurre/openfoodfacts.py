@@ -0,0 +1,182 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pur_beurre.ingestion import modification_time
+
+logger = logging.getLogger(__name__)
+
+SEARCH_URL = "https://fr.openfoodfacts.org/cgi/search.pl"
+USER_AGENT = "PurBeurre - fill_database"
+PRODUCT_FIELDS = ("code,product_name,brands,nutrition_grades,ingredients_text,image_url,"
+                  "categories,categories_tags,last_modified_t")
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+Page = namedtuple('Page', ['category', 'number', 'products', 'count', 'error'])
+
+
+class RateLimiter:
+    """ Spacing the requests of all the threads sharing it by at least 1 / rate seconds
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class OpenFoodFactsFetcher:
+    """ Fetching the products of many categories from the Open Food Facts search API. The first page of a category
+    gives its product count, then its other pages are fetched concurrently by a bounded pool of threads sharing one
+    keep-alive session and a global rate limit. Failed requests are retried with an exponential backoff. The
+    fetched pages are handed over through a queue, in the order they arrive, to the thread iterating `fetch()`.
+
+    With `newer_than`, only the products modified upstream after that Unix timestamp are wanted: the categories
+    are browsed most recently modified first, one page after the other, until a page reaches older products.
+    """
+    def __init__(self, search_url=SEARCH_URL, workers=4, page_size=100, max_pages=None, rate=5.0,
+                 retries=4, backoff=1.0, timeout=30, session=None, newer_than=None):
+        self.search_url = search_url
+        self.workers = workers
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or self.build_session(workers)
+        self.newer_than = newer_than
+
+    @staticmethod
+    def build_session(workers):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = USER_AGENT
+        return session
+
+    def get(self, params):
+        """ Requesting a search page, retrying the network errors and the throttled or failed responses
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                response = self.session.get(self.search_url, params=params, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError("{0} {1}".format(response.status_code, response.reason))
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                error = exception
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt
+            logger.warning("Open Food Facts request failed (%s), new attempt in %.1fs", error, delay)
+            time.sleep(delay)
+
+    def page_params(self, category, number):
+        params = {"action": "process",
+                  "tagtype_0": "categories",
+                  "tag_contains_0": "contains",
+                  "tag_0": category.off_id,
+                  "page": number,
+                  "page_size": self.page_size,
+                  "fields": PRODUCT_FIELDS,
+                  "json": 1}
+        if self.newer_than is not None:
+            params["sort_by"] = "last_modified_t"
+        return params
+
+    def fetch_page(self, category, number):
+        data = self.get(self.page_params(category, number))
+        products = data.get("products", [])
+        if self.newer_than is not None:
+            products = [food for food in products if (modification_time(food) or 0) > self.newer_than]
+        return Page(category, number, products, int(data.get("count") or 0), None)
+
+    def next_pages(self, page):
+        """ Returning the numbers of the pages to fetch after a fetched one: all the others after the first page,
+        or only the following one while the products are newer than `newer_than`
+        """
+        last = -(-page.count // self.page_size)
+        if self.max_pages:
+            last = min(last, self.max_pages)
+        if self.newer_than is None:
+            return range(2, last + 1) if page.number == 1 else []
+        if page.number < last and len(page.products) == self.page_size:
+            return [page.number + 1]
+        return []
+
+    def fetch(self, categories):
+        """ Yielding the pages of every category as soon as they are fetched. A page that could not be fetched is
+        yielded with its `error` set and no products.
+        """
+        pages = queue.Queue(maxsize=self.workers * 2)
+        cancelled = threading.Event()
+        pending = [0]
+        lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def submit(category, number):
+            with lock:
+                pending[0] += 1
+            executor.submit(run, category, number)
+
+        def run(category, number):
+            try:
+                if cancelled.is_set():
+                    return
+                try:
+                    page = self.fetch_page(category, number)
+                except (requests.RequestException, ValueError) as error:
+                    page = Page(category, number, [], 0, error)
+                if not page.error:
+                    for other in self.next_pages(page):
+                        submit(category, other)
+                put(page)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    finished = pending[0] == 0
+                if finished:
+                    put(None)
+
+        categories = list(categories)
+        with lock:
+            pending[0] += len(categories)
+        try:
+            if not categories:
+                return
+            for category in categories:
+                executor.submit(run, category, 1)
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                yield page
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=True)
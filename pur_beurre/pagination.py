@@ -0,0 +1,33 @@
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.exceptions import EmptyResultSet
+from django.utils.functional import cached_property
+
+from OCRnutella.routers import primary
+from pur_beurre.cache import catalog_generation
+
+
+class CachedCountPaginator(Paginator):
+    """ Paginator for large querysets. The count query is cached until the catalog changes, and capped to
+    `max_count` rows so that counting a huge result set stays cheap: only the first `max_count` results can then
+    be browsed.
+    """
+    count_timeout = 300
+    max_count = 9000
+
+    @cached_property
+    def count(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = 'pur_beurre:{0}:count:{1}'.format(catalog_generation(),
+                                                hashlib.md5(repr((sql, params)).encode('utf8')).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            with primary():
+                count = self.object_list.order_by()[:self.max_count].count()
+            cache.set(key, count, self.count_timeout)
+        return count
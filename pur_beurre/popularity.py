@@ -0,0 +1,107 @@
+"""Popularity of the products: how many users saved each of them.
+
+The count is kept on the product itself, so that ranking by popularity is a plain indexed ORDER BY instead of a
+COUNT over the favorites. Adding or removing favorites does not write it right away: every worker sums the changes
+in memory and applies them in a few UPDATE ... SET save_count = save_count + n statements, at most every
+SAVE_COUNT_FLUSH_INTERVAL seconds, so that a popular product is not a row every request waits on. The changes
+still buffered when a worker dies are lost: "manage.py reconcile_save_counts" recounts the favorites and fixes
+the products that drifted.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from pur_beurre.cache import catalog_generation
+from pur_beurre.models import Product, SavedProduct
+
+logger = logging.getLogger(__name__)
+
+ORDERINGS = ('relevance', 'popular')
+
+
+def ordering(request):
+    """ Returning the ordering asked for with `?order=`, the default one for unknown values
+    """
+    order = request.GET.get('order')
+    return order if order in ORDERINGS else ORDERINGS[0]
+
+
+class SaveCountBuffer:
+    """ Save count changes of one worker, waiting to be written
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.flushed_at = time.monotonic()
+
+    def add(self, product_ids, delta):
+        """ Recording that the products were saved (delta 1) or removed (delta -1) once more, and writing the
+        buffered changes when they are due
+        """
+        with self.lock:
+            for product_id in product_ids:
+                self.pending[product_id] += delta
+            due = (len(self.pending) >= settings.SAVE_COUNT_FLUSH_SIZE or
+                   time.monotonic() - self.flushed_at >= settings.SAVE_COUNT_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Writing the buffered changes, one UPDATE per distinct change. Returning the number of products updated.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            self.flushed_at = time.monotonic()
+        by_delta = defaultdict(list)
+        for product_id, delta in pending.items():
+            if delta:
+                by_delta[delta].append(product_id)
+        updated = 0
+        for delta, product_ids in sorted(by_delta.items()):
+            updated += Product.objects.filter(id__in=sorted(product_ids)).update(save_count=F('save_count') + delta)
+        return updated
+
+
+save_counts = SaveCountBuffer()
+
+
+@atexit.register
+def flush_save_counts():
+    try:
+        save_counts.flush()
+    except Exception:
+        logger.exception("Save counts lost at exit")
+
+
+def reconcile_save_counts():
+    """ Recounting the favorites of every product and fixing the save counts that drifted. Returning the number of
+    products fixed.
+    """
+    save_counts.flush()
+    actual = Coalesce(Subquery(SavedProduct.objects.filter(saved_product=OuterRef('pk')).order_by()
+                               .values('saved_product').annotate(count=Count('id')).values('count'),
+                               output_field=IntegerField()), Value(0))
+    return Product.objects.exclude(save_count=actual).update(save_count=actual)
+
+
+def most_saved(category_id=None, limit=None):
+    """ Returning the ids of the most saved active products, of a category or of the whole catalog, from the cache
+    when possible
+    """
+    limit = limit or settings.MOST_SAVED_SIZE
+    key = 'pur_beurre:{0}:most_saved:{1}:{2}'.format(catalog_generation(), category_id or 'all', limit)
+    ids = cache.get(key)
+    if ids is None:
+        queryset = Product.objects.filter(is_active=True, save_count__gt=0)
+        if category_id:
+            queryset = queryset.filter(categories=category_id)
+        ids = list(queryset.order_by('-save_count', 'id').values_list('id', flat=True)[:limit])
+        cache.set(key, ids, settings.MOST_SAVED_CACHE_TIMEOUT)
+    return ids
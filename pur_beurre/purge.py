@@ -0,0 +1,112 @@
+"""Pruning of the catalog rows nobody needs.
+
+Three kinds of rows are purged: the categories linked to fewer than a given number of products, most of them made
+from the free text of a single product, the products missing from Open Food Facts for a given number of full syncs,
+and the products having neither a nutriscore nor any category, which can neither be substituted nor substitute
+anything. The categories having an Open Food Facts id are the ones imported from, so they are always kept, and so
+are the products saved by a user unless asked otherwise.
+
+Every kind is walked by ranges of ids, `batch_size` rows at a time and each batch in its own transaction, so that
+neither the memory of the process nor the locks held depend on the size of the catalog.
+"""
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef
+
+from pur_beurre.models import Categories, Product, ProductSubstitute, SavedProduct, SyncState
+
+UNKNOWN_NUTRISCORES = ('', 'Z')
+VACUUMED_MODELS = (Product, Categories, Product.categories.through, ProductSubstitute)
+
+
+def stale_products(missed_syncs, source='openfoodfacts'):
+    """ Returning the products absent from the last `missed_syncs` full syncs of the source
+    """
+    state = SyncState.objects.filter(source=source).first()
+    if state is None or missed_syncs < 1 or state.full_syncs < missed_syncs:
+        return Product.objects.none()
+    return Product.objects.filter(is_active=False, missing_since__lte=state.full_syncs - missed_syncs + 1)
+
+
+def empty_products():
+    """ Returning the products with neither a nutriscore nor any category
+    """
+    through = Product.categories.through
+    return (Product.objects.filter(nutriscore__in=UNKNOWN_NUTRISCORES)
+            .annotate(categorized=Exists(through.objects.filter(product_id=OuterRef('pk'))))
+            .filter(categorized=False))
+
+
+def saved(products):
+    return products.annotate(saved=Exists(SavedProduct.objects.filter(saved_product_id=OuterRef('pk'))))
+
+
+class CatalogPurge:
+    """ Counting, and deleting unless `dry_run`, the rows to purge. The ids of the products whose substitutes may
+    change are gathered in `affected`.
+    """
+    def __init__(self, batch_size=1000, dry_run=False, include_saved=False):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.include_saved = include_saved
+        self.affected = set()
+
+    def batches(self, queryset):
+        """ Yielding the ids of the queryset by ascending batches, each read once the previous one was handled
+        """
+        last = 0
+        while True:
+            ids = list(queryset.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                return
+            yield ids
+            last = ids[-1]
+
+    def categories(self, min_products):
+        """ Purging the categories without Open Food Facts id linked to fewer than `min_products` products.
+        Returning their number.
+        """
+        through = Product.categories.through
+        purged = 0
+        for ids in self.batches(Categories.objects.filter(off_id='')):
+            counts = dict(through.objects.filter(categories_id__in=ids).order_by().values_list('categories_id')
+                          .annotate(count=Count('id')))
+            small = [category_id for category_id in ids if counts.get(category_id, 0) < min_products]
+            purged += len(small)
+            if self.dry_run or not small:
+                continue
+            self.affected.update(through.objects.filter(categories_id__in=small).values_list('product_id', flat=True))
+            with transaction.atomic():
+                through.objects.filter(categories_id__in=small).delete()
+                Categories.objects.filter(id__in=small).delete()
+        return purged
+
+    def products(self, queryset):
+        """ Purging the products of the queryset, except the saved ones unless `include_saved`. Returning the
+        numbers of purged and kept saved products.
+        """
+        queryset = saved(queryset)
+        kept = 0 if self.include_saved else queryset.filter(saved=True).count()
+        if not self.include_saved:
+            queryset = queryset.filter(saved=False)
+        purged = 0
+        for ids in self.batches(queryset):
+            purged += len(ids)
+            if self.dry_run:
+                continue
+            self.affected.update(ProductSubstitute.objects.filter(substitute_id__in=ids)
+                                 .values_list('product_id', flat=True))
+            with transaction.atomic():
+                Product.objects.filter(id__in=ids).delete()
+        return purged, kept
+
+
+def vacuum():
+    """ Reclaiming the space of the purged rows and refreshing the planner statistics, on PostgreSQL only. VACUUM
+    cannot run in a transaction: this relies on the autocommit mode of the connection.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        for model in VACUUMED_MODELS:
+            cursor.execute('VACUUM ANALYZE {0}'.format(connection.ops.quote_name(model._meta.db_table)))
+    return True
@@ -0,0 +1,99 @@
+import re
+import unicodedata
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connections
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from pur_beurre.models import Product
+
+SEARCH_CONFIG = 'pur_beurre'
+FTS_TABLE = 'pur_beurre_product_fts'
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS pur_beurre_product_fts_insert AFTER INSERT ON pur_beurre_product BEGIN
+        INSERT INTO pur_beurre_product_fts(rowid, name, brand, openfoodfacts_link)
+        VALUES (new.id, new.name, new.brand, new.openfoodfacts_link);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS pur_beurre_product_fts_delete AFTER DELETE ON pur_beurre_product BEGIN
+        INSERT INTO pur_beurre_product_fts(pur_beurre_product_fts, rowid, name, brand, openfoodfacts_link)
+        VALUES ('delete', old.id, old.name, old.brand, old.openfoodfacts_link);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS pur_beurre_product_fts_update AFTER UPDATE ON pur_beurre_product BEGIN
+        INSERT INTO pur_beurre_product_fts(pur_beurre_product_fts, rowid, name, brand, openfoodfacts_link)
+        VALUES ('delete', old.id, old.name, old.brand, old.openfoodfacts_link);
+        INSERT INTO pur_beurre_product_fts(rowid, name, brand, openfoodfacts_link)
+        VALUES (new.id, new.name, new.brand, new.openfoodfacts_link);
+    END
+    """,
+]
+
+
+def install_sqlite_fts(connection):
+    """ Creating the FTS5 index and its triggers, from the post_migrate signal. SQLite drops triggers whenever a
+    migration rebuilds the product table, so this is safe to call again after every migrate and rebuilds the index
+    when triggers were missing. The PostgreSQL search vector is installed by the migrations.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'pur_beurre_product'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                       "AND name LIKE 'pur_beurre_product_fts_%'")
+        if cursor.fetchone()[0] == len(SQLITE_TRIGGERS):
+            return
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS pur_beurre_product_fts "
+            "USING fts5(name, brand, openfoodfacts_link, content='pur_beurre_product', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        for statement in SQLITE_TRIGGERS:
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO pur_beurre_product_fts(pur_beurre_product_fts) VALUES ('rebuild')")
+
+
+def search_terms(research):
+    """ Splitting a research into lowercase terms without accents, "Crème Brûlée" gives ['creme', 'brulee']
+    """
+    research = unicodedata.normalize('NFKD', research)
+    research = ''.join(character for character in research if not unicodedata.combining(character))
+    return re.findall(r'[^\W_]+', research.lower())
+
+
+def search_products(research, queryset=None):
+    """ Returning the products whose name, brand or ingredients match every term of the research as a prefix,
+    annotated with a relevance `rank` and ordered by it. PostgreSQL uses the GIN indexed search vector, SQLite its
+    FTS5 index.
+    """
+    if queryset is None:
+        queryset = Product.objects.filter(is_active=True)
+    terms = search_terms(research)
+    if not terms:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        query = SearchQuery(' & '.join('{0}:*'.format(term) for term in terms),
+                            config=SEARCH_CONFIG, search_type='raw')
+        queryset = queryset.filter(search_vector=query).annotate(rank=SearchRank(F('search_vector'), query))
+    elif vendor == 'sqlite':
+        match = ' '.join('"{0}"*'.format(term) for term in terms)
+        queryset = queryset.extra(
+            where=["{1}.id IN (SELECT rowid FROM {0} WHERE {0} MATCH %s)".format(FTS_TABLE, Product._meta.db_table)],
+            params=[match],
+        ).annotate(rank=RawSQL(
+            "SELECT -bm25({0}, 10.0, 4.0, 1.0) FROM {0} WHERE {0} MATCH %s AND rowid = {1}.id".format(
+                FTS_TABLE, Product._meta.db_table),
+            (match,), output_field=FloatField()))
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= Q(name__icontains=term) | Q(brand__icontains=term) | Q(openfoodfacts_link__icontains=term)
+        queryset = queryset.filter(condition).annotate(rank=Value(0.0, output_field=FloatField()))
+    return queryset.order_by('-rank', 'id')
@@ -0,0 +1,160 @@
+import threading
+from array import array
+from collections import defaultdict
+
+from OCRnutella.routers import primary
+from pur_beurre.cache import catalog_generation
+from pur_beurre.models import Product
+
+
+def indices_mask(indices, size):
+    """ Returning the bitset of a list of product indices
+    """
+    buffer = bytearray((size + 7) // 8)
+    for index in indices:
+        buffer[index >> 3] |= 1 << (index & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class CategorySimilarity:
+    """ In-memory similarity engine between the category sets of the active products, without any SQL.
+
+    Products are numbered in (nutriscore, id) order and sets of products are bitsets held in Python integers, so
+    that the products of a nutriscore are a contiguous range of bits and the lowest bits of a set are its best
+    products. A category is kept as a bitset when that is smaller than the list of its products, as that list
+    otherwise. The categories of a product are added up bit-sliced, giving at once the number of categories every
+    other product shares with it. Candidates are then taken by decreasing Jaccard index, shared / (own + theirs -
+    shared), from the bitsets of the products having exactly `shared` categories in common and `theirs` categories.
+    """
+    def __init__(self, products, memberships):
+        """ `products` are (id, nutriscore) pairs, `memberships` (product id, category id) pairs
+        """
+        products = sorted(products, key=lambda product: (product[1], product[0]))
+        self.size = len(products)
+        self.ids = array('q', [product_id for product_id, nutriscore in products])
+        self.position = {product_id: index for index, product_id in enumerate(self.ids)}
+
+        self.grades = {}
+        for index, (product_id, nutriscore) in enumerate(products):
+            start, end = self.grades.get(nutriscore, (index, index))
+            self.grades[nutriscore] = (start, index + 1)
+
+        members = defaultdict(list)
+        counts = defaultdict(int)
+        for product_id, category_id in memberships:
+            index = self.position.get(product_id)
+            if index is not None:
+                members[category_id].append(index)
+                counts[index] += 1
+
+        self.categories = {}
+        for category_id, indices in members.items():
+            if len(indices) * 32 > self.size:
+                self.categories[category_id] = indices_mask(indices, self.size)
+            else:
+                self.categories[category_id] = array('I', sorted(indices))
+
+        by_count = defaultdict(list)
+        for index, count in counts.items():
+            by_count[count].append(index)
+        self.by_count = {count: indices_mask(indices, self.size) for count, indices in by_count.items()}
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def build(cls):
+        products = Product.objects.filter(is_active=True).values_list('id', 'nutriscore')
+        memberships = Product.categories.through.objects.filter(product__is_active=True).values_list(
+            'product_id', 'categories_id')
+        return cls(products.iterator(), memberships.iterator())
+
+    def category_mask(self, category_id):
+        members = self.categories.get(category_id, 0)
+        return members if isinstance(members, int) else indices_mask(members, self.size)
+
+    def grades_mask(self, nutriscores):
+        mask = 0
+        for nutriscore in nutriscores:
+            if nutriscore in self.grades:
+                start, end = self.grades[nutriscore]
+                mask |= ((1 << (end - start)) - 1) << start
+        return mask
+
+    def substitutes(self, product_id, nutriscores, category_ids, limit):
+        """ Returning the `limit` products of the given nutriscores most similar to a product, as dicts with their
+        id, the number of categories they share with it and their Jaccard index, the most similar first and then
+        the best nutriscores first
+        """
+        allowed = self.grades_mask(nutriscores or ())
+        category_ids = set(category_ids)
+        if not allowed or not category_ids:
+            return []
+
+        planes = []
+        candidates = 0
+        for category_id in category_ids:
+            carry = self.category_mask(category_id) & allowed
+            candidates |= carry
+            for plane, value in enumerate(planes):
+                planes[plane], carry = value ^ carry, value & carry
+                if not carry:
+                    break
+            if carry:
+                planes.append(carry)
+        if product_id in self.position:
+            candidates &= ~(1 << self.position[product_id])
+        if not candidates:
+            return []
+
+        own = len(category_ids)
+        pairs = sorted(((shared, theirs) for shared in range(1, own + 1)
+                        for theirs in self.by_count if theirs >= shared),
+                       key=lambda pair: (-pair[0] / (own + pair[1] - pair[0]), -pair[0]))
+        levels = {}
+        results = []
+        for shared, theirs in pairs:
+            if shared not in levels:
+                level = candidates if shared < 1 << len(planes) else 0
+                for plane, value in enumerate(planes):
+                    level &= value if shared >> plane & 1 else ~value
+                levels[shared] = level
+            mask = levels[shared] & self.by_count[theirs]
+            while mask and len(results) < limit:
+                lowest = mask & -mask
+                mask ^= lowest
+                results.append({'id': self.ids[lowest.bit_length() - 1],
+                                'shared': shared,
+                                'score': shared / (own + theirs - shared)})
+            if len(results) >= limit:
+                break
+        return results
+
+
+class SharedEngine:
+    """ The similarity engine of this worker process, rebuilt when the catalog generation changes. The new engine
+    is built by one thread while the others keep answering from the previous one, then swapped in whole. It is
+    built from the primary, a lagging replica not having the catalog of the generation yet.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engine = None
+        self.generation = None
+
+    def get(self):
+        generation = catalog_generation()
+        if generation != self.generation and self.lock.acquire(blocking=self.engine is None):
+            try:
+                if generation != self.generation:
+                    with primary():
+                        self.engine, self.generation = CategorySimilarity.build(), generation
+            finally:
+                self.lock.release()
+        return self.engine
+
+    def reset(self):
+        with self.lock:
+            self.engine, self.generation = None, None
+
+
+shared_engine = SharedEngine()
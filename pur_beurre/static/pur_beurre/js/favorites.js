@@ -0,0 +1,46 @@
+// Saving and removing favorites in place through the JSON favorites endpoint, the forms and links still working
+// without JavaScript
+(function ($) {
+  "use strict";
+
+  function csrfToken() {
+    var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+    return match ? decodeURIComponent(match[1]) : '';
+  }
+
+  function post(url, data) {
+    return $.ajax({
+      url: url,
+      type: 'POST',
+      contentType: 'application/json',
+      data: JSON.stringify(data),
+      headers: {'X-CSRFToken': csrfToken()},
+      dataType: 'json'
+    });
+  }
+
+  $('form[data-favorite]').on('submit', function (event) {
+    var form = $(this);
+    var button = form.find('button');
+    var saved = form.data('saved') === true;
+    var change = saved ? {remove: [form.data('favorite')]} : {save: [form.data('favorite')]};
+    event.preventDefault();
+    button.prop('disabled', true);
+    post(form.data('favorites-url'), change).done(function () {
+      form.data('saved', !saved);
+      button.html(saved ? '<i class="fas fa-save"></i> Sauvegarder' : '<i class="fas fa-check"></i> Sauvegardé');
+      button.toggleClass('btn-outline-dark', saved).toggleClass('btn-dark', !saved);
+    }).always(function () {
+      button.prop('disabled', false);
+    });
+  });
+
+  $('a[data-favorite-remove]').on('click', function (event) {
+    var link = $(this);
+    event.preventDefault();
+    post(link.data('favorites-url'), {remove: [link.data('favorite-remove')]}).done(function () {
+      link.closest('.col-lg-4').fadeOut();
+    });
+  });
+
+})(jQuery);
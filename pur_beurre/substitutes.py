@@ -0,0 +1,91 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Q
+
+from pur_beurre.models import Product, ProductSubstitute
+from pur_beurre.similarity import CategorySimilarity, shared_engine
+
+SUBSTITUTES_PER_PRODUCT = 90
+STORED_SUBSTITUTES = 60
+
+BETTER_NUTRISCORES = {
+    'A': ['A'],
+    'B': ['A'],
+    'C': ['A', 'B'],
+    'D': ['A', 'B', 'C'],
+    'E': ['A', 'B', 'C', 'D'],
+    'Z': ['A', 'B', 'C', 'D', 'E'],
+}
+
+
+def better_nutriscores(nutriscore):
+    """ Returning the nutriscores a substitute may have, 'Z' being the unknown nutriscore
+    """
+    return BETTER_NUTRISCORES.get(nutriscore)
+
+
+def stored_substitutes_cover(stored, end):
+    """ Telling whether the `stored` precomputed substitutes of a product hold its substitutes up to rank `end`:
+    all of them when fewer than STORED_SUBSTITUTES were stored, the first STORED_SUBSTITUTES otherwise
+    """
+    return stored > 0 and (stored < STORED_SUBSTITUTES or end <= stored)
+
+
+def live_substitutes(product_id, nutriscore, limit=SUBSTITUTES_PER_PRODUCT):
+    """ Ranking the substitutes of a product with the similarity engine of this worker, for the products whose
+    substitutes were not precomputed or beyond the precomputed ones. Returning dicts of their id and the number of
+    categories they share with it, best first.
+    """
+    category_ids = Product.categories.through.objects.filter(product_id=product_id).values_list('categories_id',
+                                                                                                 flat=True)
+    return shared_engine.get().substitutes(product_id, better_nutriscores(nutriscore), category_ids, limit)
+
+
+def affected_products(product_ids):
+    """ Returning the products whose substitutes may change when the given products change: themselves, the
+    products sharing a category with them and the products currently listing them as substitutes
+    """
+    through = Product.categories.through.objects
+    category_ids = through.filter(product_id__in=product_ids).values('categories_id')
+    neighbours = through.filter(categories_id__in=category_ids).values('product_id')
+    referencing = ProductSubstitute.objects.filter(substitute_id__in=product_ids).values('product_id')
+    return Product.objects.filter(Q(id__in=product_ids) | Q(id__in=neighbours) | Q(id__in=referencing))
+
+
+def refresh_substitutes(product_ids=None, batch_size=500):
+    """ Rebuilding the precomputed substitutes of every product, or only of the products affected by a change of
+    the given ones. The candidates are ranked by the in-memory similarity engine, built once for the whole refresh,
+    and only the first STORED_SUBSTITUTES are stored, the deeper ones being ranked again when asked for. The
+    inactive products get none. Each batch is swapped in a single transaction. Returning the number of refreshed
+    products.
+    """
+    products = Product.objects.all() if product_ids is None else affected_products(product_ids)
+    ids = list(products.order_by('id').values_list('id', flat=True))
+    engine = CategorySimilarity.build() if ids else None
+
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        nutriscores = dict(Product.objects.filter(id__in=batch, is_active=True).values_list('id', 'nutriscore'))
+        categories = defaultdict(list)
+        for product_id, category_id in Product.categories.through.objects.filter(
+                product_id__in=batch).values_list('product_id', 'categories_id'):
+            categories[product_id].append(category_id)
+
+        rows = []
+        for product_id in batch:
+            if product_id not in nutriscores:
+                continue
+            candidates = engine.substitutes(product_id, better_nutriscores(nutriscores[product_id]),
+                                            categories[product_id], STORED_SUBSTITUTES)
+            for rank, candidate in enumerate(candidates, 1):
+                rows.append(ProductSubstitute(product_id=product_id,
+                                              substitute_id=candidate['id'],
+                                              rank=rank,
+                                              shared_categories=candidate['shared']))
+
+        with transaction.atomic():
+            ProductSubstitute.objects.filter(product_id__in=batch).delete()
+            ProductSubstitute.objects.bulk_create(rows)
+
+    return len(ids)
@@ -0,0 +1,21 @@
+from django import template
+from django.urls import reverse
+
+register = template.Library()
+
+
+@register.filter
+def rows(items, size):
+    """ Grouping the items of a page into rows of `size` items for the grid templates
+    """
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+@register.filter
+def thumbnail(product, size):
+    """ Returning the url of the local thumbnail of a product image, the remote image when it has none
+    """
+    if product.thumbnail:
+        return reverse('pur-beurre-thumbnail', args=[product.thumbnail, size])
+    return product.image
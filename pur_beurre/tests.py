@@ -1,13 +1,57 @@
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.auth.views import LoginView
-from django.test import RequestFactory, TestCase
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.conf import settings
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from unittest import skipUnless
 from unittest.mock import patch, MagicMock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
+import csv
+import gzip
+import io
+import json
+import random
+import shutil
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from django.utils import timezone
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
 from pur_beurre.management.commands import fill_database
 from .models import *
 from django.urls import reverse
-from .views import UserSavedProductsList, SaveDelete, Food
+from .views import UserSavedProductsList, SaveDelete, Food, Favorites
+from .search import search_products, search_terms
+from .autocomplete import PrefixIndex, rebuild_autocomplete_index, shared_index
+from .substitutes import STORED_SUBSTITUTES, better_nutriscores, refresh_substitutes
+from .similarity import CategorySimilarity, shared_engine
+from .thumbnails import ThumbnailStore, evict_thumbnails, fetch_thumbnails
+from PIL import Image
+import requests
+from .ingestion import OPENFOODFACTS_PRODUCT_URL, BulkProductWriter, category_key, deactivate_missing, parse_food
+from .openfoodfacts import Page
+from .openfoodfacts import OpenFoodFactsFetcher, RateLimiter
+from .catalog_fixture import dump_catalog, iter_json_array
+from .cache import GENERATION_SOURCE, bump_catalog_generation
+from .popularity import most_saved, save_counts
+from OCRnutella.metrics import RequestMetrics
+from OCRnutella.postgresql_pool.pool import ConnectionPool, PoolTimeout
+from OCRnutella import routers
+from OCRnutella.routers import PIN_COOKIE, PrimaryReplicaRouter, Routing, current_routing, lags
+from .benchmark import clear_catalog, generate_catalog, run_benchmark
+from .exports import CATALOG_FIELDS, catalog_rows, export_lines
 from users.views import profile, register
 
+TEST_AUTOCOMPLETE_INDEX = os.path.join(tempfile.gettempdir(), 'pur_beurre_test_autocomplete.idx')
+
 
 class ProductModelTests(TestCase):
     """ Testing product name
@@ -29,6 +73,7 @@ class ViewsTests(TestCase):
     def setUp(self):
         """ Setting up a new test product for TestCase
                                         """
+        cache.clear()
         Product.objects.create(name='testname', brand='aubusson', image='http://imagetest.com')
 
     def test_homepage(self):
@@ -48,6 +93,24 @@ class ViewsTests(TestCase):
         self.assertContains(response, "aubusson")
         self.assertInHTML('''<img src="http://imagetest.com" alt="food_image" class="sr-icons img-product">''', html)
 
+    def test_research_pagination_queries(self):
+        """ Testing that a results page costs a count and a page query whatever the number of results, and that
+        the count is served from the cache afterwards
+                                                """
+        Product.objects.bulk_create([Product(name='testname {0}'.format(i), brand='b') for i in range(100)])
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('pur-beurre-results'), {'food': 'testname', 'page': 2})
+        self.assertContains(response, "Page 2 de 4.")
+        self.assertEqual(len(response.context['queryset']), 30)
+        with self.assertNumQueries(1):
+            self.client.get(reverse('pur-beurre-results'), {'food': 'testname', 'page': 3})
+
+    def test_research_without_food(self):
+        """ Testing that an empty research displays the no results page
+                                                """
+        response = self.client.get(reverse('pur-beurre-results'))
+        self.assertContains(response, "Pas de résultats")
+
     def test_legal(self):
         """ Testing legal view. The test must return a correct 200 code and contains some specifics strings
                                                 """
@@ -56,10 +119,146 @@ class ViewsTests(TestCase):
         self.assertContains(response, "Hébergeur")
 
 
+class SearchTests(TestCase):
+    def setUp(self):
+        """ Setting up products sharing words in their name, brand and ingredients for TestCase
+                                        """
+        self.cream = Product.objects.create(name='Crème fraîche', brand='Elle & Vire')
+        self.dessert = Product.objects.create(name='Dessert lacté', brand='Crème de la crème')
+        Product.objects.create(name='Gazpacho', brand='Alvalle', description='5410188031072',
+                               openfoodfacts_link='Tomates, concombres, poivrons')
+
+    def test_terms(self):
+        """ Testing that the research is split into lowercase terms without accents
+                                        """
+        self.assertEqual(search_terms(" Crème  Brûlée!"), ['creme', 'brulee'])
+
+    def test_accent_and_case_insensitive(self):
+        """ Testing that "CREME" finds the products containing "Crème", the name match being ranked first
+                                        """
+        results = list(search_products('CREME'))
+        self.assertEqual(results, [self.cream, self.dessert])
+
+    def test_prefix_and_ingredients(self):
+        """ Testing that every term is matched as a prefix, on the ingredients too but not on the barcode
+                                        """
+        self.assertEqual(search_products('fraich crem').get(), self.cream)
+        self.assertEqual(search_products('concomb').get().name, 'Gazpacho')
+        self.assertFalse(search_products('541018').exists())
+
+    def test_index_follows_updates(self):
+        """ Testing that the search index is maintained when a product is renamed or deleted
+                                        """
+        self.cream.name = 'Beurre doux'
+        self.cream.save()
+        self.assertEqual(search_products('beurre').get(), self.cream)
+        self.cream.delete()
+        self.assertFalse(search_products('beurre').exists())
+        self.assertFalse(search_products('!!').exists())
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        """ Setting up products of a few brands, one of them saved twice, for TestCase
+                                        """
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        other = User.objects.create_user(username='otheruser', password='12345')
+        self.nutella = Product.objects.create(name='Nutella', brand='Ferrero')
+        self.nutella_bio = Product.objects.create(name='Nutella Bio', brand='Ferrero')
+        Product.objects.create(name='Nutella', brand='Ferrero')
+        self.noisette = Product.objects.create(name='Pâte à tartiner noisette', brand='Nocciolata')
+        SavedProduct.objects.create(saved_by=self.user, saved_product=self.nutella_bio)
+        SavedProduct.objects.create(saved_by=other, saved_product=self.nutella_bio)
+        if os.path.exists(TEST_AUTOCOMPLETE_INDEX):
+            os.remove(TEST_AUTOCOMPLETE_INDEX)
+        shared_index.reset()
+
+    def test_suggestions_by_popularity(self):
+        """ Testing that the suggestions start with the prefix whatever its case and accents, the most saved first,
+        products of the same name being merged
+                                        """
+        index = PrefixIndex.build()
+        self.assertEqual([(suggestion['label'], suggestion['kind']) for suggestion in index.suggest('NUT')],
+                         [('Nutella Bio', 'product'), ('Nutella', 'product')])
+        self.assertEqual(index.suggest('pate a'), [{'label': 'Pâte à tartiner noisette', 'kind': 'product',
+                                                    'id': self.noisette.id}])
+        self.assertEqual(index.suggest('fer'), [{'label': 'Ferrero', 'kind': 'brand', 'id': None}])
+        self.assertEqual(index.suggest('nut', limit=1)[0]['id'], self.nutella_bio.id)
+        self.assertEqual(index.suggest(' !'), [])
+        self.assertEqual(index.suggest('xyz'), [])
+
+    def test_precomputed_prefixes(self):
+        """ Testing that the precomputed suggestions of the crowded short prefixes match the scanned ones
+                                        """
+        entries = [('produit {0}'.format(i), i % 97, 'Produit {0}'.format(i), 'product', i) for i in range(3000)]
+        index = PrefixIndex(entries, limit=5)
+        self.assertIn('pro', index.precomputed)
+        self.assertEqual(index.suggest('pro'), index.best(*index.range('pro'), 5))
+        self.assertEqual([suggestion['id'] for suggestion in index.suggest('produit 29', limit=2)], [290, 2909])
+
+    def test_view(self):
+        """ Testing that the view answers from the published index without any SQL query, and sees a new one
+                                        """
+        rebuild_autocomplete_index()
+        shared_index.get()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('pur-beurre-autocomplete'), {'q': 'nut', 'limit': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=300', response['Cache-Control'])
+        self.assertEqual(response.json()['suggestions'][0]['label'], 'Nutella Bio')
+
+        bar = Product.objects.create(name='Nutri bar', brand='Test')
+        for i in range(3):
+            user = User.objects.create_user(username='fan{0}'.format(i), password='12345')
+            SavedProduct.objects.create(saved_by=user, saved_product=bar)
+        rebuild_autocomplete_index()
+        os.utime(TEST_AUTOCOMPLETE_INDEX, (time.time() + 10, time.time() + 10))
+        shared_index.checked = 0
+        response = self.client.get(reverse('pur-beurre-autocomplete'), {'q': 'nut', 'limit': 'junk'})
+        self.assertEqual(response.json()['suggestions'][0]['label'], 'Nutri bar')
+
+
+@override_settings(AUTOCOMPLETE_RELOAD_INTERVAL=0)
+class AutocompleteRebuildTests(TransactionTestCase):
+    def setUp(self):
+        """ Setting up an empty catalog without a published index
+                                        """
+        if os.path.exists(TEST_AUTOCOMPLETE_INDEX):
+            os.remove(TEST_AUTOCOMPLETE_INDEX)
+        shared_index.reset()
+
+    def tearDown(self):
+        shared_index.reset()
+
+    def built(self):
+        shared_index.get()
+        shared_index.builder.join()
+        return shared_index.get()
+
+    def test_rebuilt_without_published_index(self):
+        """ Testing that without a published file, the index is built from the database outside of the requests,
+        which get an empty index meanwhile, and built again once the catalog generation changes
+                                        """
+        Product.objects.create(name='Nutella', brand='Ferrero')
+        with patch.object(shared_index, 'build') as build:
+            self.assertEqual(shared_index.get().suggest('nut'), [])
+            self.assertEqual(self.client.get(reverse('pur-beurre-autocomplete'), {'q': 'nut'}).json()['suggestions'],
+                             [])
+        self.assertTrue(build.called)
+        shared_index.reset()
+        self.assertEqual(self.built().suggest('nut')[0]['label'], 'Nutella')
+        Product.objects.create(name='Nutri bar', brand='Test')
+        self.assertEqual(shared_index.get().suggest('nutri'), [])
+        bump_catalog_generation()
+        self.assertEqual(self.built().suggest('nutri')[0]['label'], 'Nutri bar')
+
+
 class SubstituteViewTests(TestCase):
     def setUp(self):
         """ Setting up two new test products, and one category for TestCase
                                                 """
+        cache.clear()
         c = Categories.objects.create(name='testcat',
                                       url='http://imagetest.com',
                                       off_id='test')
@@ -75,6 +274,7 @@ class SubstituteViewTests(TestCase):
                                  image='http://imagetest.com',
                                  id=2)
         f2.categories.add(c)
+        refresh_substitutes()
 
     def test_get_request_got_results(self):
         """ Testing if the substitute view display an appropriate product
@@ -85,11 +285,567 @@ class SubstituteViewTests(TestCase):
         self.assertInHTML('''<img class="sr-icons img-product" src="http://imagetest.com" alt="">''', html)
         self.assertTrue(html.startswith(''))
 
+    def test_substitutes_ranking(self):
+        """ Testing that the substitutes sharing the most categories come first, then the best nutriscores
+                                                """
+        other = Categories.objects.create(name='othercat', url='http://imagetest.com', off_id='other')
+        base = Product.objects.create(name='base', nutriscore='E', id=3)
+        base.categories.add(Categories.objects.get(name='testcat'), other)
+        close = Product.objects.create(name='close', nutriscore='D', id=4)
+        close.categories.add(Categories.objects.get(name='testcat'), other)
+        worse = Product.objects.create(name='worse', nutriscore='E', id=5)
+        worse.categories.add(other)
+        refresh_substitutes()
+        ranked = ProductSubstitute.objects.filter(product=base).order_by('rank')
+        self.assertEqual([s.substitute_id for s in ranked], [4, 2, 1])
+        self.assertEqual(ranked[0].shared_categories, 2)
+
+    def test_incremental_refresh(self):
+        """ Testing that refreshing a changed product updates the substitutes of the products around it
+                                                """
+        f3 = Product.objects.create(name='testnamethree', nutriscore='A', id=3)
+        f3.categories.add(Categories.objects.get(name='testcat'))
+        self.assertFalse(ProductSubstitute.objects.filter(substitute=f3).exists())
+        refresh_substitutes([f3.id])
+        self.assertTrue(ProductSubstitute.objects.filter(product_id=1, substitute=f3).exists())
+        Product.objects.filter(id=3).update(nutriscore='E')
+        refresh_substitutes([f3.id])
+        self.assertFalse(ProductSubstitute.objects.filter(substitute=f3).exists())
+
+    def test_stored_first_pages(self):
+        """ Testing that only the first pages of substitutes are stored, the next ones being ranked by the engine,
+        and that the inactive products neither get nor are substitutes
+                                                """
+        shared_engine.reset()
+        category = Categories.objects.get(name='testcat')
+        base = Product.objects.create(name='base', nutriscore='E', id=3)
+        base.categories.add(category)
+        for i in range(70):
+            Product.objects.create(name='better {0}'.format(i), nutriscore='A', id=10 + i).categories.add(category)
+        Product.objects.filter(id=1).update(is_active=False)
+        refresh_substitutes()
+        self.assertFalse(ProductSubstitute.objects.filter(product_id=1).exists())
+        self.assertEqual(ProductSubstitute.objects.filter(product=base).count(), STORED_SUBSTITUTES)
+        self.assertFalse(ProductSubstitute.objects.filter(substitute_id=1).exists())
+
+        Product.objects.filter(id=10).update(is_active=False)
+        url = reverse('pur-beurre-substitutes', args=[base.id])
+        first = self.client.get(url).context['queryset']
+        self.assertEqual(len(first), 30)
+        self.assertNotIn(10, [food.id for food in first])
+        self.assertEqual(first.paginator.num_pages, 3)
+        refresh_substitutes([10])
+        bump_catalog_generation()
+        ids = []
+        for page in (1, 2, 3):
+            ids.extend(food.id for food in self.client.get(url, {'page': page}).context['queryset'])
+        self.assertEqual(sorted(ids), [2] + list(range(11, 80)))
+
+
+class SimilarityEngineTests(TestCase):
+    def test_matches_brute_force(self):
+        """ Testing that the bitset engine ranks like a plain Jaccard computation on a random catalog
+        """
+        rng = random.Random(3)
+        products = [(product_id, rng.choice('ABCDEZ')) for product_id in range(1, 400)]
+        categories = {product_id: set(rng.sample(range(30), rng.randint(1, 6))) for product_id, grade in products}
+        memberships = [(product_id, category_id) for product_id, owned in categories.items() for category_id in owned]
+        engine = CategorySimilarity(products, memberships)
+        for product_id, nutriscore in products[:50]:
+            allowed = better_nutriscores(nutriscore)
+            own = categories[product_id]
+            expected = sorted(((len(own & categories[other]) / len(own | categories[other]),
+                                len(own & categories[other]), grade, other)
+                               for other, grade in products
+                               if other != product_id and grade in allowed and own & categories[other]),
+                              key=lambda item: (-item[0], -item[1], item[2], item[3]))[:10]
+            found = engine.substitutes(product_id, allowed, own, 10)
+            self.assertEqual([(item['id'], item['shared']) for item in found],
+                             [(other, shared) for score, shared, grade, other in expected])
+
+    def test_live_substitutes(self):
+        """ Testing that a product without precomputed substitutes gets them from the engine, which follows the
+        catalog generation
+        """
+        cache.clear()
+        shared_engine.reset()
+        category = Categories.objects.create(name='Laits', url='http://test.com', off_id='en:milks')
+        base = Product.objects.create(name='Lait chocolaté', nutriscore='D')
+        base.categories.add(category)
+        self.assertEqual(shared_engine.get().substitutes(base.id, ['A', 'B', 'C'], [category.id], 10), [])
+        better = Product.objects.create(name='Lait demi écrémé', nutriscore='B')
+        better.categories.add(category)
+        bump_catalog_generation()
+        response = self.client.get(reverse('pur-beurre-substitutes', args=[base.id]))
+        self.assertEqual(list(response.context['queryset']), [better])
+        self.assertFalse(ProductSubstitute.objects.exists())
+
+
+class StubImageFetcher:
+    """ Local stand-in for the image downloads: a 600x300 picture colored after the url, or a network error
+    """
+    def fetch(self, url):
+        if 'broken' in url:
+            raise requests.ConnectionError("unreachable")
+        content = io.BytesIO()
+        Image.new('RGB', (600, 300), (len(url) % 256, 120, 40)).save(content, 'PNG')
+        return content.getvalue()
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        """ Setting up products sharing an image, one with a broken image, and an empty thumbnail store for TestCase
+        """
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(THUMBNAIL_ROOT=self.directory.name,
+                                          THUMBNAIL_FETCHER='pur_beurre.tests.StubImageFetcher')
+        self.settings.enable()
+        self.first = Product.objects.create(name='Confiture', image='http://images.test/jam.jpg')
+        self.second = Product.objects.create(name='Confiture extra', image='http://images.test/jam.jpg')
+        self.broken = Product.objects.create(name='Confiture bio', image='http://images.test/broken.jpg')
+
+    def tearDown(self):
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_fetch_thumbnails(self):
+        """ Testing that every image is reduced to every size once, the failed ones being marked
+        """
+        self.assertEqual(fetch_thumbnails(Product.objects.order_by('id'), workers=2), (2, 1))
+        first, second, broken = Product.objects.order_by('id')
+        self.assertEqual(len(first.thumbnail), 64)
+        self.assertEqual(first.thumbnail, second.thumbnail)
+        self.assertEqual(broken.thumbnail, '')
+        store = ThumbnailStore()
+        with Image.open(store.path(first.thumbnail, 'card')) as card:
+            self.assertEqual((card.format, card.size), ('WEBP', (200, 100)))
+        self.assertEqual(len(os.listdir(os.path.dirname(store.path(first.thumbnail, 'page')))), 2)
+
+    def test_serve_thumbnail(self):
+        """ Testing that the pages link the thumbnails, served with far-future cache headers, and that a missing
+        thumbnail redirects to the original image and is queued for the next fetch
+        """
+        call_command('fetch_images', stdout=StringIO())
+        digest = Product.objects.get(id=self.first.id).thumbnail
+        url = reverse('pur-beurre-thumbnail', args=[digest, 'card'])
+        html = self.client.get(reverse('pur-beurre-results'), {'food': 'confiture'}).content.decode('utf8')
+        self.assertIn(url, html)
+        self.assertIn('http://images.test/broken.jpg', html)
+
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(b''.join(response.streaming_content)[:4], b'RIFF')
+        self.assertEqual(self.client.get(reverse('pur-beurre-thumbnail', args=[digest, 'huge'])).status_code, 404)
+
+        os.remove(ThumbnailStore().path(digest, 'card'))
+        response = self.client.get(url)
+        self.assertRedirects(response, 'http://images.test/jam.jpg', fetch_redirect_response=False)
+        self.assertTrue(Product.objects.get(id=self.first.id).thumbnail_missing)
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        call_command('fetch_images', stdout=StringIO())
+        self.assertEqual(Product.objects.filter(id=self.first.id, thumbnail_missing=False, thumbnail=digest).count(), 1)
+        self.assertEqual(self.client.get(url)['Content-Type'], 'image/webp')
+
+    def test_refetch_missing_thumbnails(self):
+        """ Testing that the thumbnails missing from the store are fetched again by the next fetch
+        """
+        call_command('fetch_images', stdout=StringIO())
+        digest = Product.objects.get(id=self.first.id).thumbnail
+        shutil.rmtree(os.path.dirname(ThumbnailStore().path(digest, 'card')))
+        out = StringIO()
+        call_command('fetch_images', stdout=out)
+        self.assertIn("2 miniatures manquantes", out.getvalue())
+        self.assertIn("2 images enregistrées", out.getvalue())
+        self.assertEqual(Product.objects.get(id=self.first.id).thumbnail, digest)
+        self.assertTrue(ThumbnailStore().exists(digest))
+
+    def test_lru_eviction(self):
+        """ Testing that the least recently used thumbnails are evicted first, the temporary files being left out
+        of the eviction and removed once stale
+        """
+        fetch_thumbnails(Product.objects.filter(id=self.first.id))
+        digest = Product.objects.get(id=self.first.id).thumbnail
+        store = ThumbnailStore()
+        card, page = store.path(digest, 'card'), store.path(digest, 'page')
+        os.utime(page, (time.time() - 7200, time.time() - 7200))
+        os.utime(card, (time.time() - 3600 * 3, time.time() - 3600 * 3))
+        store.open(digest, 'card').close()
+        stale, fresh = os.path.join(os.path.dirname(card), 'stale.tmp'), os.path.join(os.path.dirname(card), 'fresh.tmp')
+        for path in (stale, fresh):
+            with open(path, 'wb') as temporary:
+                temporary.write(b'x' * 100)
+        os.utime(stale, (time.time() - 3600 * 4, time.time() - 3600 * 4))
+        store.max_bytes = os.path.getsize(card)
+        self.assertEqual(evict_thumbnails(store), 1)
+        self.assertTrue(os.path.exists(card))
+        self.assertFalse(os.path.exists(page))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertIsNone(Product.objects.get(id=self.first.id).thumbnail)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        """ Setting up a spread, its categories and better spreads for TestCase
+                                        """
+        self.spreads = Categories.objects.create(name='Pâtes à tartiner', off_id='en:spreads')
+        self.sweet = Categories.objects.create(name='Produits sucrés', off_id='en:sugary-snacks')
+        self.nutella = Product.objects.create(name='Nutella', nutriscore='E', brand='Ferrero', barcode='3017620422003')
+        self.nutella.categories.add(self.spreads, self.sweet)
+        self.better = []
+        for i in range(5):
+            product = Product.objects.create(name='Pâte {0}'.format(i), nutriscore='B', brand='Bio')
+            product.categories.add(self.spreads, *([self.sweet] if i % 2 else []))
+            self.better.append(product)
+        refresh_substitutes()
+
+    def test_cursor_pagination(self):
+        """ Testing that following the cursors walks every product once, with a single query per page
+                                        """
+        url, seen = reverse('api-products') + '?limit=2', []
+        while url:
+            with self.assertNumQueries(1):
+                data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 2)
+            seen.extend(product['id'] for product in data['results'])
+            url = data['next']
+        self.assertEqual(seen, sorted(product.id for product in [self.nutella] + self.better))
+
+    def test_fields_and_batch_lookup(self):
+        """ Testing the sparse fields and the lookup of many ids, the categories costing one more query
+                                        """
+        ids = '{0},{1},999999'.format(self.better[1].id, self.nutella.id)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('api-products'), {'ids': ids, 'fields': 'name,barcode,categories'})
+        self.assertEqual(response.json()['results'], [
+            {'name': 'Nutella', 'barcode': '3017620422003', 'categories': [self.spreads.id, self.sweet.id]},
+            {'name': 'Pâte 1', 'barcode': None, 'categories': [self.spreads.id, self.sweet.id]},
+        ])
+        self.assertEqual(self.client.get(reverse('api-products'), {'fields': 'password'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-products'), {'cursor': 'junk'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-products'), {'ids': '1,a'}).status_code, 400)
+
+    def test_detail_and_substitutes(self):
+        """ Testing a product and its substitutes, ranked and paginated on their rank
+                                        """
+        data = self.client.get(reverse('api-product', args=[self.nutella.id])).json()
+        self.assertEqual((data['brand'], data['url']), ('Ferrero', ''))
+        self.assertEqual(self.client.get(reverse('api-product', args=[999999])).status_code, 404)
+
+        url = reverse('api-substitutes', args=[self.nutella.id]) + '?limit=3&fields=id'
+        with self.assertNumQueries(2):
+            first = self.client.get(url).json()
+        self.assertEqual([substitute['rank'] for substitute in first['results']], [1, 2, 3])
+        self.assertEqual(first['results'][0], {'id': self.better[1].id, 'rank': 1, 'shared_categories': 2})
+        second = self.client.get(first['next']).json()
+        self.assertEqual([substitute['rank'] for substitute in second['results']], [4, 5])
+        self.assertIsNone(second['next'])
+
+    def test_live_substitutes(self):
+        """ Testing that the substitutes not precomputed are ranked by the engine like on the substitutes page, and
+        that the inactive substitutes are left out
+                                        """
+        shared_engine.reset()
+        spread = Product.objects.create(name='Pâte nouvelle', nutriscore='E')
+        spread.categories.add(self.spreads, self.sweet)
+        Product.objects.filter(id=self.better[3].id).update(is_active=False)
+        url = reverse('api-substitutes', args=[spread.id]) + '?limit=2&fields=id'
+        first = self.client.get(url).json()
+        self.assertEqual(first['results'], [{'id': self.better[1].id, 'rank': 1, 'shared_categories': 2},
+                                            {'id': self.better[0].id, 'rank': 2, 'shared_categories': 1}])
+        second = self.client.get(first['next']).json()
+        self.assertEqual([substitute['id'] for substitute in second['results']],
+                         [self.better[2].id, self.better[4].id])
+        self.assertIsNone(second['next'])
+        stored = self.client.get(reverse('api-substitutes', args=[self.nutella.id]) + '?fields=id').json()
+        self.assertNotIn(self.better[3].id, [substitute['id'] for substitute in stored['results']])
+
+    def test_categories(self):
+        """ Testing the categories list
+                                        """
+        data = self.client.get(reverse('api-categories'), {'fields': 'off_id'}).json()
+        self.assertEqual(data, {'results': [{'off_id': 'en:spreads'}, {'off_id': 'en:sugary-snacks'}], 'next': None})
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        """ Setting up a product with a substitute and a user for TestCase
+                                                """
+        cache.clear()
+        category = Categories.objects.create(name='testcat', url='http://imagetest.com', off_id='test')
+        self.food = Product.objects.create(name='testname', brand='testbrand', nutriscore='C', id=1)
+        self.substitute = Product.objects.create(name='testnametwo', nutriscore='A', id=2)
+        self.food.categories.add(category)
+        self.substitute.categories.add(category)
+        refresh_substitutes()
+        self.user = User.objects.create_user(username='Patrick', password='machin')
+
+    def test_anonymous_pages_cached(self):
+        """ Testing that the product and substitutes pages are served from the cache to anonymous visitors
+                                                """
+        for url in (reverse('pur-beurre-food', args=[1]), reverse('pur-beurre-substitutes', args=[1])):
+            first = self.client.get(url)
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(first.content, second.content)
+
+    def test_generation_invalidates(self):
+        """ Testing that bumping the catalog generation invalidates the cached pages
+                                                """
+        url = reverse('pur-beurre-food', args=[1])
+        self.client.get(url)
+        Product.objects.filter(id=1).update(name='renamed')
+        self.assertContains(self.client.get(url), 'testname')
+        bump_catalog_generation()
+        self.assertContains(self.client.get(url), 'renamed')
+
+    @override_settings(CACHE_SHARED=False, CATALOG_GENERATION_CHECK_INTERVAL=0)
+    def test_generation_shared_through_database(self):
+        """ Testing that without a shared cache, a generation bumped by another process is read from the database
+                                                """
+        url = reverse('pur-beurre-food', args=[1])
+        self.client.get(url)
+        Product.objects.filter(id=1).update(name='renamed')
+        self.assertContains(self.client.get(url), 'testname')
+        SyncState.objects.filter(source=GENERATION_SOURCE).update(watermark=F('watermark') + 1)
+        self.assertContains(self.client.get(url), 'renamed')
+
+    def test_vary_on_authentication(self):
+        """ Testing that logged in users get their save buttons while the catalog data still comes from the cache
+                                                """
+        url = reverse('pur-beurre-substitutes', args=[1])
+        self.assertNotContains(self.client.get(url), 'Sauvegarder')
+        self.client.login(username='Patrick', password='machin')
+        self.assertContains(self.client.get(url), 'Sauvegarder')
+        Product.objects.filter(id=2).update(name='renamed')
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'testnametwo')
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.client.logout()
+        self.assertNotContains(self.client.get(url), 'Sauvegarder')
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+    def test_reuse_and_limit(self):
+        """ Testing that returned connections are reused, and that no more than the pool size are handed out
+        """
+        pool = ConnectionPool(2, timeout=0.05)
+        first = pool.acquire(FakeConnection, lambda connection: True)
+        second = pool.acquire(FakeConnection, lambda connection: True)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection, lambda connection: True)
+        pool.release(second, True)
+        self.assertIs(pool.acquire(FakeConnection, lambda connection: True), second)
+        pool.release(first, False)
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.acquire(FakeConnection, lambda connection: True), first)
+
+    def test_health_checks(self):
+        """ Testing that idle connections are checked, and that old ones are replaced
+        """
+        pool = ConnectionPool(1, timeout=0.05, check_after=0, max_age=60)
+        connection = pool.acquire(FakeConnection, lambda connection: True)
+        pool.release(connection, True)
+        replacement = pool.acquire(FakeConnection, lambda connection: False)
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+        pool.release(replacement, True)
+        pool.max_age = -1
+        self.assertIsNot(pool.acquire(FakeConnection, lambda connection: True), replacement)
+        self.assertTrue(replacement.closed)
+
+    def test_foreign_connection(self):
+        """ Testing that a connection the pool did not hand out is closed without freeing a slot
+        """
+        pool = ConnectionPool(1, timeout=0.05)
+        pool.acquire(FakeConnection, lambda connection: True)
+        foreign = FakeConnection()
+        pool.release(foreign, True)
+        self.assertTrue(foreign.closed)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection, lambda connection: True)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_MAX_LAG=10)
+class ReplicaRoutingTests(TransactionTestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        lags.clear()
+        cache.clear()
+
+    def route(self, routing, model):
+        token = current_routing.set(routing)
+        try:
+            return self.router.db_for_read(model)
+        finally:
+            current_routing.reset(token)
+
+    def test_catalog_reads(self):
+        """ Testing that the catalog reads of a request go to the replicas in turn, and the other reads to the primary
+        """
+        with transaction.atomic():
+            self.assertEqual(self.route(Routing(), Product), 'default')
+        with patch('OCRnutella.routers.replica_lag', return_value=0):
+            self.assertEqual({self.route(Routing(), Product), self.route(Routing(), Product)}, {'replica1', 'replica2'})
+            self.assertEqual(self.route(Routing(), SavedProduct), 'default')
+            self.assertEqual(self.route(Routing(), User), 'default')
+            self.assertEqual(self.route(None, Product), 'default')
+
+    def test_lagging_replicas(self):
+        """ Testing that a lagging replica is skipped, and that the primary is read when every replica lags
+        """
+        lag = {'replica1': 60, 'replica2': 1}
+        with patch('OCRnutella.routers.replica_lag', side_effect=lag.get):
+            self.assertEqual({self.route(Routing(), Product), self.route(Routing(), Product)}, {'replica2'})
+        with patch('OCRnutella.routers.replica_lag', return_value=60):
+            self.assertEqual(self.route(Routing(), Categories), 'default')
+        with patch('OCRnutella.routers.measure_lag', side_effect=DatabaseError) as measure_lag:
+            self.assertEqual(routers.replica_lag('replica1'), float('inf'))
+            self.assertEqual(routers.replica_lag('replica1'), float('inf'))
+        self.assertEqual(measure_lag.call_count, 1)
+
+    def test_pinned_after_write(self):
+        """ Testing that a request reads from the primary once it wrote, and the next requests of its client too
+        """
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+        finally:
+            current_routing.reset(token)
+        self.assertEqual(self.route(routing, Product), 'default')
+
+        food = Product.objects.create(name='testname', nutriscore='A')
+        with patch('OCRnutella.routers.pick_replica', return_value='default') as pick_replica:
+            response = self.client.get(reverse('api-product', args=[food.id]))
+            self.assertEqual(response.status_code, 200)
+            reads = pick_replica.call_count
+            self.assertGreater(reads, 0)
+            self.assertNotIn(PIN_COOKIE, response.cookies)
+            User.objects.create_user(username='reader', password='password')
+            response = self.client.post(reverse('login'), {'username': 'reader', 'password': 'password'})
+            self.assertIn(PIN_COOKIE, response.cookies)
+            self.client.get(reverse('api-product', args=[food.id]))
+            self.assertEqual(pick_replica.call_count, reads)
+
+    def test_cache_filled_from_primary(self):
+        """ Testing that the pages cached in a new catalog generation are read from the primary, a replica lagging
+        behind the refresh which bumped it being read by the uncached requests only
+        """
+        food = Product.objects.create(name='testname', nutriscore='A')
+        url = reverse('pur-beurre-food', args=[food.id])
+        with patch('OCRnutella.routers.pick_replica', return_value='default') as pick_replica:
+            self.assertContains(self.client.get(url), 'testname')
+            Product.objects.filter(id=food.id).update(name='renamed')
+            bump_catalog_generation()
+            self.assertContains(self.client.get(url), 'renamed')
+            self.assertEqual(pick_replica.call_count, 0)
+            self.client.get(reverse('api-product', args=[food.id]))
+            self.assertGreater(pick_replica.call_count, 0)
+
+    def test_primary_block(self):
+        """ Testing that the reads of a primary block go to the primary, a write within pinning the request
+        """
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            with routers.primary():
+                self.assertEqual(self.router.db_for_read(Product), 'default')
+            self.assertFalse(routing.pinned)
+            with routers.primary():
+                self.router.db_for_write(Product)
+            self.assertTrue(routing.pinned)
+        finally:
+            current_routing.reset(token)
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "Needs a replica in DATABASE_REPLICA_URLS")
+class ReplicaDatabaseTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_read_from_replica(self):
+        """ Testing that a product is read from a replica by the API, and from the primary by the cached page
+        """
+        cache.clear()
+        food = Product.objects.create(name='testname', nutriscore='A')
+        with CaptureQueriesContext(connections[settings.DATABASE_REPLICAS[0]]) as replica_queries:
+            response = self.client.get(reverse('api-product', args=[food.id]))
+        self.assertContains(response, 'testname')
+        self.assertTrue(replica_queries.captured_queries)
+        with CaptureQueriesContext(connections[settings.DATABASE_REPLICAS[0]]) as replica_queries:
+            response = self.client.get(reverse('pur-beurre-food', args=[food.id]))
+        self.assertContains(response, 'testname')
+        self.assertFalse(replica_queries.captured_queries)
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN=None)
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        """ Setting up a product for TestCase
+                                                """
+        cache.clear()
+        Product.objects.create(name='testname', brand='aubusson', image='http://imagetest.com')
+
+    def test_request_measured(self):
+        """ Testing that a request gets an id, a structured log line and its measures in the metrics endpoint
+                                                """
+        with self.assertLogs('OCRnutella.requests', 'INFO') as logs:
+            response = self.client.get(reverse('pur-beurre-results'), {'food': 'test'},
+                                       HTTP_X_REQUEST_ID='abc-123')
+        self.assertEqual(response['X-Request-ID'], 'abc-123')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['request_id'], 'abc-123')
+        self.assertEqual(line['view'], 'pur-beurre-results')
+        self.assertEqual(line['sql_queries'], 2)
+        self.assertGreater(line['template_ms'], 0)
+
+        metrics = self.client.get(reverse('metrics')).content.decode('utf8')
+        self.assertIn('pur_beurre_sql_queries{view="pur-beurre-results",quantile="0.5"} 2', metrics)
+        self.assertIn('pur_beurre_request_duration_seconds_count{view="pur-beurre-results"}', metrics)
+
+    def test_n_plus_one(self):
+        """ Testing that a query shape repeated over the threshold is reported
+                                                """
+        metrics = RequestMetrics()
+        execute = MagicMock()
+        for i in range(12):
+            metrics(execute, 'SELECT * FROM t WHERE id = %s', [i], False, {})
+        metrics(execute, 'SELECT * FROM t WHERE id IN (%s, %s)', [1, 2], False, {})
+        metrics(execute, 'SELECT * FROM t WHERE id IN (%s)', [1], False, {})
+        self.assertEqual(metrics.sql_count, 14)
+        self.assertEqual(metrics.repeated_shapes(10), {'SELECT * FROM t WHERE id = %s': 12})
+        self.assertEqual(metrics.repeated_shapes(1), {'SELECT * FROM t WHERE id = %s': 12,
+                                                      'SELECT * FROM t WHERE id IN (...)': 2})
+
+    def test_metrics_endpoint_access(self):
+        """ Testing that the metrics endpoint is hidden when disabled, and protected by its token when set
+                                                """
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
 
 class UserLoggedIn(TestCase):
     def setUp(self):
         """ Setting up a new test product and a new user for TestCase, and creating an association between them
                                                 """
+        cache.clear()
         self.factory = RequestFactory()
         self.product = Product.objects.create(name='testname',
                                               brand='testbrand',
@@ -141,6 +897,285 @@ class UserLoggedIn(TestCase):
         self.assertContains(request, "Ingrédients")
 
 
+class ExportTests(TestCase):
+    def setUp(self):
+        """ Setting up categorized products, a user with favorites and a staff member for TestCase
+                                                """
+        self.laits = Categories.objects.create(name='Laits', url='http://test.com', off_id='en:milks')
+        self.bio = Categories.objects.create(name='Bio', url='http://test.com', off_id='en:organic')
+        self.products = [Product.objects.create(name='lait {0}'.format(i), brand='Lactel', nutriscore='b',
+                                                barcode='30{0}'.format(i)) for i in range(5)]
+        for product in self.products:
+            product.categories.add(self.laits)
+        self.products[0].categories.add(self.bio)
+        self.user = User.objects.create_user(username='Patrick', password='machin')
+        for product in (self.products[3], self.products[1]):
+            SavedProduct.objects.create(saved_by=self.user, saved_product=product)
+        other = User.objects.create_user(username='Bob', password='machin')
+        SavedProduct.objects.create(saved_by=other, saved_product=self.products[0])
+        self.staff = User.objects.create_user(username='Admin', password='machin', is_staff=True)
+
+    def download(self, url):
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode('utf8')
+
+    def test_favorites_csv(self):
+        """ Testing that a user downloads their own favorites, in the order they were saved
+                                                """
+        self.assertEqual(self.client.get(reverse('saved-products-export', args=['csv'])).status_code, 302)
+        self.client.force_login(self.user)
+        response, content = self.download(reverse('saved-products-export', args=['csv']))
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('favoris.csv', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([(row['name'], row['barcode']) for row in rows], [('lait 3', '303'), ('lait 1', '301')])
+        self.assertEqual(self.client.get(reverse('saved-products-export', args=['xml'])).status_code, 404)
+
+    def test_catalog_jsonl(self):
+        """ Testing that the staff downloads the whole catalog with the categories of every product
+                                                """
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('catalog-export', args=['jsonl'])).status_code, 302)
+        self.client.force_login(self.staff)
+        response, content = self.download(reverse('catalog-export', args=['jsonl']))
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [product.id for product in self.products])
+        self.assertEqual(rows[0]['categories'], ['Bio', 'Laits'])
+        self.assertEqual(rows[1]['categories'], ['Laits'])
+
+    def test_streamed_by_chunks(self):
+        """ Testing that the CSV header comes before any query, and that the categories are read once per chunk
+                                                """
+        with self.assertNumQueries(0):
+            lines = export_lines(catalog_rows(chunk_size=2), CATALOG_FIELDS, 'csv')
+            self.assertEqual(next(lines), 'id,name,brand,nutriscore,barcode,url,ingredients,image,categories\r\n')
+        with self.assertNumQueries(4):
+            lines = list(lines)
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].endswith(',Bio|Laits\r\n'))
+
+
+@override_settings(SAVE_COUNT_FLUSH_INTERVAL=3600)
+class FavoritesTests(TestCase):
+    def setUp(self):
+        """ Setting up products and a user for the favorites endpoint
+                                                """
+        save_counts.flush()
+        self.factory = RequestFactory()
+        self.products = [Product.objects.create(name='favorite {0}'.format(i), nutriscore='a') for i in range(3)]
+        self.user = User.objects.create(username='Patrick', email='patrick@yahoo.com', password='machin')
+
+    def post(self, data, user=None):
+        request = self.factory.post(reverse('pur-beurre-favorites'), json.dumps(data),
+                                    content_type='application/json')
+        request.user = user or self.user
+        return Favorites.as_view()(request)
+
+    def test_save_in_one_query(self):
+        """ Testing that saving several favorites is a single query, and that saving them again changes nothing
+                                                """
+        ids = [product.id for product in self.products[:2]]
+        with self.assertNumQueries(1):
+            response = self.post({'save': ids})
+        self.assertEqual(json.loads(response.content.decode()), {'saved': 2, 'removed': 0})
+        response = self.post({'save': ids + [ids[0]]})
+        self.assertEqual(json.loads(response.content.decode()), {'saved': 0, 'removed': 0})
+        self.assertEqual(sorted(SavedProduct.objects.values_list('saved_product_id', flat=True)), ids)
+
+    def test_unknown_products_ignored(self):
+        """ Testing that unknown product ids are skipped
+                                                """
+        response = self.post({'save': [self.products[0].id, 999999]})
+        self.assertEqual(json.loads(response.content.decode())['saved'], 1)
+        self.assertEqual(SavedProduct.objects.count(), 1)
+
+    def test_remove(self):
+        """ Testing removing favorites, only those of the user
+                                                """
+        other = User.objects.create(username='Bob', email='bob@yahoo.com', password='machin')
+        SavedProduct.objects.create(saved_by=self.user, saved_product=self.products[0])
+        SavedProduct.objects.create(saved_by=other, saved_product=self.products[0])
+        response = self.post({'remove': [self.products[0].id, self.products[1].id]})
+        self.assertEqual(json.loads(response.content.decode()), {'saved': 0, 'removed': 1})
+        self.assertEqual(list(SavedProduct.objects.values_list('saved_by_id', flat=True)), [other.id])
+
+    def test_anonymous_and_invalid(self):
+        """ Testing the 401 of anonymous users and the 400 of invalid ids
+                                                """
+        self.assertEqual(self.post({'save': [self.products[0].id]}, user=AnonymousUser()).status_code, 401)
+        self.assertEqual(self.post({'save': ['abc']}).status_code, 400)
+        self.assertEqual(self.post({'save': 12}).status_code, 400)
+        self.assertEqual(self.post({'save': list(range(101))}).status_code, 400)
+        self.assertFalse(SavedProduct.objects.exists())
+
+    def test_form_data(self):
+        """ Testing the form encoded requests through the client
+                                                """
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('pur-beurre-favorites'), {'save': [self.products[2].id]})
+        self.assertEqual(json.loads(response.content.decode()), {'saved': 1, 'removed': 0})
+
+    def test_substitutes_marked_saved(self):
+        """ Testing that the substitutes page renders the products already saved by the user as saved
+                                                """
+        base = Product.objects.create(name='favorite base', nutriscore='e')
+        for rank, product in enumerate(self.products, 1):
+            ProductSubstitute.objects.create(product=base, substitute=product, rank=rank)
+        SavedProduct.objects.create(saved_by=self.user, saved_product=self.products[1])
+        self.client.force_login(self.user)
+        html = self.client.get(reverse('pur-beurre-substitutes', args=[base.id])).content.decode('utf8')
+        self.assertEqual(html.count('data-saved="true"'), 1)
+        self.assertEqual(html.count('Sauvegardé'), 1)
+        self.assertIn('data-favorite="{0}" data-favorites-url="{1}"\n                          data-saved="true"'.format(
+            self.products[1].id, reverse('pur-beurre-favorites')), html)
+
+
+@override_settings(SAVE_COUNT_FLUSH_INTERVAL=3600, SAVE_COUNT_FLUSH_SIZE=100)
+class PopularityTests(TestCase):
+    def setUp(self):
+        """ Setting up products, users and a category for the save counters
+                                                """
+        cache.clear()
+        save_counts.flush()
+        self.factory = RequestFactory()
+        self.category = Categories.objects.create(name='popular', url='http://popular.com', off_id='en:popular')
+        self.products = [Product.objects.create(name='popular {0}'.format(i), nutriscore='a') for i in range(4)]
+        for product in self.products[:3]:
+            product.categories.add(self.category)
+        self.users = [User.objects.create(username='user {0}'.format(i), password='machin') for i in range(3)]
+
+    def favorites(self, user, data):
+        request = self.factory.post(reverse('pur-beurre-favorites'), json.dumps(data),
+                                    content_type='application/json')
+        request.user = user
+        return Favorites.as_view()(request)
+
+    def counts(self):
+        return [product.save_count for product in Product.objects.order_by('id')]
+
+    def test_buffered_counts(self):
+        """ Testing that the counts are written in one update per distinct change when the buffer is flushed
+                                                """
+        for user in self.users:
+            self.favorites(user, {'save': [self.products[0].id, self.products[1].id]})
+        self.favorites(self.users[0], {'save': [self.products[2].id, self.products[3].id],
+                                       'remove': [self.products[1].id]})
+        self.assertEqual(self.counts(), [0, 0, 0, 0])
+        with self.assertNumQueries(3):
+            self.assertEqual(save_counts.flush(), 4)
+        self.assertEqual(self.counts(), [3, 2, 1, 1])
+
+    def test_flush_size(self):
+        """ Testing that the buffer is written once enough products changed
+                                                """
+        with self.settings(SAVE_COUNT_FLUSH_SIZE=2):
+            self.favorites(self.users[0], {'save': [self.products[0].id]})
+            self.assertEqual(self.counts(), [0, 0, 0, 0])
+            self.favorites(self.users[0], {'save': [self.products[1].id]})
+        self.assertEqual(self.counts(), [1, 1, 0, 0])
+
+    def test_reconcile(self):
+        """ Testing that the reconciliation fixes the drifted counts only
+                                                """
+        SavedProduct.objects.create(saved_by=self.users[0], saved_product=self.products[0])
+        SavedProduct.objects.create(saved_by=self.users[1], saved_product=self.products[0])
+        Product.objects.filter(id=self.products[3].id).update(save_count=5)
+        out = StringIO()
+        call_command('reconcile_save_counts', stdout=out)
+        self.assertIn('2 compteurs corrigés', out.getvalue())
+        self.assertEqual(self.counts(), [2, 0, 0, 0])
+
+    def test_most_saved(self):
+        """ Testing the cached most saved lists, of the catalog and of a category
+                                                """
+        Product.objects.filter(id=self.products[1].id).update(save_count=4)
+        Product.objects.filter(id=self.products[3].id).update(save_count=9)
+        Product.objects.filter(id=self.products[2].id).update(save_count=4, is_active=False)
+        self.assertEqual(most_saved(), [self.products[3].id, self.products[1].id])
+        self.assertEqual(most_saved(self.category.id), [self.products[1].id])
+        Product.objects.filter(id=self.products[0].id).update(save_count=20)
+        with self.assertNumQueries(0):
+            self.assertEqual(most_saved(self.category.id), [self.products[1].id])
+        response = self.client.get(reverse('api-most-saved'), {'fields': 'id,save_count', 'limit': 2})
+        self.assertEqual(json.loads(response.content.decode())['results'],
+                         [{'id': self.products[0].id, 'save_count': 20}, {'id': self.products[3].id, 'save_count': 9}])
+
+    def test_popular_ordering(self):
+        """ Testing the ordering of the search results and of the substitutes by popularity
+                                                """
+        Product.objects.filter(id=self.products[2].id).update(save_count=7)
+        response = self.client.get(reverse('pur-beurre-results'), {'food': 'popular', 'order': 'popular'})
+        self.assertEqual([food.id for food in response.context['queryset']][0], self.products[2].id)
+        base = Product.objects.create(name='base', nutriscore='e')
+        for rank, product in enumerate(self.products[:3]):
+            ProductSubstitute.objects.create(product=base, substitute=product, rank=rank)
+        response = self.client.get(reverse('pur-beurre-substitutes', args=[base.id]))
+        self.assertEqual([food.id for food in response.context['queryset']], [p.id for p in self.products[:3]])
+        response = self.client.get(reverse('pur-beurre-substitutes', args=[base.id]), {'order': 'popular'})
+        self.assertEqual([food.id for food in response.context['queryset']],
+                         [self.products[2].id, self.products[0].id, self.products[1].id])
+
+    def test_save_views_count(self):
+        """ Testing that the save form and the delete view update the counts
+                                                """
+        self.client.force_login(self.users[0])
+        self.client.post(reverse('pur-beurre-save'), {'food_id': self.products[0].id})
+        save_counts.flush()
+        self.assertEqual(self.counts()[0], 1)
+        saved = SavedProduct.objects.get()
+        self.client.post(reverse('save-delete', args=[saved.id]))
+        save_counts.flush()
+        self.assertEqual(self.counts()[0], 0)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['users.backends.CachedModelBackend'])
+class SessionCacheTests(TestCase):
+    def setUp(self):
+        """ Setting up a user logged in through the cached backend for TestCase
+                                                """
+        cache.clear()
+        self.user = User.objects.create_user(username='Patrick', email='patrick@yahoo.com', password='machin')
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_no_auth_queries(self):
+        """ Testing that an authenticated request reads neither its session nor its user from the database
+                                                """
+        self.client.login(username='Patrick', password='machin')
+        self.client.get(reverse('profile'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('profile'))
+        self.assertContains(response, 'patrick@yahoo.com')
+
+    def test_user_invalidation(self):
+        """ Testing that a password change or a deactivation applies to the next request
+                                                """
+        self.client.login(username='Patrick', password='machin')
+        self.assertEqual(self.client.get(reverse('profile')).status_code, 200)
+        user = User.objects.get()
+        user.set_password('autre')
+        user.save()
+        self.assertEqual(self.client.get(reverse('profile')).status_code, 302)
+        self.client.login(username='Patrick', password='autre')
+        user = User.objects.get()
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get(reverse('profile')).status_code, 302)
+
+    def test_clear_expired_sessions(self):
+        """ Testing that the expired sessions are deleted by batches, the others kept
+                                                """
+        now = timezone.now()
+        Session.objects.bulk_create([Session(session_key='expired{0}'.format(i), session_data='',
+                                             expire_date=now - timedelta(days=1)) for i in range(5)] +
+                                    [Session(session_key='valid', session_data='', expire_date=now + timedelta(days=1))])
+        out = StringIO()
+        with self.assertNumQueries(6):
+            call_command('clear_expired_sessions', batch_size=2, stdout=out)
+        self.assertIn('5 sessions expirées supprimées', out.getvalue())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['valid'])
+
+
 class AnonUser(TestCase):
     def setUp(self):
         """ Setting up an anonymous user for TestCase
@@ -181,6 +1216,7 @@ class AnonUser(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
 class FillDatabase(TestCase):
     def setUp(self):
         """ Setting up a script to test for TestCase
@@ -194,16 +1230,6 @@ class FillDatabase(TestCase):
         response = self.command.category_request_api()
         self.assertTrue(get.called)
 
-    @patch('requests.get')
-    def test_food_request(self, get):
-        """ Testing if the product request is correctly called by a get request
-                        """
-        category = MagicMock()
-        category.off_id = 'test'
-
-        response = self.command.food_request(category)
-        self.assertTrue(get.called)
-
     def test_cat_to_db(self):
         """ Testing if the category data is correctly saved into the database
                         """
@@ -217,7 +1243,8 @@ class FillDatabase(TestCase):
         self.assertEqual(Categories.objects.count(), 1)
 
     def test_food_to_db(self):
-        """ Testing if the food data is correctly saved into the database
+        """ Testing that the products written row by row are parsed as in a batched import, each one in its own
+        transaction
                                 """
         request_dict = {'products': [
             {'product_name': 'test',
@@ -225,28 +1252,612 @@ class FillDatabase(TestCase):
              'brands': 'testb',
              'nutrition_grades': 'B',
              'ingredients_text': 'testdescription',
-             'url': 'http://test.com',
              'image_url': 'http://testimage.com',
-             'categories': 'test1, test2'}
+             'last_modified_t': 1575000000,
+             'categories': 'Biscuits, Chocolats'}
         ]}
-        self.command.save_food_to_db(request_dict)
-        f = Product.objects.first()
-        self.assertEqual(Product.objects.count(), 1)
+        writer = BulkProductWriter(batch_size=1)
+        self.command.bulk_save_food_to_db(request_dict, writer)
+        self.assertFalse(writer.pending)
+        product = Product.objects.get()
+        self.assertEqual(product.barcode, '298392')
+        self.assertEqual(product.last_modified_t, 1575000000)
+        self.assertEqual(product.openfoodfacts_link, 'testdescription')
+        self.assertEqual(product.categories.count(), 2)
 
-    def test_add_entry_to_db(self):
-        """ Testing if the product data entry is created for the database
+    def test_bulk_food_to_db(self):
+        """ Testing that the batched writer saves the products and their categories once, with a fixed number of
+        queries per batch
                                 """
-        name = 'testname'
-        brand = 'testbrand'
-        nutriscore = 'A'
-        itemcode = '389289'
-        image = 'http://www.test.com'
-        url = 'http://testurl.com'
-        openfoodfacts_link = 'http://offtestlink.com'
-
-        self.command.add_to_db(name, brand, nutriscore, itemcode,
-                               image, url, openfoodfacts_link)
+        request_dict = {'products': [
+            {'product_name': 'test {0}'.format(i),
+             'code': str(298390 + i),
+             'brands': 'testb',
+             'nutrition_grades': 'b',
+             'image_url': 'http://testimage.com',
+             'categories': 'alpha, beta'} for i in range(10)
+        ] + [{'product_name': '', 'code': '1'}]}
+        writer = BulkProductWriter(batch_size=4)
+        with self.assertNumQueries(20):
+            self.command.bulk_save_food_to_db(request_dict, writer)
+            writer.flush()
+        self.assertEqual(Product.objects.count(), 10)
+        self.assertEqual(Categories.objects.count(), 2)
+        self.assertEqual(Product.categories.through.objects.count(), 20)
+        product = Product.objects.get(description='298390')
+        self.assertEqual(product.nutriscore, 'B')
+        self.assertEqual(product.itemcode, 'https://fr.openfoodfacts.org/produit/298390')
+
+        writer = BulkProductWriter(batch_size=4)
+        self.command.bulk_save_food_to_db(request_dict, writer)
+        writer.flush()
+        self.assertEqual(Product.objects.count(), 10)
+        self.assertEqual(len(writer.product_ids), 10)
+
+    def test_parse_food(self):
+        """ Testing the cleaning of an Open Food Facts product
+                                """
+        fields, categories = parse_food({'product_name': 'Pâte à tartiner 1kg', 'code': '3017620422003',
+                                         'brands': 'Nutella, Ferrero', 'categories': 'Petit-déjeuners,, Pâtes'})
+        self.assertEqual(fields['name'], 'Pâte À Tartiner Kg')
+        self.assertEqual(fields['brand'], 'Nutella Ferrero')
+        self.assertEqual(fields['nutriscore'], 'Z')
+        self.assertEqual(categories, ['Petitdéjeuners', 'Pâtes'])
+        self.assertIsNone(parse_food({'product_name': 'Sans code'}))
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class DeduplicationTests(TestCase):
+    def setUp(self):
+        """ Setting up a category known by its Open Food Facts id for TestCase
+        """
+        self.spreads = Categories.objects.create(name='Pâtes À Tartiner', off_id='en:spreads')
+
+    def test_canonical_keys(self):
+        """ Testing that spelling, accent and locale variants of a category share their key
+        """
+        self.assertEqual({category_key(name) for name in ('en:orange-juices', 'Orange Juices', ' orangejuices ',
+                                                          'fr:orange-juices')}, {'orangejuices'})
+        self.assertEqual(category_key('Pâtes à tartiner'), category_key('Pates-A-Tartiner'))
+        fields, categories = parse_food({'product_name': 'Jus  d\'orange', 'code': '1234',
+                                         'categories': 'Jus d\'orange, Jus  Dorange,Boissons'})
+        self.assertEqual(fields['name'], 'Jus Dorange')
+        self.assertEqual(categories, ['Jus Dorange', 'Boissons'])
+        fields, categories = parse_food({'product_name': 'Purée', 'code': '1235',
+                                         'categories_tags': 'en:mashed-potatoes,fr:purees'})
+        self.assertEqual(categories, ['Mashed Potatoes', 'Purees'])
+
+    def test_writer_merges_aliases_and_duplicates(self):
+        """ Testing that category variants are linked to the known category, and that a product met again is
+        merged without any query
+        """
+        food = {'product_name': 'Nutella', 'code': '3017620422003', 'nutrition_grades': 'e',
+                'categories': 'Pâtes à tartiner, Spreads, Petit-déjeuners, Petit déjeuners'}
+        writer = BulkProductWriter(batch_size=1)
+        writer.add(*parse_food(food))
+        with self.assertNumQueries(0):
+            writer.add(*parse_food(dict(food, categories='Spreads')))
         self.assertEqual(Product.objects.count(), 1)
+        self.assertEqual(sorted(Categories.objects.values_list('name', flat=True)),
+                         ['Petitdéjeuners', 'Pâtes À Tartiner'])
+        self.assertEqual(Product.categories.through.objects.count(), 2)
+        self.assertEqual((writer.written, writer.duplicates), (1, 1))
+
+    def test_categories_api_completes_known_category(self):
+        """ Testing that a category created from the products gets its Open Food Facts id rather than a twin
+        """
+        Categories.objects.create(name='Jus Dorange')
+        fill_database.Command().save_cat_to_db({'tags': [
+            {'name': "Jus d'orange", 'url': 'http://test.com', 'products': 12, 'id': 'fr:jus-d-orange'}]})
+        self.assertEqual(Categories.objects.count(), 2)
+        self.assertEqual(Categories.objects.get(name='Jus Dorange').off_id, 'fr:jus-d-orange')
+
+    def test_dedupe_catalog(self):
+        """ Testing the merge of the duplicates left by the older imports
+        """
+        twin = Categories.objects.create(name='Patesatartiner')
+        other = Categories.objects.create(name='Spreads')
+        product = Product.objects.create(name='Nutella', nutriscore='E', barcode='3017620422003')
+        copy = Product.objects.create(name='Nutella', nutriscore='E', description='3017620422003')
+        copy.categories.add(twin, other)
+        user = User.objects.create(username='Patrick', password='machin')
+        SavedProduct.objects.create(saved_by=user, saved_product=copy)
+        out = StringIO()
+        call_command('dedupe_catalog', dry_run=True, stdout=out)
+        self.assertIn('2 catégories et 1 produits en double', out.getvalue())
+        self.assertEqual(Categories.objects.count(), 3)
+        call_command('dedupe_catalog', stdout=StringIO())
+        self.assertEqual(list(Categories.objects.values_list('id', flat=True)), [self.spreads.id])
+        self.assertEqual(list(Product.objects.values_list('id', flat=True)), [product.id])
+        self.assertEqual(list(product.categories.all()), [self.spreads])
+        self.assertEqual(SavedProduct.objects.get().saved_product_id, product.id)
+        self.assertEqual(Product.objects.get().save_count, 1)
+
+    def test_dedupe_fills_legacy_barcodes(self):
+        """ Testing that a product merged into a product without barcode gives it its legacy barcode
+        """
+        first = Product.objects.create(name='Nutella', nutriscore='E', description='3017620422003')
+        Product.objects.create(name='Nutella', nutriscore='E', itemcode=OPENFOODFACTS_PRODUCT_URL + '3017620422003')
+        out = StringIO()
+        call_command('dedupe_catalog', stdout=out)
+        self.assertIn('1 codes-barres renseignés', out.getvalue())
+        self.assertEqual(list(Product.objects.values_list('id', 'barcode')), [(first.id, '3017620422003')])
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class PurgeCatalogTests(TestCase):
+    def setUp(self):
+        """ Setting up categories and products of every purged kind for TestCase
+        """
+        self.imported = Categories.objects.create(name='Laits', off_id='en:milks')
+        self.shared = Categories.objects.create(name='Laits Bio')
+        self.single = Categories.objects.create(name='Lait De Ma Ferme')
+        self.unused = Categories.objects.create(name='Vide')
+        self.kept = [Product.objects.create(name='Lait {0}'.format(i), nutriscore='B') for i in range(2)]
+        for product in self.kept:
+            product.categories.add(self.imported, self.shared)
+        self.kept[0].categories.add(self.single)
+        self.empty = Product.objects.create(name='Inconnu', nutriscore='Z')
+        self.gone = Product.objects.create(name='Disparu', nutriscore='A', is_active=False, missing_since=1)
+        self.gone.categories.add(self.imported)
+        self.recent = Product.objects.create(name='Récent', nutriscore='A', is_active=False, missing_since=3)
+        self.recent.categories.add(self.imported)
+        self.saved = Product.objects.create(name='Sauvegardé', nutriscore='Z')
+        self.user = User.objects.create(username='Patrick', password='machin')
+        SavedProduct.objects.create(saved_by=self.user, saved_product=self.saved)
+        SyncState.objects.create(source='openfoodfacts', full_syncs=3)
+
+    def purge(self, **options):
+        out = StringIO()
+        call_command('purge_catalog', missed_syncs=2, batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_dry_run(self):
+        """ Testing that a dry run only reports
+        """
+        out = self.purge(dry_run=True)
+        self.assertIn("1 produits absents d'Open Food Facts à supprimer", out)
+        self.assertIn("1 produits sans nutriscore ni catégorie à supprimer, 1 gardés car sauvegardés", out)
+        self.assertIn("2 catégories de moins de 2 produits à supprimer", out)
+        self.assertEqual(Product.objects.count(), 6)
+        self.assertEqual(Categories.objects.count(), 4)
+
+    def test_purge(self):
+        """ Testing the purge of every kind, the saved products and the imported categories being kept
+        """
+        self.purge()
+        self.assertEqual(set(Product.objects.values_list('id', flat=True)),
+                         {self.kept[0].id, self.kept[1].id, self.recent.id, self.saved.id})
+        self.assertEqual(set(Categories.objects.values_list('id', flat=True)), {self.imported.id, self.shared.id})
+        self.assertEqual(SavedProduct.objects.count(), 1)
+
+    def test_include_saved(self):
+        """ Testing that the saved products go only when asked for, with their saves
+        """
+        self.purge(include_saved=True, min_products=0)
+        self.assertFalse(Product.objects.filter(id=self.saved.id).exists())
+        self.assertFalse(SavedProduct.objects.exists())
+        self.assertEqual(Categories.objects.count(), 4)
+
+    def test_full_sync_counts(self):
+        """ Testing that a complete full sync numbers itself and marks the products it deactivates
+        """
+        product = Product.objects.create(name='Lait', nutriscore='B', barcode='301')
+        deactivate_missing(set(), sync=4)
+        product.refresh_from_db()
+        self.assertEqual((product.is_active, product.missing_since), (False, 4))
+        writer = BulkProductWriter(upsert=True)
+        writer.add(*parse_food({'product_name': 'Lait', 'code': '301', 'categories': 'Laits'}))
+        writer.flush()
+        product.refresh_from_db()
+        self.assertEqual((product.is_active, product.missing_since), (True, None))
 
 
+class StubOpenFoodFactsHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for the Open Food Facts search API: every category holds 25 products, and the first request
+    for a page of the "flaky" category fails
+    """
+    failed = set()
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        category, page, page_size = params['tag_0'], int(params['page']), int(params['page_size'])
+        if category == 'flaky' and (category, page) not in self.failed:
+            self.failed.add((category, page))
+            self.send_response(503)
+            self.end_headers()
+            return
+        codes = range((page - 1) * page_size, min(page * page_size, 25))
+        body = json.dumps({'count': 25, 'products': [
+            {'product_name': '{0} produit'.format(category), 'code': '{0}{1}'.format(category, code),
+             'brands': 'marque', 'nutrition_grades': 'a', 'categories': category} for code in codes
+        ]}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class OpenFoodFactsFetcherTests(TestCase):
+    def setUp(self):
+        """ Starting the stub Open Food Facts server for TestCase
+        """
+        StubOpenFoodFactsHandler.failed = set()
+        self.server = HTTPServer(('127.0.0.1', 0), StubOpenFoodFactsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{0}/cgi/search.pl'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_every_page(self):
+        """ Testing that every page of every category is fetched, retrying the failed requests
+        """
+        categories = [Categories(name=name, off_id=name) for name in ('laits', 'flaky')]
+        fetcher = OpenFoodFactsFetcher(search_url=self.url, workers=3, page_size=10, rate=0, backoff=0.01)
+        with self.assertLogs('pur_beurre.openfoodfacts', 'WARNING'):
+            pages = list(fetcher.fetch(categories))
+        self.assertEqual(len(pages), 6)
+        self.assertFalse([page for page in pages if page.error])
+        self.assertEqual(sum(len(page.products) for page in pages), 50)
+
+    def test_max_pages_and_errors(self):
+        """ Testing that the pages are capped per category, and that a page failing every attempt is reported
+        """
+        categories = [Categories(name=name, off_id=name) for name in ('laits', 'flaky')]
+        fetcher = OpenFoodFactsFetcher(search_url=self.url, workers=2, page_size=10, max_pages=2, rate=0,
+                                       retries=0)
+        pages = list(fetcher.fetch(categories))
+        self.assertEqual(sorted((page.category.off_id, page.number) for page in pages if not page.error),
+                         [('laits', 1), ('laits', 2)])
+        self.assertEqual([page.category.off_id for page in pages if page.error], ['flaky'])
+
+    def test_rate_limiter(self):
+        """ Testing that the rate limiter spaces the requests
+        """
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for i in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_fill_database(self):
+        """ Testing the whole import against the stub server
+        """
+        Categories.objects.create(name='Laits', url='http://test.com', off_id='laits')
+        with patch.object(fill_database.Command, 'category_request_api', return_value={'tags': []}):
+            call_command('fill_database', search_url=self.url, page_size=10, rate=0, stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 25)
+        self.assertEqual(Categories.objects.get(name='Laits').product_set.count(), 25)
+
+    def test_budget_and_resume(self):
+        """ Testing that an import stops once its budget is spent, and that resuming it fetches what was left
+        """
+        for name in ('laits', 'beurres'):
+            Categories.objects.create(name=name, url='http://test.com', off_id=name)
+        out = StringIO()
+        with patch.object(fill_database.Command, 'category_request_api', return_value={'tags': []}):
+            call_command('fill_database', search_url=self.url, page_size=10, rate=0, workers=1, max_rows=10,
+                         stdout=out)
+        job = IngestionJob.objects.get()
+        self.assertEqual(job.status, IngestionJob.PAUSED)
+        self.assertIn("reprendra avec --resume", out.getvalue())
+        self.assertEqual(Product.objects.count(), 10)
+
+        with patch.object(fill_database.Command, 'category_request_api') as category_request_api:
+            call_command('fill_database', search_url=self.url, page_size=10, rate=0, resume=True, stdout=out)
+        category_request_api.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.invocations, job.rows), (IngestionJob.DONE, 2, 50))
+        self.assertEqual(sorted(job.categories.values_list('status', 'pages', 'rows')),
+                         [(IngestionCategory.DONE, 3, 25)] * 2)
+        self.assertEqual(Product.objects.count(), 50)
+        with self.assertRaises(CommandError):
+            call_command('fill_database', resume=True, stdout=out)
+
 
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class SyncTests(TestCase):
+    def setUp(self):
+        """ Setting up an upstream catalog of three products, by barcode, for TestCase
+        """
+        self.category = Categories.objects.create(name='Laits', url='http://test.com', off_id='en:milks')
+        self.upstream = {
+            '301': {'product_name': 'Lait entier', 'nutrition_grades': 'c', 'last_modified_t': 1000},
+            '302': {'product_name': 'Lait demi écrémé', 'nutrition_grades': 'b', 'last_modified_t': 1100},
+            '303': {'product_name': 'Lait de coco', 'nutrition_grades': 'd', 'last_modified_t': 1200},
+        }
+        self.asked = []
+        self.fetched = []
+        self.failing = set()
+
+    def fetch(self, fetcher, categories):
+        """ Stand-in for OpenFoodFactsFetcher.fetch serving the upstream catalog, failing the categories in
+        `self.failing`
+        """
+        self.asked.append(fetcher.newer_than)
+        categories = list(categories)
+        self.fetched.append([category.off_id for category in categories])
+        products = [dict(food, code=code, categories='Laits') for code, food in self.upstream.items()
+                    if fetcher.newer_than is None or food['last_modified_t'] > fetcher.newer_than]
+        for category in categories:
+            if category.off_id in self.failing:
+                yield Page(category, 1, [], 0, requests.HTTPError('503 Service Unavailable'))
+            else:
+                yield Page(category, 1, products, len(products), None)
+
+    def sync(self, **options):
+        out = StringIO()
+        with patch.object(fill_database.Command, 'category_request_api', return_value={'tags': []}), \
+                patch.object(OpenFoodFactsFetcher, 'fetch', autospec=True, side_effect=self.fetch):
+            call_command('fill_database', sync=True, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_delta_sync(self):
+        """ Testing that a first sync imports everything, that the next ones only ask for newer products and
+        update the changed ones, and that a full sync soft deletes the products gone upstream
+        """
+        self.assertIn("3 produits créés, 0 mis à jour, 0 inchangés, 0 désactivés", self.sync())
+        self.assertEqual(SyncState.objects.get(source='openfoodfacts').watermark, 1200)
+        coconut = Product.objects.get(barcode='303')
+        self.assertEqual((coconut.name, coconut.last_modified_t, coconut.is_active), ('Lait De Coco', 1200, True))
+
+        self.upstream['302'].update(product_name='Lait demi écrémé bio', nutrition_grades='a', last_modified_t=1300)
+        del self.upstream['303']
+        self.assertIn("0 produits créés, 1 mis à jour, 0 inchangés, 0 désactivés", self.sync())
+        self.assertEqual(self.asked, [None, 1200])
+        self.assertEqual(Product.objects.get(barcode='302').nutriscore, 'A')
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(SyncState.objects.get(source='openfoodfacts').watermark, 1300)
+
+        self.assertIn("0 produits créés, 0 mis à jour, 2 inchangés, 1 désactivés", self.sync(full=True))
+        self.assertFalse(Product.objects.get(barcode='303').is_active)
+        self.assertEqual(list(search_products('lait').values_list('barcode', flat=True).order_by('barcode')),
+                         ['301', '302'])
+
+    def test_failed_category_resumed(self):
+        """ Testing that a sync with a failed category keeps its watermark, and that resuming it only asks for that
+        category again before recording the watermark
+        """
+        Categories.objects.create(name='Beurres', url='http://test.com', off_id='en:butters')
+        self.failing = {'en:butters'}
+        self.sync()
+        job = IngestionJob.objects.get()
+        self.assertEqual((job.status, job.errors), (IngestionJob.FAILED, 1))
+        self.assertEqual(job.categories.get(category__off_id='en:butters').last_error, '503 Service Unavailable')
+        self.assertEqual(SyncState.objects.get(source='openfoodfacts').watermark, 0)
+
+        self.failing = set()
+        self.sync(resume=True)
+        self.assertEqual(self.fetched[-1], ['en:butters'])
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.DONE)
+        self.assertEqual(SyncState.objects.get(source='openfoodfacts').watermark, 1200)
+
+    def test_unchanged_products_are_not_written(self):
+        """ Testing that upserting products that did not change upstream runs no write query
+        """
+        foods = [parse_food(dict(food, code=code, categories='Laits')) for code, food in self.upstream.items()]
+        writer = BulkProductWriter(upsert=True)
+        for fields, categories in foods:
+            writer.add(fields, categories)
+        writer.flush()
+        writer = BulkProductWriter(upsert=True)
+        for fields, categories in foods:
+            writer.add(fields, categories)
+        with CaptureQueriesContext(connection) as context:
+            writer.flush()
+        self.assertEqual([query['sql'] for query in context.captured_queries
+                          if query['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')], [])
+        self.assertEqual((writer.created, writer.updated, writer.unchanged), (0, 0, 3))
+
+    def test_newer_pages(self):
+        """ Testing that a sync browses the pages one by one until it reaches products older than its watermark
+        """
+        fetcher = OpenFoodFactsFetcher(page_size=2, newer_than=100)
+        self.assertEqual(fetcher.page_params(self.category, 1)['sort_by'], 'last_modified_t')
+        self.assertEqual(list(fetcher.next_pages(Page(self.category, 1, [{}, {}], 10, None))), [2])
+        self.assertEqual(list(fetcher.next_pages(Page(self.category, 2, [{}], 10, None))), [])
+        self.assertEqual(list(OpenFoodFactsFetcher(page_size=2).next_pages(Page(self.category, 1, [{}], 10, None))),
+                         [2, 3, 4, 5])
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class ImportOffDumpTests(TestCase):
+    def setUp(self):
+        """ Writing small compressed JSONL and CSV exports for TestCase
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.products = [
+            {'code': '1', 'product_name': 'Pâte à tartiner', 'brands': 'Nutella', 'nutrition_grades': 'e',
+             'categories': 'Pâtes à tartiner', 'categories_tags': ['en:spreads'], 'countries_tags': ['en:france']},
+            {'code': '2', 'product_name': 'Purée', 'brands': 'Mousline', 'nutrition_grades': 'a',
+             'categories': 'Purées', 'categories_tags': ['en:mashed-potatoes'], 'countries_tags': ['en:france']},
+            {'code': '3', 'product_name': 'Peanut butter', 'brands': 'Skippy', 'nutrition_grades': 'unknown',
+             'categories': 'Spreads', 'categories_tags': ['en:spreads'], 'countries_tags': ['en:united-states']},
+        ]
+        self.jsonl = os.path.join(self.directory.name, 'products.jsonl.gz')
+        with gzip.open(self.jsonl, 'wt', encoding='utf8') as dump:
+            for product in self.products:
+                dump.write(json.dumps(product) + '\n')
+            dump.write('{not json\n')
+        self.csv = os.path.join(self.directory.name, 'products.csv.gz')
+        with gzip.open(self.csv, 'wt', encoding='utf8') as dump:
+            dump.write('code\tproduct_name\tbrands\tnutriscore_grade\tcategories\tcategories_tags\tcountries_tags\n')
+            for product in self.products:
+                dump.write('\t'.join([product['code'], product['product_name'], product['brands'],
+                                      product['nutrition_grades'], product['categories'],
+                                      ','.join(product['categories_tags']),
+                                      ','.join(product['countries_tags'])]) + '\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_import_jsonl(self):
+        """ Testing the import of a whole JSONL export, the invalid lines being skipped
+        """
+        call_command('import_off_dump', self.jsonl, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(Product.objects.get(description='2').nutriscore, 'A')
+        self.assertEqual(Product.objects.get(description='3').nutriscore, 'Z')
+        fields, categories = parse_food({'code': '4', 'product_name': 'Eau', 'nutrition_grades': 'not-applicable'})
+        self.assertEqual(fields['nutriscore'], 'Z')
+
+    def test_import_csv_with_filters(self):
+        """ Testing the country, category and nutriscore filters on a CSV export
+        """
+        call_command('import_off_dump', self.csv, country=['en:france'], stdout=StringIO())
+        self.assertEqual(sorted(Product.objects.values_list('description', flat=True)), ['1', '2'])
+        Product.objects.all().delete()
+        call_command('import_off_dump', self.csv, category=['en:spreads'], with_nutriscore=True,
+                     stdout=StringIO())
+        self.assertEqual(list(Product.objects.values_list('name', flat=True)), ['Pâte À Tartiner'])
+
+
+@override_settings(AUTOCOMPLETE_INDEX_PATH=TEST_AUTOCOMPLETE_INDEX)
+class CatalogFixtureTests(TestCase):
+    def test_iter_json_array(self):
+        """ Testing that the items of a JSON array are parsed across chunk boundaries
+        """
+        stream = StringIO(json.dumps([{'pk': i, 'name': 'é' * i} for i in range(50)]))
+        items = list(iter_json_array(stream, chunk_size=7))
+        self.assertEqual([item['pk'] for item in items], list(range(50)))
+        self.assertEqual(list(iter_json_array(StringIO('[ ]'))), [])
+
+    def test_load_shipped_fixture(self):
+        """ Testing that the shipped fixture loads completely, and that new rows get fresh ids afterwards
+        """
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pur_beurre.json')
+        call_command('load_catalog', path, skip_substitutes=True, stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 1433)
+        self.assertEqual(Categories.objects.count(), 1046)
+        gazpacho = Product.objects.get(pk=1)
+        self.assertEqual(gazpacho.name, 'Gazpacho')
+        self.assertEqual(sorted(gazpacho.categories.values_list('pk', flat=True)), list(range(4, 15)))
+        self.assertGreater(Product.objects.create(name='nouveau').pk, 1433)
+
+    def test_dump_and_load_round_trip(self):
+        """ Testing that a dumped catalog loads back identically
+        """
+        user = User.objects.create(username='Patrick')
+        category = Categories.objects.create(name='Crèmes', url='http://test.com', off_id='en:creams')
+        product = Product.objects.create(name='Crème', nutriscore='B', brand='marque', description='3017620422003')
+        product.categories.add(category)
+        SavedProduct.objects.create(saved_by=user, saved_product=product)
+        output = StringIO()
+        self.assertEqual(dump_catalog(output, chunk_size=1), 3)
+        records = json.loads(output.getvalue())
+        self.assertEqual(records[1]['fields']['categories'], [category.pk])
+        self.assertNotIn('search_vector', records[1]['fields'])
+
+        Product.objects.all().delete()
+        Categories.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as fixture:
+            fixture.write(output.getvalue())
+        try:
+            call_command('load_catalog', fixture.name, stdout=StringIO())
+        finally:
+            os.remove(fixture.name)
+        self.assertEqual(Product.objects.get(pk=product.pk).categories.get(), category)
+        self.assertEqual(Product.objects.get(pk=product.pk).barcode, '3017620422003')
+        self.assertTrue(SavedProduct.objects.filter(saved_by=user, saved_product_id=product.pk).exists())
+
+
+class BenchmarkTests(TestCase):
+    def test_generate_catalog(self):
+        """ Testing that the synthetic catalog has the requested sizes and is the same for the same seed
+        """
+        product_ids, user_ids = generate_catalog(60, 10, 3, saved_per_user=5, seed=1)
+        self.assertEqual(Product.objects.count(), 60)
+        self.assertEqual(Categories.objects.count(), 10)
+        self.assertEqual(SavedProduct.objects.count(), 15)
+        self.assertTrue(ProductSubstitute.objects.exists())
+        first = list(Product.objects.order_by('id').values_list('name', 'nutriscore'))
+        clear_catalog()
+        generate_catalog(60, 10, 0, seed=1)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('name', 'nutriscore')), first)
+
+    def test_run_benchmark(self):
+        """ Testing the structure of the benchmark report, and that the configured cache is left alone
+        """
+        cache.set('kept', 1)
+        report = run_benchmark([(40, 8, 2)], iterations=3)
+        self.assertEqual(cache.get('kept'), 1)
+        self.assertEqual(report['environment']['database'], connection.vendor)
+        scenarios = report['sizes'][0]['scenarios']
+        self.assertEqual(sorted(scenarios), ['food', 'results', 'save', 'saved_products', 'substitutes'])
+        self.assertEqual(sorted(scenarios['results']),
+                         ['mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_max', 'queries_mean'])
+        self.assertEqual(scenarios['results']['queries_max'], 2)
+        self.assertFalse(Product.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "Les plans d'exécution sont ceux de PostgreSQL")
+class QueryPlanTests(TestCase):
+    """ Plan regression tests: the queries of the catalog views must use the indexes of the large tables
+    """
+    large_tables = ('pur_beurre_product', 'pur_beurre_product_categories', 'pur_beurre_productsubstitute',
+                    'pur_beurre_savedproduct')
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Seeding a synthetic catalog large enough for the planner to prefer the indexes, with fresh statistics
+        """
+        cls.product_ids, cls.user_ids = generate_catalog(10000, 300, 500, seed=2)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        cache.clear()
+
+    def sequential_scans(self, plan):
+        """ Returning the large tables read by a sequential scan somewhere in the plan
+        """
+        scans = []
+        if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in self.large_tables:
+            scans.append(plan['Relation Name'])
+        for child in plan.get('Plans', []):
+            scans.extend(self.sequential_scans(child))
+        return scans
+
+    def assertIndexedQueries(self, url, data=None, user=None):
+        if user:
+            self.client.force_login(user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+        queries = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('SELECT') and 'pur_beurre_' in query['sql']]
+        self.assertTrue(queries)
+        with connection.cursor() as cursor:
+            for sql in queries:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                plan = cursor.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                self.assertEqual(self.sequential_scans(plan[0]['Plan']), [], sql)
+
+    def test_results(self):
+        """ Testing the full-text research
+        """
+        self.assertIndexedQueries(reverse('pur-beurre-results'), {'food': 'Crème Vanille'})
+
+    def test_substitutes(self):
+        """ Testing the substitutes page
+        """
+        self.assertIndexedQueries(reverse('pur-beurre-substitutes', args=[self.product_ids[42]]))
+
+    def test_food(self):
+        """ Testing the product page
+        """
+        self.assertIndexedQueries(reverse('pur-beurre-food', args=[self.product_ids[42]]))
+
+    def test_saved_products(self):
+        """ Testing the favorites list
+        """
+        self.assertIndexedQueries(reverse('saved-products'), user=User.objects.get(id=self.user_ids[7]))
@@ -0,0 +1,240 @@
+"""Local thumbnails of the product images.
+
+The images of Open Food Facts are fetched in batch after the imports by a pluggable fetcher, the THUMBNAIL_FETCHER
+setting, and reduced to the fixed sizes of THUMBNAIL_SIZES. The thumbnails are stored on disk under the hash of
+the original image, so that products sharing an image share its files and a file never changes once written: they
+are served with far-future cache headers. The store is kept under THUMBNAIL_MAX_BYTES by evicting the least
+recently served files, whose products are then left without a thumbnail until the next fetch.
+
+A thumbnail missing from the disk of a server, evicted or written on another one, is marked as such by the first
+request for it, which is redirected to the original image, and made again by the next fetch.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from PIL import Image
+
+from pur_beurre.cache import bump_catalog_generation
+from pur_beurre.models import Product
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "PurBeurre - fetch_images"
+TOUCH_INTERVAL = 60 * 60
+TEMPORARY_MAX_AGE = 60 * 60
+
+THUMBNAIL_NAME = re.compile(r'^([0-9a-f]{64})-\w+\.(webp|jpg)$')
+
+
+class HttpImageFetcher:
+    """ Downloading the images over HTTP with one keep-alive session, refusing the too large ones
+    """
+    max_bytes = 5 * 1024 * 1024
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+
+    def fetch(self, url):
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            content = response.raw.read(self.max_bytes + 1, decode_content=True)
+        if len(content) > self.max_bytes:
+            raise ValueError("Image too large")
+        return content
+
+
+def get_fetcher():
+    return import_string(settings.THUMBNAIL_FETCHER)()
+
+
+class ThumbnailStore:
+    """ Content-addressed directory of thumbnails: <root>/<2 first hex digits>/<image hash>-<size>.<extension>
+    """
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or settings.THUMBNAIL_ROOT
+        self.max_bytes = max_bytes if max_bytes is not None else settings.THUMBNAIL_MAX_BYTES
+        self.format = settings.THUMBNAIL_FORMAT
+        self.extension = 'webp' if self.format == 'WEBP' else 'jpg'
+        self.content_type = 'image/webp' if self.format == 'WEBP' else 'image/jpeg'
+
+    def path(self, digest, size):
+        return os.path.join(self.root, digest[:2], '{0}-{1}.{2}'.format(digest, size, self.extension))
+
+    def add(self, content):
+        """ Writing the thumbnails of an image in every size, unless they are stored already. Returning the hash
+        of the image.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        missing = [size for size in settings.THUMBNAIL_SIZES if not os.path.exists(self.path(digest, size))]
+        if missing:
+            image = Image.open(io.BytesIO(content))
+            image.load()
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            if self.format != 'WEBP' and image.mode == 'RGBA':
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.split()[3])
+                image = background
+            for size in missing:
+                thumbnail = image.copy()
+                thumbnail.thumbnail(settings.THUMBNAIL_SIZES[size], Image.LANCZOS)
+                self.write(self.path(digest, size), thumbnail)
+        return digest
+
+    def write(self, path, image):
+        """ Writing a file atomically, so that a thumbnail is never served half written
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as thumbnail_file:
+            image.save(thumbnail_file, self.format, quality=80)
+        os.replace(temporary, path)
+
+    def open(self, digest, size):
+        """ Opening a thumbnail to serve it, marking it as recently used. Returning None when it was evicted.
+        """
+        path = self.path(digest, size)
+        try:
+            thumbnail_file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if os.fstat(thumbnail_file.fileno()).st_mtime < now - TOUCH_INTERVAL:
+            os.utime(path, (now, now))
+        return thumbnail_file
+
+    def exists(self, digest):
+        return all(os.path.exists(self.path(digest, size)) for size in settings.THUMBNAIL_SIZES)
+
+    def files(self):
+        """ Listing the files of the store as (name, path, stat) tuples
+        """
+        for directory, subdirectories, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    yield name, path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def evict(self):
+        """ Removing the least recently used thumbnails until the store fits in its size. Only the files named as
+        thumbnails are counted and removed. Returning the hashes of the images which lost a thumbnail.
+        """
+        files = []
+        total = 0
+        for name, path, stat in self.files():
+            match = THUMBNAIL_NAME.match(name)
+            if match:
+                files.append((stat.st_mtime, stat.st_size, path, match.group(1)))
+                total += stat.st_size
+        removed = set()
+        for mtime, size, path, digest in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.add(digest)
+        return removed
+
+    def remove_temporary_files(self, max_age=TEMPORARY_MAX_AGE):
+        """ Removing the temporary files left by writes interrupted more than `max_age` seconds ago. Returning
+        their number.
+        """
+        removed = 0
+        stale = time.time() - max_age
+        for name, path, stat in self.files():
+            if name.endswith('.tmp') and stat.st_mtime < stale:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+def forget_thumbnails(digests, batch_size=500):
+    """ Leaving the products whose thumbnails are these without any, for the next fetch to make them again, and
+    the cached pages linking them to be rendered again. Returning the number of products.
+    """
+    digests = list(digests)
+    forgotten = 0
+    for start in range(0, len(digests), batch_size):
+        forgotten += Product.objects.filter(thumbnail__in=digests[start:start + batch_size]).update(thumbnail=None)
+    if forgotten:
+        bump_catalog_generation()
+    return forgotten
+
+
+def evict_thumbnails(store=None):
+    """ Bringing the store back under its size and forgetting the evicted thumbnails. Returning the number of
+    images which lost a thumbnail.
+    """
+    store = store or ThumbnailStore()
+    store.remove_temporary_files()
+    digests = store.evict()
+    forget_thumbnails(digests)
+    return len(digests)
+
+
+def forget_missing_thumbnails(store=None):
+    """ Forgetting the thumbnails missing from the store of this server, written on another one or removed.
+    Returning the number of products left without a thumbnail.
+    """
+    store = store or ThumbnailStore()
+    digests = Product.objects.exclude(thumbnail__isnull=True).exclude(thumbnail='').values_list(
+        'thumbnail', flat=True).distinct()
+    return forget_thumbnails([digest for digest in digests.iterator() if not store.exists(digest)])
+
+
+def queue_thumbnail(digest):
+    """ Marking the products of a thumbnail missing from the store, for the next fetch to make it again. Returning
+    the number of products newly marked.
+    """
+    return Product.objects.filter(thumbnail=digest, thumbnail_missing=False).update(thumbnail_missing=True)
+
+
+def fetch_thumbnails(products, fetcher=None, store=None, workers=8, batch_size=200):
+    """ Fetching the images of the products and storing their thumbnails. The thumbnail hash of each product is
+    saved in batches, an empty one marking the images that could not be fetched or read. Returning the numbers of
+    stored and failed images.
+    """
+    fetcher = fetcher or get_fetcher()
+    store = store or ThumbnailStore()
+
+    def thumbnail(url):
+        if not url:
+            return ''
+        try:
+            return store.add(fetcher.fetch(url))
+        except (requests.RequestException, ValueError, OSError, Image.DecompressionBombError) as error:
+            logger.info("Image %s not fetched: %s", url, error)
+            return ''
+
+    stored = failed = 0
+    rows = list(products.values_list('id', 'image'))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            urls = sorted({image for product_id, image in batch})
+            digests = dict(zip(urls, executor.map(thumbnail, urls)))
+            Product.objects.bulk_update([Product(id=product_id, thumbnail=digests[image], thumbnail_missing=False)
+                                         for product_id, image in batch], ['thumbnail', 'thumbnail_missing'])
+            failed += sum(1 for product_id, image in batch if not digests[image])
+            stored += sum(1 for product_id, image in batch if digests[image])
+    evict_thumbnails(store)
+    return stored, failed
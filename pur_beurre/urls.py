@@ -1,14 +1,26 @@
+from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import path
-from . import views
+from . import api, views
 from .views import *
 
 urlpatterns = [
     path('', Index.as_view(), name='pur-beurre-index'),
     path('results/', Results.as_view(), name='pur-beurre-results'),
+    path('autocomplete/', Autocomplete.as_view(), name='pur-beurre-autocomplete'),
     path('substitutes/<int:id>', Substitutes.as_view(), name='pur-beurre-substitutes'),
     path('food/<int:id>', Food.as_view(), name='pur-beurre-food'),
+    path('thumbnails/<str:digest>/<str:size>', Thumbnail.as_view(), name='pur-beurre-thumbnail'),
+    path('favorites', Favorites.as_view(), name='pur-beurre-favorites'),
     path('save', SaveProduct.as_view(), name='pur-beurre-save'),
     path('legal_notices', Legal.as_view(), name='legal_notices'),
     path('saved_products/', login_required(views.UserSavedProductsList.as_view()), name='saved-products'),
     path('save/<int:pk>/delete/', views.SaveDelete.as_view(), name='save-delete'),
+    path('saved_products/export.<str:format>', login_required(views.FavoritesExport.as_view()),
+         name='saved-products-export'),
+    path('catalog/export.<str:format>', staff_member_required(views.CatalogExport.as_view()), name='catalog-export'),
+    path('api/v1/products/', api.ProductList.as_view(), name='api-products'),
+    path('api/v1/products/most-saved/', api.MostSavedProducts.as_view(), name='api-most-saved'),
+    path('api/v1/products/<int:id>', api.ProductDetail.as_view(), name='api-product'),
+    path('api/v1/products/<int:id>/substitutes/', api.ProductSubstitutes.as_view(), name='api-substitutes'),
+    path('api/v1/categories/', api.CategoryList.as_view(), name='api-categories'),
 ]
@@ -1,13 +1,32 @@
+import json
+import logging
+
 from django.utils.decorators import method_decorator
-from .models import Product, SavedProduct
+from .models import Product, ProductSubstitute, SavedProduct
 from django.contrib.auth.decorators import login_required
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.views.generic import ListView, DeleteView
 from django.views import View
 from django.shortcuts import render
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.utils.cache import add_never_cache_headers, patch_cache_control
 from pur_beurre.models import Product
 from pur_beurre.forms import FoodRequestForm
-from django.core.paginator import Paginator
+from pur_beurre.search import search_products
+from pur_beurre.autocomplete import shared_index
+from pur_beurre.substitutes import (STORED_SUBSTITUTES, SUBSTITUTES_PER_PRODUCT, better_nutriscores, live_substitutes,
+                                    stored_substitutes_cover)
+from pur_beurre.thumbnails import ThumbnailStore, queue_thumbnail
+from pur_beurre.favorites import remove_favorites, save_favorites
+from pur_beurre.popularity import ordering, save_counts
+from django.core.paginator import Page, Paginator
+from pur_beurre.cache import cache_anonymous_page, cached_catalog_data, page_number
+from pur_beurre.pagination import CachedCountPaginator
+from pur_beurre.exports import (CATALOG_FIELDS, EXPORTED_FIELDS, FORMATS, catalog_rows, export_lines,
+                                favorite_rows)
+
+logger = logging.getLogger(__name__)
 
 
 class Index(View):
@@ -32,105 +51,164 @@ class Legal(View):
 
 
 class Results(View):
-    """ Returning the products result template view, and returning the results by a research in the database
+    """ Returning the products result template view, and returning the results of a full-text research in the
+    database, the most relevant first or, with `?order=popular`, the most saved first
         """
     form = FoodRequestForm
     template_name = "pur_beurre/pages/results.html"
+    paginate_by = 30
 
     def get(self, request):
         form = self.form(request.GET)
         page = request.GET.get('page')
-        if form.is_valid():
-            research = form.cleaned_data.get('food')
-            queryset = Product.objects.filter(name__icontains=research)
+        if not form.is_valid():
+            return render(request, self.template_name)
 
-            if queryset.count() <= 0:
-                return render(request, self.template_name)
-            else:
-                new_queryset = []
-                for list in self.chunks(queryset, 3):
-                    new_queryset.append(list)
+        research = form.cleaned_data.get('food')
+        order = ordering(request)
+        queryset = search_products(research)
+        if order == 'popular':
+            queryset = queryset.order_by('-save_count', '-rank', 'id')
+        paginator = CachedCountPaginator(queryset, self.paginate_by)
+
+        if paginator.count <= 0:
+            return render(request, self.template_name)
+        else:
+            foods = paginator.get_page(page)
+            context_dict = {"queryset": foods,
+                            "order": order}
 
-                paginator = Paginator(new_queryset, 10)
-                foods = paginator.get_page(page)
-                context_dict = {"queryset": foods}
+            return render(request, self.template_name, context_dict)
 
-                return render(request, self.template_name, context_dict)
 
-    @staticmethod
-    def chunks(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+class Autocomplete(View):
+    """ Returning as JSON the most popular product names and brands starting with the text typed in the search box,
+    answered from the in-memory prefix index without touching the database
+        """
+    default_limit = 8
+    max_age = 300
+
+    def get(self, request):
+        text = request.GET.get('q', '')[:100]
+        limit = request.GET.get('limit', '')
+        limit = int(limit) if limit.isdigit() and int(limit) > 0 else self.default_limit
+        response = JsonResponse({'query': text, 'suggestions': shared_index.get().suggest(text, limit)})
+        patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
 
 
 class Substitutes(View):
-    """ Returning the substitutes result template view, and returning the results by a research in the database by
-    filtering out all the lesser nutrition grade products
+    """ Returning the substitutes result template view, and returning the precomputed substitutes of the product,
+    ranked by the similarity of their categories with its own or, with `?order=popular`, the most saved first
             """
     template_name = 'pur_beurre/pages/substitutes.html'
+    paginate_by = 30
 
+    @cache_anonymous_page('substitutes', variant=ordering)
     def get(self, request, id):
-        page = request.GET.get('page')
-        food = Product.objects.get(id=id)
-        basefood = Product.objects.get(id=id)
-        categories = food.categories.all().order_by('id')
-        nutriscore_list = self.nutriscore_list(food.nutriscore)
-
-        queryset = Product.objects.filter(categories=categories[0]).filter(
-            nutriscore__in=nutriscore_list).exclude(id=id)
+        page = page_number(request)
+        order = ordering(request)
+        data = cached_catalog_data(request, ('substitutes', id, page, order),
+                                   lambda: self.substitutes_page(id, page, order))
 
-        for category in categories[1:5]:
-            query = Product.objects.filter(categories=category).filter(
-                nutriscore__in=nutriscore_list).exclude(id=id)
-            queryset = queryset.intersection(query)
-
-        if queryset.count() == 0:
+        if not data:
             return render(request, self.template_name)
         else:
-            new_queryset = []
-            for list in self.chunks(queryset, 3):
-                new_queryset.append(list)
-
-            paginator = Paginator(new_queryset, 10)
-            foods = paginator.get_page(page)
+            foods = Page(data['foods'], data['number'], Paginator(range(data['count']), self.paginate_by))
             context_dict = {"queryset": foods,
-                            "research": food,
-                            "basefood": basefood}
+                            "research": data['basefood'],
+                            "basefood": data['basefood'],
+                            "order": order}
+            if request.user.is_authenticated:
+                ids = [data['basefood'].id] + [food.id for food in data['foods']]
+                context_dict["saved"] = set(SavedProduct.objects.filter(
+                    saved_by=request.user, saved_product_id__in=ids).values_list('saved_product_id', flat=True))
             return render(request, self.template_name, context_dict)
 
-    @staticmethod
-    def nutriscore_list(nutriscore):
-        if nutriscore == 'A':
-            return ['A']
-        elif nutriscore == 'B':
-            return ['A']
-        elif nutriscore == 'C':
-            return ['A', 'B']
-        elif nutriscore == 'D':
-            return ['A', 'B', 'C']
-        elif nutriscore == 'E':
-            return ['A', 'B', 'C', 'D']
-        elif nutriscore == 'Z':
-            return ['A', 'B', 'C', 'D', 'E']
+    def substitutes_page(self, id, page, order='relevance'):
+        """ Returning the product and the requested page of its substitutes, in a cacheable form. Only the first
+        STORED_SUBSTITUTES are precomputed: when there may be more, the deeper pages and the popularity ranking,
+        which needs all of them, are served by the engine, the first pages telling SUBSTITUTES_PER_PRODUCT
+        substitutes.
+        """
+        basefood = Product.objects.get(id=id)
+        stored = ProductSubstitute.objects.filter(product_id=id).count()
+        truncated = stored >= STORED_SUBSTITUTES
+        if not stored_substitutes_cover(stored, int(page) * self.paginate_by) or truncated and order == 'popular':
+            return self.live_substitutes_page(basefood, page, order)
+        queryset = Product.objects.filter(substitute_of__product_id=id, is_active=True)
+        if order == 'popular':
+            queryset = queryset.order_by('-save_count', 'substitute_of__rank')
+        else:
+            queryset = queryset.order_by('substitute_of__rank')
+        paginator = Paginator(queryset, self.paginate_by)
+        foods = paginator.get_page(page)
+        return {'basefood': basefood,
+                'foods': list(foods.object_list),
+                'number': foods.number,
+                'count': SUBSTITUTES_PER_PRODUCT if truncated else paginator.count}
+
+    def live_substitutes_page(self, basefood, page, order='relevance'):
+        """ Ranking the substitutes of a product not precomputed, or beyond the precomputed ones, with the in-memory
+        similarity engine
+        """
+        candidates = live_substitutes(basefood.id, basefood.nutriscore)
+        if not candidates:
+            return {}
+        ids = [candidate['id'] for candidate in candidates]
+        if order == 'popular':
+            counts = dict(Product.objects.filter(id__in=ids).values_list('id', 'save_count'))
+            ids.sort(key=lambda food_id: -counts.get(food_id, 0))
+        paginator = Paginator(ids, self.paginate_by)
+        foods = paginator.get_page(page)
+        products = Product.objects.filter(is_active=True).in_bulk(foods.object_list)
+        return {'basefood': basefood,
+                'foods': [products[food_id] for food_id in foods.object_list if food_id in products],
+                'number': foods.number,
+                'count': paginator.count}
 
     @staticmethod
-    def chunks(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+    def nutriscore_list(nutriscore):
+        return better_nutriscores(nutriscore)
 
 
 class Food(View):
     """Return the template for a single product"""
     template_name = 'pur_beurre/pages/food.html'
 
+    @cache_anonymous_page('food')
     def get(self, request, id):
-        food = Product.objects.get(id=id)
+        food = cached_catalog_data(request, ('food', id), lambda: Product.objects.get(id=id))
 
         context_dict = {'food': food}
 
         return render(request, self.template_name, context_dict)
 
 
+class Thumbnail(View):
+    """ Serving a product image thumbnail. Its url names the hash of the original image, so it never changes and
+    can be cached forever. A thumbnail missing from this server is queued for the next fetch_images, the request
+    being redirected to the original image.
+        """
+    max_age = 60 * 60 * 24 * 365
+
+    def get(self, request, digest, size):
+        if size not in settings.THUMBNAIL_SIZES or len(digest) != 64:
+            raise Http404
+        store = ThumbnailStore()
+        thumbnail_file = store.open(digest, size)
+        if thumbnail_file is None:
+            product = Product.objects.filter(thumbnail=digest).values('image', 'thumbnail_missing').first()
+            if not product or not product['image']:
+                raise Http404
+            if not product['thumbnail_missing']:
+                queue_thumbnail(digest)
+            return HttpResponseRedirect(product['image'])
+        response = FileResponse(thumbnail_file, content_type=store.content_type)
+        patch_cache_control(response, public=True, max_age=self.max_age, immutable=True)
+        return response
+
+
 class SaveProduct(View):
     """Saving product process. If it already exists in the database, it cannot be saved twice
     """
@@ -145,10 +223,12 @@ class SaveProduct(View):
 
         try:
             save = SavedProduct(saved_by=request.user, saved_product=food)
-            save.save()
-            print(foodr.name)
-        except IntegrityError as error:
-            print(error)
+            with transaction.atomic():
+                save.save()
+            save_counts.add([foodr.id], 1)
+            logger.info("Product %s saved by user %s", foodr.id, request.user.id)
+        except IntegrityError:
+            logger.info("Product %s already saved by user %s", foodr.id, request.user.id)
             already_saved = "Ce produit figure déjà dans vos favoris"
             context_dict = {'foodr': foodr,
                             'already_saved': already_saved}
@@ -161,34 +241,87 @@ class SaveProduct(View):
             yield l[i:i + n]
 
 
+class Favorites(View):
+    """ Saving and removing favorites of the logged in user as JSON, many at once and without any page render. The
+    product ids come in the `save` and `remove` lists of a JSON body or of the form data.
+        """
+    max_ids = 100
+
+    def post(self, request):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': "Connexion requise"}, status=401)
+        try:
+            save, remove = self.product_ids(request)
+        except (TypeError, ValueError):
+            return JsonResponse({'error': "Identifiants de produits invalides"}, status=400)
+        saved = save_favorites(request.user.id, save)
+        removed = remove_favorites(request.user.id, remove)
+        logger.info("User %s saved %s and removed %s favorites", request.user.id, saved, removed)
+        return JsonResponse({'saved': saved, 'removed': removed})
+
+    def product_ids(self, request):
+        if request.content_type == 'application/json':
+            data = json.loads(request.body.decode('utf8') or '{}')
+            if not isinstance(data, dict):
+                raise ValueError
+            save, remove = data.get('save') or [], data.get('remove') or []
+        else:
+            save, remove = request.POST.getlist('save'), request.POST.getlist('remove')
+        if not isinstance(save, list) or not isinstance(remove, list) or len(save) + len(remove) > self.max_ids:
+            raise ValueError
+        return sorted({int(product_id) for product_id in save}), sorted({int(product_id) for product_id in remove})
+
+
 class UserSavedProductsList(ListView):
     """Displaying user's favorites products.
     """
     model = SavedProduct
     template_name = 'pur_beurre/pages/saved_products.html'
-    paginate_by = 6
+    paginate_by = 30
 
     def get(self, request):
         page = request.GET.get('page')
-        queryset = SavedProduct.objects.select_related('saved_product').filter(saved_by=request.user)
+        queryset = SavedProduct.objects.select_related('saved_product').filter(saved_by=request.user).order_by('id')
+        paginator = Paginator(queryset, self.paginate_by)
 
-        if queryset.count() <= 0:
+        if paginator.count <= 0:
             return render(request, self.template_name)
         else:
-            new_queryset = []
-            for list in self.chunks(queryset, 3):
-                new_queryset.append(list)
-
-            paginator = Paginator(new_queryset, 10)
             foods = paginator.get_page(page)
             context_dict = {"queryset": foods}
 
             return render(request, self.template_name, context_dict)
 
-    @staticmethod
-    def chunks(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+
+class Export(View):
+    """ Base of the streaming exports, in the format named by the url. `rows` yields the exported rows, given the
+    user when `per_user` is set
+        """
+    filename = 'catalogue'
+    fields = CATALOG_FIELDS
+    rows = staticmethod(catalog_rows)
+    per_user = False
+
+    def get(self, request, format):
+        if format not in FORMATS:
+            raise Http404
+        rows = self.rows(request.user) if self.per_user else self.rows()
+        response = StreamingHttpResponse(export_lines(rows, self.fields, format), content_type=FORMATS[format])
+        response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(self.filename, format)
+        add_never_cache_headers(response)
+        return response
+
+
+class FavoritesExport(Export):
+    """Downloading the user's favorite products"""
+    filename = 'favoris'
+    fields = EXPORTED_FIELDS
+    rows = staticmethod(favorite_rows)
+    per_user = True
+
+
+class CatalogExport(Export):
+    """Downloading the whole catalog, with the categories of every product. For the staff only"""
 
 
 class SaveDelete(DeleteView):
@@ -197,3 +330,7 @@ class SaveDelete(DeleteView):
     template_name = 'pur_beurre/pages/save_confirm_delete.html'
     success_url = '/saved_products'
 
+    def delete(self, request, *args, **kwargs):
+        response = super().delete(request, *args, **kwargs)
+        save_counts.add([self.object.saved_product_id], -1)
+        return response
@@ -0,0 +1,44 @@
+// Suggestions of the search boxes, fetched from the autocomplete endpoint while the user types
+(function ($) {
+  "use strict";
+
+  var delay = 120;
+  var minLength = 2;
+  var cache = {};
+
+  $('input[data-autocomplete]').each(function () {
+    var input = $(this);
+    var datalist = $('#' + input.attr('list'));
+    var timer = null;
+    var last = null;
+
+    function show(suggestions) {
+      datalist.empty();
+      $.each(suggestions, function (i, suggestion) {
+        datalist.append($('<option>').attr('value', suggestion.label));
+      });
+    }
+
+    input.on('input', function () {
+      var text = $.trim(input.val()).toLowerCase();
+      clearTimeout(timer);
+      if (text.length < minLength || text === last) {
+        return;
+      }
+      last = text;
+      if (cache[text]) {
+        show(cache[text]);
+        return;
+      }
+      timer = setTimeout(function () {
+        $.getJSON(input.data('autocomplete'), {q: text}, function (data) {
+          cache[text] = data.suggestions;
+          if (last === text) {
+            show(data.suggestions);
+          }
+        });
+      }, delay);
+    });
+  });
+
+})(jQuery);
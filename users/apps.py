@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
 
 
 class UsersConfig(AppConfig):
     name = 'users'
+
+    def ready(self):
+        from users.backends import forget_user
+        post_save.connect(forget_user, sender=get_user_model(), dispatch_uid='users.forget_saved_user')
+        post_delete.connect(forget_user, sender=get_user_model(), dispatch_uid='users.forget_deleted_user')
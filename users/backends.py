@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+
+def user_cache_key(user_id):
+    return 'users:user:{0}'.format(user_id)
+
+
+class CachedModelBackend(ModelBackend):
+    """ Authentication backend reading the logged in user from the cache, the database being read only on a miss.
+    The cached user is forgotten whenever it is saved or deleted, a new password or a deactivation then applying
+    to the next request.
+    """
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+
+def forget_user(sender, instance, **kwargs):
+    """ Dropping a saved or deleted user from the cache
+    """
+    cache.delete(user_cache_key(instance.pk))
@@ -0,0 +1,26 @@
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = "Supprime par lots les sessions expirées enregistrées en base de données"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Nombre de sessions supprimées par requête")
+
+    def handle(self, *args, **options):
+        """ Deleting the expired sessions a batch at a time, each DELETE committed on its own, rather than in one
+        statement holding its locks on the whole table. The sessions kept only in the cache expire by themselves.
+                """
+        batch_size = options['batch_size']
+        expired = Session.objects.filter(expire_date__lt=timezone.now()).order_by('session_key')
+        deleted = 0
+        while True:
+            keys = list(expired.values_list('session_key', flat=True)[:batch_size])
+            if keys:
+                deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+            if len(keys) < batch_size:
+                break
+        self.stdout.write("{0} sessions expirées supprimées".format(deleted))